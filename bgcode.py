@@ -0,0 +1,396 @@
+import struct, zlib, codecs
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Binary GCode exception
+class BGCodeException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+# Binary GCode (.bgcode) format
+# File header : magic 'GCDE', version (u32), checksum type (u16)
+# Block       : header - type (u16), compression (u16), uncompressed size (u32), compressed size (u32, only if compressed)
+#               params - encoding (u16) or format, width, height (u16 x3) for thumbnails
+#               data
+#               checksum - CRC32 (u32) of header + params + data (if checksum type is CRC32)
+# Blocks order: file metadata, printer metadata, thumbnails, print metadata, slicer metadata, gcode
+MAGIC   = b'GCDE'
+VERSION = 1
+
+CHECKSUM_NONE  = 0
+CHECKSUM_CRC32 = 1
+
+BLOCK_FILE_METADATA    = 0
+BLOCK_GCODE            = 1
+BLOCK_SLICER_METADATA  = 2
+BLOCK_PRINTER_METADATA = 3
+BLOCK_PRINT_METADATA   = 4
+BLOCK_THUMBNAIL        = 5
+
+COMPRESSION_NONE           = 0
+COMPRESSION_DEFLATE        = 1
+COMPRESSION_HEATSHRINK_11_4 = 2
+COMPRESSION_HEATSHRINK_12_4 = 3
+
+ENCODING_INI = 0                        # Metadata encoding
+
+ENCODING_NONE                = 0        # GCode encodings
+ENCODING_MEATPACK            = 1
+ENCODING_MEATPACK_COMMENTS   = 2
+
+# Max size of the uncompressed GCode block (same as PrusaSlicer)
+GCODE_BLOCK_SIZE = 65535
+
+# Check if the file is binary GCode
+def is_bgcode(gcode_file):
+    with open(gcode_file, mode='rb') as gcode_in:
+        return gcode_in.read(len(MAGIC)) == MAGIC
+
+# Heatshrink (LZSS) decoder
+# Bitstream MSB first: 1 + 8 bit literal, or 0 + (index - 1) + (count - 1) back-reference
+def heatshrink_decode(data, window_sz2, lookahead_sz2, size):
+    out = bytearray()
+    bits = 0            # Bit accumulator
+    bits_count = 0
+    pos = 0
+
+    # Read n bits (None if not enough data)
+    def read_bits(n):
+        nonlocal bits, bits_count, pos
+        while bits_count < n:
+            if pos >= len(data):
+                return None
+            bits = (bits << 8) | data[pos]
+            bits_count += 8
+            pos += 1
+        bits_count -= n
+        val = bits >> bits_count
+        bits &= (1 << bits_count) - 1
+        return val
+
+    while len(out) < size:
+        tag = read_bits(1)
+        if tag is None:
+            break
+        if tag:
+            literal = read_bits(8)
+            if literal is None:
+                break
+            out.append(literal)
+        else:
+            index = read_bits(window_sz2)
+            count = read_bits(lookahead_sz2)
+            if index is None or count is None:
+                break
+            index += 1
+            for indx in range(count + 1):
+                out.append(out[-index] if index <= len(out) else 0)
+
+    if len(out) != size:
+        raise BGCodeException("Heatshrink block decoded to {decoded} bytes, expected {size}".format(decoded = len(out), size = size))
+    return bytes(out)
+
+# MeatPack decoder
+# Characters packed as 4 bit codes two per byte (low nibble first), 0b1111 means
+# the full character follows, 0xFF 0xFF <command> switches the modes
+MEATPACK_SIGNAL          = 0xFF
+MEATPACK_ENABLE_PACKING  = 251
+MEATPACK_DISABLE_PACKING = 250
+MEATPACK_RESET_ALL       = 249
+MEATPACK_ENABLE_NOSPACES = 247
+MEATPACK_DISABLE_NOSPACES = 246
+
+meatpack_table = b'0123456789. \nGX'
+
+# Params of the G lines - MeatPack drops the spaces in front of them
+meatpack_gline_params = b'XYZEFIJRPWHCA'
+
+def meatpack_decode(data):
+    chars = bytearray()
+
+    packing = False
+    nospaces = False
+    signal_count = 0
+    command = False
+    full_char_queue = 0
+    char_buf = None
+
+    def unpack(code):
+        if code == 0b1011 and nospaces:
+            return ord('E')
+        return meatpack_table[code]
+
+    # Decode the data byte (after the commands are handled)
+    def decode(c):
+        nonlocal full_char_queue, char_buf
+        if not packing:
+            chars.append(c)
+            return
+        if full_char_queue > 0:
+            chars.append(c)
+            if char_buf is not None:
+                chars.append(char_buf)
+                char_buf = None
+            full_char_queue -= 1
+            return
+
+        first_full = (c & 0x0F) == 0x0F
+        second_full = (c & 0xF0) == 0xF0
+        if first_full:
+            full_char_queue += 1
+            if second_full:
+                full_char_queue += 1
+            else:
+                char_buf = unpack(c >> 4)
+        else:
+            first = unpack(c & 0x0F)
+            chars.append(first)
+            if first != ord('\n'):
+                if second_full:
+                    full_char_queue += 1
+                else:
+                    chars.append(unpack(c >> 4))
+
+    for c in data:
+        if c == MEATPACK_SIGNAL:
+            if signal_count > 0:
+                command = True
+                signal_count = 0
+            else:
+                signal_count += 1
+            continue
+        if command:
+            if c == MEATPACK_ENABLE_PACKING:
+                packing = True
+            elif c == MEATPACK_DISABLE_PACKING or c == MEATPACK_RESET_ALL:
+                packing = False
+            elif c == MEATPACK_ENABLE_NOSPACES:
+                nospaces = True
+            elif c == MEATPACK_DISABLE_NOSPACES:
+                nospaces = False
+            command = False
+            continue
+        if signal_count > 0:
+            decode(MEATPACK_SIGNAL)
+            signal_count = 0
+        decode(c)
+
+    # Put back the spaces in front of the G line params and drop the empty lines
+    out = bytearray()
+    gline = False
+    for c in chars:
+        last = out[-1] if len(out) > 0 else ord('\n')
+        if c == ord('G') and last == ord('\n'):
+            gline = True
+        elif c == ord('\n'):
+            gline = False
+            if last == ord('\n') and len(out) > 0:
+                continue
+        if gline and last != ord(' ') and c in meatpack_gline_params:
+            out.append(ord(' '))
+        out.append(c)
+    return bytes(out)
+
+# Metadata block contents - key=value lines
+def metadata_decode(data):
+    metadata = {}
+    for line in data.decode('utf8').splitlines():
+        sep = line.find('=')
+        if sep == -1:
+            continue
+        metadata[line[0:sep]] = line[sep+1:]
+    return metadata
+
+def metadata_encode(metadata):
+    return ''.join(["{key}={value}\n".format(key = key, value = value) for key, value in metadata.items()]).encode('utf8')
+
+# Block of the file
+class BGCodeBlock:
+    def __init__(self, type, compression = COMPRESSION_NONE, params = (0,), data = b''):
+        self.type = type
+        self.compression = compression
+        self.params = params         # (encoding,) or (format, width, height) for thumbnails
+        self.data = data             # Uncompressed data
+
+    # Decompress the data read from the file
+    @staticmethod
+    def decompress(compression, data, size):
+        if compression == COMPRESSION_NONE:
+            return data
+        if compression == COMPRESSION_DEFLATE:
+            return zlib.decompress(data)
+        if compression == COMPRESSION_HEATSHRINK_11_4:
+            return heatshrink_decode(data, 11, 4, size)
+        if compression == COMPRESSION_HEATSHRINK_12_4:
+            return heatshrink_decode(data, 12, 4, size)
+        raise BGCodeException("Unsupported block compression {compression}".format(compression = compression))
+
+    # Serialize the block
+    # - only the deflate compression is supported for writing
+    def serialize(self, checksum_type):
+        data = self.data
+        compression = self.compression
+        if compression == COMPRESSION_DEFLATE:
+            data = zlib.compress(self.data)
+        elif compression != COMPRESSION_NONE:
+            raise BGCodeException("Unsupported block compression {compression} for writing".format(compression = compression))
+
+        header = struct.pack('<HHI', self.type, compression, len(self.data))
+        if compression != COMPRESSION_NONE:
+            header += struct.pack('<I', len(data))
+        params = struct.pack('<' + 'H' * len(self.params), *self.params)
+
+        block = header + params + data
+        if checksum_type == CHECKSUM_CRC32:
+            block += struct.pack('<I', zlib.crc32(block))
+        return block
+
+# Binary GCode file
+# Metadata blocks are read upfront, the GCode blocks are decoded on iteration
+class BGCodeFile:
+    def __init__(self, gcode_file):
+        self.gcode_file = gcode_file
+        self.checksum_type = CHECKSUM_CRC32
+        self.file_metadata = None
+        self.printer_metadata = {}
+        self.print_metadata = {}
+        self.slicer_metadata = {}
+        self.thumbnails = []
+        self.gcode_offset = None
+
+        with open(gcode_file, mode='rb') as gcode_in:
+            magic, version, self.checksum_type = struct.unpack('<4sIH', gcode_in.read(10))
+            if magic != MAGIC:
+                raise BGCodeException("{file} is not a binary GCode file".format(file = gcode_file))
+            if version != VERSION:
+                raise BGCodeException("Unsupported binary GCode version {version}".format(version = version))
+
+            while True:
+                offset = gcode_in.tell()
+                block = self.read_block(gcode_in)
+                if block is None:
+                    break
+                if block.type == BLOCK_GCODE:
+                    self.gcode_offset = offset
+                    break
+                elif block.type == BLOCK_FILE_METADATA:
+                    self.file_metadata = metadata_decode(block.data)
+                elif block.type == BLOCK_PRINTER_METADATA:
+                    self.printer_metadata = metadata_decode(block.data)
+                elif block.type == BLOCK_PRINT_METADATA:
+                    self.print_metadata = metadata_decode(block.data)
+                elif block.type == BLOCK_SLICER_METADATA:
+                    self.slicer_metadata = metadata_decode(block.data)
+                elif block.type == BLOCK_THUMBNAIL:
+                    self.thumbnails.append(block)
+                else:
+                    logger.warn("Skipping unknown binary GCode block type {type}".format(type = block.type))
+
+    # Read the block - None at the end of the file
+    def read_block(self, gcode_in):
+        header = gcode_in.read(8)
+        if len(header) == 0:
+            return None
+        if len(header) < 8:
+            raise BGCodeException("Truncated binary GCode block header")
+        type, compression, size = struct.unpack('<HHI', header)
+        data_size = size
+        if compression != COMPRESSION_NONE:
+            compressed = gcode_in.read(4)
+            header += compressed
+            data_size = struct.unpack('<I', compressed)[0]
+
+        params_size = 6 if type == BLOCK_THUMBNAIL else 2
+        params = gcode_in.read(params_size)
+        data = gcode_in.read(data_size)
+        if len(params) < params_size or len(data) < data_size:
+            raise BGCodeException("Truncated binary GCode block")
+
+        if self.checksum_type == CHECKSUM_CRC32:
+            checksum = struct.unpack('<I', gcode_in.read(4))[0]
+            if checksum != zlib.crc32(header + params + data):
+                raise BGCodeException("Binary GCode block checksum mismatch")
+
+        return BGCodeBlock(
+            type = type,
+            compression = compression,
+            params = struct.unpack('<' + 'H' * (params_size // 2), params),
+            data = BGCodeBlock.decompress(compression, data, size))
+
+    # Decoded text of the GCode blocks - one block at a time
+    def gcode_chunks(self):
+        if self.gcode_offset is None:
+            return
+        decoder = codecs.getincrementaldecoder('utf8')()
+        with open(self.gcode_file, mode='rb') as gcode_in:
+            gcode_in.seek(self.gcode_offset)
+            while True:
+                block = self.read_block(gcode_in)
+                if block is None:
+                    break
+                if block.type != BLOCK_GCODE:
+                    continue
+                data = block.data
+                encoding = block.params[0]
+                if encoding == ENCODING_MEATPACK or encoding == ENCODING_MEATPACK_COMMENTS:
+                    data = meatpack_decode(data)
+                elif encoding != ENCODING_NONE:
+                    raise BGCodeException("Unsupported GCode block encoding {encoding}".format(encoding = encoding))
+                yield decoder.decode(data)
+        yield decoder.decode(b'', final = True)
+
+# Binary GCode writer
+# Stream like (write) - the text is split at the line ends into the GCode blocks
+# Header and metadata blocks (from the source file) are written on creation
+class BGCodeWriter:
+    def __init__(self, gcode_out, source = None, compression = COMPRESSION_DEFLATE, checksum_type = CHECKSUM_CRC32):
+        self.gcode_out = gcode_out
+        self.compression = compression
+        self.checksum_type = checksum_type
+        self.pending = []
+        self.pending_size = 0
+
+        gcode_out.write(struct.pack('<4sIH', MAGIC, VERSION, checksum_type))
+
+        if source is not None:
+            if source.file_metadata is not None:
+                self.write_metadata(BLOCK_FILE_METADATA, source.file_metadata)
+            self.write_metadata(BLOCK_PRINTER_METADATA, source.printer_metadata)
+            # Thumbnails are images already - stored uncompressed
+            for thumbnail in source.thumbnails:
+                self.write_block(BGCodeBlock(BLOCK_THUMBNAIL, COMPRESSION_NONE, thumbnail.params, thumbnail.data))
+            self.write_metadata(BLOCK_PRINT_METADATA, source.print_metadata)
+            self.write_metadata(BLOCK_SLICER_METADATA, source.slicer_metadata)
+
+    def write_block(self, block):
+        self.gcode_out.write(block.serialize(self.checksum_type))
+
+    def write_metadata(self, type, metadata):
+        self.write_block(BGCodeBlock(type, self.compression, (ENCODING_INI,), metadata_encode(metadata)))
+
+    # Write the GCode text
+    def write(self, text):
+        self.pending.append(text.encode('utf8'))
+        self.pending_size += len(self.pending[-1])
+        if self.pending_size >= GCODE_BLOCK_SIZE:
+            self.flush_blocks(final = False)
+
+    # Write the pending text as GCode blocks
+    # - unless final, the text after the last complete line is kept for the next block
+    def flush_blocks(self, final):
+        data = b''.join(self.pending)
+        start = 0
+        while len(data) - start >= GCODE_BLOCK_SIZE or (final and start < len(data)):
+            end = min(start + GCODE_BLOCK_SIZE, len(data))
+            if end < len(data):
+                line_end = data.rfind(b'\n', start, end)
+                if line_end != -1:
+                    end = line_end + 1
+            self.write_block(BGCodeBlock(BLOCK_GCODE, self.compression, (ENCODING_NONE,), data[start:end]))
+            start = end
+        self.pending = [data[start:]]
+        self.pending_size = len(data) - start
+
+    def close(self):
+        self.flush_blocks(final = True)
@@ -0,0 +1,228 @@
+import conf
+import gcode_analyzer
+import edit_overlay
+from gcode_analyzer import Token, GCodeAnalyzer, opcode_id
+
+import re, json, time, datetime
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Calibration exception
+class CalibrationException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+# Runtime classes - the opcodes the correction factor of the class applies to
+RUNTIME_CLASSES = {
+    'move'        : ('G0', 'G1', 'G2', 'G3'),   # move speed (move_speed_xy/move_speed_z) guess
+    'tool_change' : ('T',),                     # runtime_tool_change
+    'retract'     : ('G10',),                   # runtime_g10
+    'unretract'   : ('G11',) }                  # runtime_g11
+
+# Timing markers - M118 S"TCPSPP:L<layer>" after the layer changes and M118 S"TCPSPP:T<index>" after the tool changes
+# The firmware echoes them into its log with the time they were executed
+MARKER_PREFIX = 'TCPSPP:'
+marker_pattern = re.compile(r'TCPSPP:([LT]\d+)')
+
+# Log line - the timestamp (seconds or the date and time) followed by the marker
+# 2024-01-05 12:34:56 [info] TCPSPP:L3
+# 1234.5 TCPSPP:T12
+log_pattern = re.compile(r'^\s*(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:\.\d+)?|\d+(?:\.\d+)?)\b.*?TCPSPP:([LT]\d+)')
+
+# Marker GCode
+def marker_gcode(marker):
+    return gcode_analyzer.GCode('M118', {'S' : '"{prefix}{marker}"'.format(prefix = MARKER_PREFIX, marker = marker)})
+
+# Marker of the token (None if not a marker)
+def token_marker(token):
+    if token.type != Token.GCODE or token.gcode != 'M118':
+        return None
+    match = marker_pattern.search(str(token.param.get('S', '')))
+    return match.group(1) if match is not None else None
+
+# Inject the timing markers after the layer changes and the tool changes
+# - edits : where the markers go
+def inject_markers(gcode_analyzer, edits = None):
+    edits = edit_overlay.edits_or_in_place(edits)
+
+    tool_change_indx = 0
+    for token in list(gcode_analyzer.tokens):
+        if token.type == Token.PARAMS and token.label == 'AFTER_LAYER_CHANGE':
+            edits.insert_after(token, marker_gcode('L{layer}'.format(layer = token.param[0])))
+        elif token.type == Token.TOOLCHANGE:
+            edits.insert_after(token, marker_gcode('T{indx}'.format(indx = tool_change_indx)))
+            tool_change_indx += 1
+
+# Read the marker times from the log - marker -> time [s]
+# (the first occurrence of the marker if the log has it more than once)
+def read_marker_times(log_file):
+    times = {}
+    with open(log_file, mode = 'r', errors = 'replace') as log_in:
+        for line in log_in:
+            match = log_pattern.search(line)
+            if match is None:
+                continue
+            timestamp, marker = match.groups()
+            if '-' in timestamp:
+                seconds = datetime.datetime.fromisoformat(timestamp.replace(' ', 'T')).timestamp()
+            else:
+                seconds = float(timestamp)
+            times.setdefault(marker, seconds)
+    return times
+
+# Runtime class of the opcodes - opcode id -> class
+def class_opcodes():
+    return { opcode_id(name) : runtime_class for runtime_class, names in RUNTIME_CLASSES.items() for name in names }
+
+# Estimated runtimes of the classes between the markers
+# Returns list of (marker_start, marker_end, {class : runtime}, other_runtime)
+def marker_intervals(gcode_analyzer):
+    classes = class_opcodes()
+    intervals = []
+    marker = None
+    runtimes = {}
+    other = 0.0
+    for token in gcode_analyzer.tokens:
+        next_marker = token_marker(token)
+        if next_marker is not None:
+            if marker is not None:
+                intervals.append((marker, next_marker, runtimes, other))
+            marker = next_marker
+            runtimes = {}
+            other = 0.0
+            continue
+
+        runtime_class = classes.get(token.op)
+        if runtime_class is not None:
+            runtimes[runtime_class] = runtimes.get(runtime_class, 0.0) + token.runtime
+        else:
+            other += token.runtime
+    return intervals
+
+# Solve the linear system (Gaussian elimination with the partial pivoting)
+def solve(matrix, vector):
+    size = len(vector)
+    rows = [list(matrix[indx]) + [vector[indx]] for indx in range(size)]
+    for col in range(size):
+        pivot = max(range(col, size), key = lambda row: abs(rows[row][col]))
+        if rows[pivot][col] == 0.0:
+            raise CalibrationException("Calibration data doesn't determine the correction factors")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for row in range(col + 1, size):
+            ratio = rows[row][col] / rows[col][col]
+            for k in range(col, size + 1):
+                rows[row][k] -= ratio * rows[col][k]
+    result = [0.0] * size
+    for row in reversed(range(size)):
+        result[row] = (rows[row][size] - sum(rows[row][k] * result[k] for k in range(row + 1, size))) / rows[row][row]
+    return result
+
+# Per printer runtime correction factors of the classes
+# The estimated runtime of the tokens of the class is multiplied by its factor
+class CalibrationProfile:
+    def __init__(self, printer = None, factors = None, samples = 0, residual = 0.0):
+        self.printer = printer
+        self.factors = factors if factors is not None else {}
+        self.samples = samples      # Number of the measured intervals
+        self.residual = residual    # RMS of the fitted interval errors [s]
+
+    def to_dict(self):
+        return {
+            'printer' : self.printer,
+            'factors' : self.factors,
+            'samples' : self.samples,
+            'residual' : self.residual }
+
+    @staticmethod
+    def from_dict(values):
+        return CalibrationProfile(
+            printer = values.get('printer'),
+            factors = { runtime_class : float(factor) for runtime_class, factor in values.get('factors', {}).items() },
+            samples = values.get('samples', 0),
+            residual = values.get('residual', 0.0))
+
+    @staticmethod
+    def load(profile_file):
+        with open(profile_file, mode = 'r') as profile_in:
+            profile = CalibrationProfile.from_dict(json.load(profile_in))
+        for runtime_class in profile.factors:
+            if runtime_class not in RUNTIME_CLASSES:
+                raise CalibrationException("Unknown runtime class {name} in the calibration profile {file}".format(name = runtime_class, file = profile_file))
+        return profile
+
+    def save(self, profile_file):
+        with open(profile_file, mode = 'w') as profile_out:
+            json.dump(self.to_dict(), profile_out, indent = 2)
+
+    # Use the factors in the analysis (GCodeAnalyzer.analyze_state)
+    def apply(self):
+        GCodeAnalyzer.runtime_factors = {}
+        for runtime_class, factor in self.factors.items():
+            for name in RUNTIME_CLASSES[runtime_class]:
+                GCodeAnalyzer.runtime_factors[opcode_id(name)] = factor
+        logger.info("Runtime calibration {printer}: {factors}".format(printer = self.printer, factors = self.factors))
+
+# Fit the correction factors of the classes to the measured durations (least squares)
+# - gcode_file : printed GCode (with the timing markers)
+# - log_file   : log with the marker times
+# The intervals between the subsequent markers found in the log are the samples:
+#   measured = other + sum(factor[class] * runtime[class])
+# The factors are regularized towards 1.0 (conf.calibration_regularization) so the classes
+# the samples don't tell apart keep the default estimate
+def calibrate(gcode_file, log_file, printer = None):
+    t_start = time.time()
+    marker_times = read_marker_times(log_file)
+    if len(marker_times) == 0:
+        raise CalibrationException("No timing markers found in {file}".format(file = log_file))
+
+    # Estimate without the correction
+    runtime_factors = GCodeAnalyzer.runtime_factors
+    GCodeAnalyzer.runtime_factors = {}
+    try:
+        analyzer = gcode_analyzer.GCodeAnalyzer(gcode_file)
+        analyzer.analyze_state()
+        intervals = marker_intervals(analyzer)
+        analyzer.close()
+    finally:
+        GCodeAnalyzer.runtime_factors = runtime_factors
+
+    classes = list(RUNTIME_CLASSES)
+    samples = []
+    for marker_start, marker_end, runtimes, other in intervals:
+        if marker_start not in marker_times or marker_end not in marker_times:
+            continue
+        measured = marker_times[marker_end] - marker_times[marker_start]
+        if measured < 0.0:
+            logger.warn("Timing marker {marker} logged before {previous} - skipped".format(marker = marker_end, previous = marker_start))
+            continue
+        samples.append(([runtimes.get(runtime_class, 0.0) for runtime_class in classes], measured - other))
+
+    if len(samples) == 0:
+        raise CalibrationException("No intervals between the timing markers of {gcode} found in {log}".format(gcode = gcode_file, log = log_file))
+
+    # Normal equations (A'A + l * I) f = A'b + l * 1
+    size = len(classes)
+    normal = [[sum(row[i] * row[j] for row, measured in samples) for j in range(size)] for i in range(size)]
+    rhs = [sum(row[i] * measured for row, measured in samples) for i in range(size)]
+    scale = max(normal[i][i] for i in range(size))
+    weight = conf.calibration_regularization * (scale if scale > 0.0 else 1.0)
+    for i in range(size):
+        normal[i][i] += weight
+        rhs[i] += weight
+    factors = solve(normal, rhs)
+
+    profile = CalibrationProfile(printer = printer, samples = len(samples))
+    for runtime_class, factor in zip(classes, factors):
+        if factor < conf.calibration_min_factor:
+            logger.warn("Correction factor {factor:0.3f} of {name} out of range - clamped".format(factor = factor, name = runtime_class))
+            factor = conf.calibration_min_factor
+        profile.factors[runtime_class] = factor
+
+    errors = [measured - sum(profile.factors[runtime_class] * value for runtime_class, value in zip(classes, row)) for row, measured in samples]
+    profile.residual = (sum(error * error for error in errors) / len(errors)) ** 0.5
+
+    t_end = time.time()
+    logger.info("Calibrated from {samples} intervals - factors: {factors}, RMS error {residual:0.2f}s [elapsed: {elapsed:0.2f}s]".format(
+        samples = profile.samples, factors = profile.factors, residual = profile.residual, elapsed = t_end - t_start))
+    return profile
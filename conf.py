@@ -44,12 +44,41 @@ runtime_g10         = 0.4               # z-hop time of 1.2mm at 1200mm/min and
 runtime_g11         = 0.4               # z-hop time of 1.2mm at 1200mm/min and retract
 runtime_default     = 0                 # Default instruction time
 
+# Runtime calibration (calibration.py) - correction factors fitted to the measured print durations
+calibration_profile        = None       # Path of the calibration profile (JSON) used by the runtime estimates (None - not calibrated)
+calibration_markers        = False      # Inject the M118 timing markers after the layer and tool changes (logged by the firmware)
+calibration_regularization = 1e-3       # Pull of the fitted factors towards 1.0 (relative to the largest class runtime)
+calibration_min_factor     = 0.05       # Lowest correction factor accepted from the fit
+
+# Motion planner (acceleration aware runtimes) - M201/M203/M566 found in the GCode override the limits
+runtime_planner          = False                              # Estimate the move runtimes with the motion planner (used by the temp managment)
+planner_max_acceleration = [1000.0, 1000.0, 250.0, 2500.0]    # M201 X/Y/Z/E max acceleration [mm/s^2]
+planner_max_feedrate     = [35000.0, 35000.0, 1200.0, 3600.0] # M203 X/Y/Z/E max feed rate [mm/min]
+planner_max_jerk         = [900.0, 900.0, 60.0, 300.0]        # M566 X/Y/Z/E max instantaneous speed change [mm/min]
+planner_lookahead        = 32                                 # Number of the moves the planner looks ahead
+
 # Temp managment
 temp_idle_delta     = 30
 temp_heating_rate   = 0.6  # Heating rate estimate (in C/s)
 temp_cooling_rate   = 0.8  # Cooling rate estimate (in C/s)
 
 wipe_distance    = 0.0       # distance of wipe in mm
+arc_segment_length = 1.0     # Length of the segments the arcs (G2/G3) are followed by in the wipe path [mm]
+
+# Parser settings
+parse_chunk_size = 1 << 20   # Size of the buffered read chunks when tokenizing the file (in characters)
+parse_mmap       = False     # Memory map the file - tokens keep only line offsets and decode on access
+write_batch_size = 1 << 20   # Size of the batched writes of unmodified lines (in characters)
+parse_workers    = 0         # Number of processes for the parallel parse (0 or 1 - parse in the main process)
+parse_chunks_per_worker = 4  # Number of chunks the file is split into per worker process
+token_cache_enabled = False  # Cache the parsed tokens on disk (keyed by the file contents)
+token_cache_dir  = os.path.join(os.path.expanduser('~'), '.cache', 'tcpspp')    # Token cache directory
+token_cache_max_size = 512 << 20    # Token cache size cap (in bytes) - least recently used entries are evicted
+output_compression_level = 6 # Compression level of the .gz/.bz2/.xz output (0-9)
+metadata_tail_max_size = 1 << 20  # Max size of the trailing metadata block read from the end of the file
+analysis_checkpoint_interval = 0   # Keep the state only every N tokens (e.g. 256) and at the layer changes, the other states are rebuilt on access (0 - keep all the states)
+analysis_checkpoint_cache_size = 16 # Number of the rebuilt checkpoint segments kept (least recently used are dropped)
+analysis_incremental_limit = 0.1    # Analyze the modified tokens only while they are less than this part of the list (more - full analysis)
 
 #==============================================================================
 # Defaults - override while reading settings
@@ -150,8 +179,20 @@ def bed_temperature(layer_num, tools_used):
         bed_temps = [bed_temp_layern[tool] for tool in tools_used]
     return max(bed_temps)
 
+# Get the slic3r setting
+# - from the environment when run by PrusaSlicer (SLIC3R_<NAME>)
+# - otherwise from the config embedded in the GCode file (if given)
+def slic3r_setting(name, config = None):
+    env_name = 'SLIC3R_' + name.upper()
+    if env_name in os.environ:
+        return os.environ[env_name]
+    if config is not None and name in config:
+        return config[name]
+    return None
+
 # Load slic3r settings
-def slic3r_config_read():
+# - config - settings embedded in the GCode file, used when not run by PrusaSlicer
+def slic3r_config_read(config = None):
     global tool_temperature_layer0
     global tool_temperature_layerN
     global tool_pcfan_disable_first_layers
@@ -174,46 +215,48 @@ def slic3r_config_read():
     global bed_temp_layer0
     global bed_temp_layern
 
-    if 'SLIC3R_FIRST_LAYER_TEMPERATURE' in os.environ:
-        tool_temperature_layer0                  = [int(t) for t in os.environ['SLIC3R_FIRST_LAYER_TEMPERATURE'].split(',')]
-        tool_temperature_layerN                  = [int(t) for t in os.environ['SLIC3R_TEMPERATURE'].split(',')]
-        tool_pcfan_disable_first_layers          = [int(l) for l in os.environ['SLIC3R_DISABLE_FAN_FIRST_LAYERS'].split(',')]
-        tool_pcfan_speed                         = [float(s) / 100.0 for s in os.environ['SLIC3R_MAX_FAN_SPEED'].split(',')]
-        tool_nozzle_diameter                     = [float(d) for d in os.environ['SLIC3R_NOZZLE_DIAMETER'].split(',')]
-        tool_extrusion_multiplier                = [float(m) for m in os.environ['SLIC3R_EXTRUSION_MULTIPLIER'].split(',')]
-        tool_filament_diameter                   = [float(d) for d in os.environ['SLIC3R_FILAMENT_DIAMETER'].split(',')]
-        tool_min_layer_height                    = [float(h) for h in os.environ['SLIC3R_MIN_LAYER_HEIGHT'].split(',')]
-        tool_max_layer_height                    = [float(h) for h in os.environ['SLIC3R_MAX_LAYER_HEIGHT'].split(',')]
+    if slic3r_setting('first_layer_temperature', config) is not None:
+        tool_temperature_layer0                  = [int(t) for t in slic3r_setting('first_layer_temperature', config).split(',')]
+        tool_temperature_layerN                  = [int(t) for t in slic3r_setting('temperature', config).split(',')]
+        tool_pcfan_disable_first_layers          = [int(l) for l in slic3r_setting('disable_fan_first_layers', config).split(',')]
+        tool_pcfan_speed                         = [float(s) / 100.0 for s in slic3r_setting('max_fan_speed', config).split(',')]
+        tool_nozzle_diameter                     = [float(d) for d in slic3r_setting('nozzle_diameter', config).split(',')]
+        tool_extrusion_multiplier                = [float(m) for m in slic3r_setting('extrusion_multiplier', config).split(',')]
+        tool_filament_diameter                   = [float(d) for d in slic3r_setting('filament_diameter', config).split(',')]
+        tool_min_layer_height                    = [float(h) for h in slic3r_setting('min_layer_height', config).split(',')]
+        tool_max_layer_height                    = [float(h) for h in slic3r_setting('max_layer_height', config).split(',')]
 
-        filament_type                            = [filament for filament in os.environ['SLIC3R_FILAMENT_TYPE'].split(';')]
+        filament_type                            = [filament for filament in slic3r_setting('filament_type', config).split(';')]
 
         # Retraction settings
-        retraction_firmware                      = True if int(os.environ['SLIC3R_USE_FIRMWARE_RETRACTION']) == 1 else False
-        retraction_length                        = [float(l) for l in os.environ['SLIC3R_RETRACT_LENGTH'].split(',')]
-        retraction_speed                         = [float(s) * 60.0 for s in os.environ['SLIC3R_RETRACT_SPEED'].split(',')]
-        retraction_zhop                          = [float(h) for h in os.environ['SLIC3R_RETRACT_LIFT'].split(',')]
+        retraction_firmware                      = True if int(slic3r_setting('use_firmware_retraction', config)) == 1 else False
+        retraction_length                        = [float(l) for l in slic3r_setting('retract_length', config).split(',')]
+        retraction_speed                         = [float(s) * 60.0 for s in slic3r_setting('retract_speed', config).split(',')]
+        retraction_zhop                          = [float(h) for h in slic3r_setting('retract_lift', config).split(',')]
 
         # Settings
-        relative_E_distances                     = True if int(os.environ['SLIC3R_USE_RELATIVE_E_DISTANCES']) == 1 else False
+        relative_E_distances                     = True if int(slic3r_setting('use_relative_e_distances', config)) == 1 else False
 
         # Bed temperature
-        bed_temp_layer0                          = [int(t) for t in os.environ['SLIC3R_FIRST_LAYER_BED_TEMPERATURE'].split(',')]
-        bed_temp_layern                          = [int(t) for t in os.environ['SLIC3R_BED_TEMPERATURE'].split(',')]
+        bed_temp_layer0                          = [int(t) for t in slic3r_setting('first_layer_bed_temperature', config).split(',')]
+        bed_temp_layern                          = [int(t) for t in slic3r_setting('bed_temperature', config).split(',')]
          
     else:
-        logger.warn("Script run outside of PrusaSlicer, using defaults...")
+        logger.warn("Script run outside of PrusaSlicer and no config in the file, using defaults...")
 
 
 # Validate slic3r settings
-def slic3r_config_validate():
+def slic3r_config_validate(config = None):
     if retraction_firmware == False and relative_E_distances == False:
         raise ConfException("Firmware retraction and relative E distances disabled, if using slicer retraction settings, enable relative E distances")
 
     # Check tool change retractions
-    if 'SLIC3R_RETRACT_LENGTH_TOOLCHANGE' in os.environ and max([int(retraction) for retraction in os.environ['SLIC3R_RETRACT_LENGTH_TOOLCHANGE'].split(',')]) > 0:
+    retract_length_toolchange = slic3r_setting('retract_length_toolchange', config)
+    if retract_length_toolchange is not None and max([float(retraction) for retraction in retract_length_toolchange.split(',')]) > 0:
             raise ConfException("Slicer has non 0 'Retraction when tool disabled - Length' setting, set it to 0 for all extruders.")
 
-    if 'SLIC3R_WIPE_TOWER' in os.environ and int(os.environ['SLIC3R_WIPE_TOWER']) != 0:
+    wipe_tower = slic3r_setting('wipe_tower', config)
+    if wipe_tower is not None and int(wipe_tower) != 0:
         raise ConfException("Slicer wipe tower enabled, please disable")
 
 
@@ -1,12 +1,66 @@
 # Iterable double linked list 
 # Insert operations are O(1)
+# Nodes carry order labels (node.order, increasing along the list) so the positions of any two
+# nodes compare in O(1) - labels are taken from the gaps in [0, ORDER_SPACE) and a range is
+# relabeled when the gap runs out (order maintenance, amortized O(log n) relabeling)
+# Splicing a whole list relinks in O(1) and clearing is O(1):
+# - the nodes point to the owner cell of the list they were inserted into, the cell of the spliced
+#   list is linked under the cell of the receiving list (union-find with the path compression)
+# - the spliced (or moved) chain is labeled later - on the next use of the labels (validate_order)
+#   the pending chains are labeled at once from the gaps between their neighbours (O(k) per chain,
+#   the adjacent chains spliced into each other are labeled as one)
+# - the listeners are notified once per chain (range_inserted), the removed nodes one by one
+
+# Order label space and the label step of the appends at the tail
+ORDER_SPACE = 1 << 62
+ORDER_START = 1 << 60
+ORDER_STEP = 1 << 20
+# Density limit of the relabeled ranges - a range of 2^i labels can hold (2/T)^i nodes
+ORDER_DENSITY = 1.3
+
+# Owner cell of the nodes
+# - dll is set on the cell of the list (root), the cells of the lists spliced into it point to it
+class OwnerCell:
+    __slots__ = ('parent', 'dll')
+
+    def __init__(self, dll):
+        self.parent = None
+        self.dll = dll
+
+    # Root cell (compresses the path)
+    def find(self):
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        cell = self
+        while cell.parent is not None and cell.parent is not root:
+            cell.parent, cell = root, cell.parent
+        return root
 
 # Double linked list Node (as inheritable)
 class Node:
+    __slots__ = ('cell', 'prev', 'next', 'order')
+
     def __init__(self, prev = None, next = None):
-        self.dll = None
+        self.cell = None
         self.prev = prev
         self.next = next
+        self.order = None
+
+    # List the node is in (None if not in any)
+    @property
+    def dll(self):
+        cell = self.cell
+        if cell is None:
+            return None
+        if cell.parent is not None:
+            cell = cell.find()
+            self.cell = cell
+        return cell.dll
+
+    # Node is before the other node in the list
+    def precedes(self, other):
+        return self.dll.precedes(self, other)
 
     # Node append item left
     def append_node_left(self, node):
@@ -16,13 +70,19 @@ class Node:
     def append_node(self, node):
         self.dll.append_node_at(self,node)
 
-    # Append nodes list on the left
+    # Append nodes list on the left (DLList is spliced in)
     def append_nodes_left(self, iterable):
+        if isinstance(iterable, DLList):
+            self.dll.splice_before(self, iterable)
+            return
         for node in iterable:
             self.dll.append_node_left_of(self, node)
 
-    # Append nodes list on the right
+    # Append nodes list on the right (DLList is spliced in)
     def append_nodes_right(self, iterable):
+        if isinstance(iterable, DLList):
+            self.dll.splice_after(self, iterable)
+            return
         for node in reversed(iterable):
             self.dll.append_node_at(self, node)
 
@@ -62,6 +122,16 @@ class DLList:
         self.head = None
         self.tail = None
         self.len = 0
+        # Incremented on every modification
+        self.version = 0
+        # Notified on every modification - node_inserted(node), range_inserted(first, last, count),
+        # node_removed(node, next_node), node_changed(node)
+        self.listeners = []
+        # Chains not labeled yet - first: last (in the splice order) and last: first
+        self.unordered = {}
+        self.unordered_last = {}
+        # Owner cell of the nodes
+        self.cell = OwnerCell(self)
         if iterable is not None:
             self.join_nodes(iterable)
 
@@ -78,40 +148,55 @@ class DLList:
 
     # Most generic append
     def append_node_at(self, node_at, node):
-        if node_at.dll != self:
+        if node_at.cell is not self.cell and node_at.dll is not self:
             raise ValueError("attempting to append at node that is not part of the dllist")
-        if node.dll is not None:
-            node.dll.remove_node(node)
+        if node.cell is not None:
+            self.release_node(node)
+        if len(self.unordered) > 0:
+            self.validate_order()
         if node_at.next is not None:
             node_at.next.prev = node
         else:
             self.tail = node
         node.prev = node_at
         node.next = node_at.next
-        node.dll = self
+        node.cell = self.cell
         node_at.next = node
+        self.order_node(node)
         self.len += 1
+        self.version += 1
+        for listener in self.listeners:
+            listener.node_inserted(node)
         return node
 
     def append_node_left_of(self, node_at, node):
-        if node_at.dll != self:
+        if node_at.cell is not self.cell and node_at.dll is not self:
             raise ValueError("attempting to append at node that is not part of the dllist")
-        if node.dll is not None:
-            node.dll.remove_node(node)
+        if node.cell is not None:
+            self.release_node(node)
+        if len(self.unordered) > 0:
+            self.validate_order()
         if node_at.prev is not None:
             node_at.prev.next = node
         else:
             self.head = node
         node.prev = node_at.prev
         node.next = node_at
-        node.dll = self
+        node.cell = self.cell
         node_at.prev = node
+        self.order_node(node)
         self.len += 1
+        self.version += 1
+        for listener in self.listeners:
+            listener.node_inserted(node)
         return node
 
     def remove_node(self, node):
-        if node.dll != self:
+        if node.cell is not self.cell and node.dll is not self:
             raise ValueError("attempting to remove node not in list")
+        if len(self.unordered) > 0:
+            self.validate_order()
+        next_node = node.next
         if node.prev is not None:
             node.prev.next = node.next
         else:
@@ -120,60 +205,343 @@ class DLList:
             node.next.prev = node.prev
         else:
             self.tail = node.prev
-        node.dll = None
+        node.cell = None
         node.prev = None
         node.next = None
         self.len -= 1
+        self.version += 1
+        # The listeners can still locate the node by its label
+        for listener in self.listeners:
+            listener.node_removed(node, next_node)
+        node.order = None
+
+    # Remove the node from the list it is in (if any) - resolves the list once
+    @staticmethod
+    def release_node(node):
+        dll = node.dll
+        if dll is not None:
+            dll.remove_node(node)
+
+    # Order labels
+    # Label the node linked in between its neighbours (the labels of the list are valid)
+    def order_node(self, node):
+        lower = node.prev.order if node.prev is not None else -1
+        if node.next is None and lower + ORDER_STEP < ORDER_SPACE:
+            node.order = lower + ORDER_STEP
+            return
+        upper = node.next.order if node.next is not None else ORDER_SPACE
+        if upper - lower > 1:
+            node.order = (lower + upper) // 2
+        else:
+            # Takes the label of a neighbour - relabeled with it
+            node.order = lower if lower >= 0 else upper
+            self.reorder(node)
+
+    # Spread the labels of the smallest enclosing aligned range that is not too dense
+    def reorder(self, node):
+        first = last = node
+        count = 1
+        width = 1
+        level = 0
+        while True:
+            width <<= 1
+            level += 1
+            if width > ORDER_SPACE:
+                raise OverflowError("order label space of the dllist exhausted")
+            lo = node.order & ~(width - 1)
+            hi = lo + width
+            while first.prev is not None and first.prev.order >= lo:
+                first = first.prev
+                count += 1
+            while last.next is not None and last.next.order < hi:
+                last = last.next
+                count += 1
+            if count < (2.0 / ORDER_DENSITY) ** level:
+                break
+
+        step = width // count
+        label = lo + step // 2
+        curr = first
+        while True:
+            curr.order = label
+            label += step
+            if curr is last:
+                break
+            curr = curr.next
+
+    # Label the chain first..last (count nodes) linked in between its neighbours
+    # - spread over the gap, the range is relabeled when the gap is too small
+    def order_range(self, first, last, count):
+        if first.prev is None and last.next is None:
+            lower = ORDER_START - ORDER_STEP
+        else:
+            lower = first.prev.order if first.prev is not None else -1
+        upper = last.next.order if last.next is not None else ORDER_SPACE
+        if last.next is None and lower + count * ORDER_STEP < ORDER_SPACE:
+            step = ORDER_STEP
+        else:
+            step = (upper - lower) // (count + 1)
+
+        if step > 0:
+            label = lower + step
+        else:
+            # Takes the label of a neighbour - relabeled with it
+            label = lower if lower >= 0 else upper
+        node = first
+        while True:
+            node.order = label
+            label += step
+            if node is last:
+                break
+            node = node.next
+        if step == 0:
+            self.reorder(first)
+
+    # Label the chain first..last later (spliced or moved, its labels are not valid until then)
+    def defer_order(self, first, last):
+        self.unordered[first] = last
+        self.unordered_last[last] = first
+
+    # Label the pending chains - the labels are valid afterwards
+    # - first the nodes of each chain take the label of its left neighbour (the labels do not decrease),
+    #   the chains spliced later right before it are joined to it (their left neighbour is not labeled yet)
+    # - then each chain is labeled from the gap between its neighbours (or relabeled with the range around it)
+    def validate_order(self):
+        unordered = self.unordered
+        if len(unordered) == 0:
+            return
+        unordered_last = self.unordered_last
+        chains = []
+        for first, last in list(unordered.items()):
+            if unordered.get(first) is not last:
+                continue
+            del unordered[first]
+            del unordered_last[last]
+            while first.prev is not None and first.prev in unordered_last:
+                first = unordered_last.pop(first.prev)
+                del unordered[first]
+
+            label = first.prev.order if first.prev is not None else 0
+            count = 1
+            node = first
+            node.order = label
+            while node is not last:
+                node = node.next
+                node.order = label
+                count += 1
+            chains.append((first, last, count))
+
+        for first, last, count in chains:
+            self.order_range(first, last, count)
+
+    # Node a is before node b (both in the list)
+    def precedes(self, a, b):
+        if len(self.unordered) > 0:
+            self.validate_order()
+        return a.order < b.order
+
+    # Compare the positions of the nodes (-1, 0, 1)
+    def compare(self, a, b):
+        if len(self.unordered) > 0:
+            self.validate_order()
+        return (a.order > b.order) - (a.order < b.order)
+
+    # Node is within [first, last] (inclusive)
+    def in_range(self, node, first, last):
+        if len(self.unordered) > 0:
+            self.validate_order()
+        return first.order <= node.order <= last.order
+
+    # Node modified in place
+    def node_changed(self, node):
+        self.version += 1
+        for listener in self.listeners:
+            listener.node_changed(node)
 
     # Compount append functions
     def append_node(self, node):
-        if node.dll:
-            node.dll.remove_node(node)
+        if node.cell is not None:
+            self.release_node(node)
         if self.tail is None:
             self.tail = node
             self.head = node
             node.next = None
             node.prev = None
-            node.dll = self
+            node.cell = self.cell
+            node.order = ORDER_START
             self.len = 1
+            self.version += 1
+            for listener in self.listeners:
+                listener.node_inserted(node)
         else:
             self.append_node_at(self.tail, node)
         return node
 
     def append_node_left(self, node):
-        if node.dll:
-            node.dll.remove_node(node)
+        if node.cell is not None:
+            self.release_node(node)
         if self.head is None:
             self.head = node
             self.tail = node
             node.next = None
             node.prev = None
-            node.dll = self
+            node.cell = self.cell
+            node.order = ORDER_START
             self.len = 1
+            self.version += 1
+            for listener in self.listeners:
+                listener.node_inserted(node)
         else:
             self.append_node_left_of(self.head, node)
         return node
 
-    # Generic    
+    # Generic (DLList is spliced in)
     def append_nodes(self, iterable):
+        if isinstance(iterable, DLList):
+            self.append_nodes_dllist(iterable)
+            return
         for node in iterable:
             self.append_node(node)
 
     # Optimized for dlllist
     def append_nodes_dllist(self, dllist):
-        # Replace heads and tails
-        dllist.head.prev = self.tail
-        self.tail.next = dllist.head
-        self.tail = dllist.tail
-        for node in dllist:
-            node.dll = self
+        self.splice(dllist, self.tail, None)
+
+    # Splice all the nodes of the dllist after/before the node (the dllist is left empty)
+    def splice_after(self, node_at, dllist):
+        if node_at.dll is not self:
+            raise ValueError("attempting to splice at node that is not part of the dllist")
+        self.splice(dllist, node_at, node_at.next)
+
+    def splice_before(self, node_at, dllist):
+        if node_at.dll is not self:
+            raise ValueError("attempting to splice at node that is not part of the dllist")
+        self.splice(dllist, node_at.prev, node_at)
+
+    # Splice the nodes of the dllist in between the neighbours - relinked in O(1), labeled later (validate_order)
+    def splice(self, dllist, prev_node, next_node):
+        if dllist is self:
+            raise ValueError("attempting to splice the dllist into itself")
+        if dllist.head is None:
+            return
+        first, last = dllist.head, dllist.tail
+        count = dllist.len
+
+        # Nodes leave the dllist
+        if len(dllist.listeners) > 0:
+            dllist.validate_order()
+        for listener in dllist.listeners:
+            for node in dllist:
+                listener.node_removed(node, None)
+
+        # Ownership moves with the cell - the dllist starts with a new one
+        dllist.cell.parent = self.cell
+        dllist.cell.dll = None
+        dllist.cell = OwnerCell(dllist)
         dllist.head = None
         dllist.tail = None
+        dllist.len = 0
+        dllist.version += 1
+        dllist.unordered = {}
+        dllist.unordered_last = {}
+
+        self.link_range(first, last, prev_node, next_node)
+        self.defer_order(first, last)
+        self.len += count
+        self.version += 1
+        for listener in self.listeners:
+            listener.range_inserted(first, last, count)
+
+    # Link the chain first..last in between the neighbours
+    def link_range(self, first, last, prev_node, next_node):
+        first.prev = prev_node
+        last.next = next_node
+        if prev_node is not None:
+            prev_node.next = first
+        else:
+            self.head = first
+        if next_node is not None:
+            next_node.prev = last
+        else:
+            self.tail = last
 
-    # Clear
+    # Unlink the chain first..last (from this list)
+    def unlink_range(self, first, last):
+        if first.prev is not None:
+            first.prev.next = last.next
+        else:
+            self.head = last.next
+        if last.next is not None:
+            last.next.prev = first.prev
+        else:
+            self.tail = first.prev
+        first.prev = None
+        last.next = None
+
+    # Notify the listeners about the chain first..last before it is unlinked
+    def notify_removed(self, first, last):
+        for node in DLListIterator(first):
+            for listener in self.listeners:
+                listener.node_removed(node, last.next)
+            if node is last:
+                break
+
+    # Move the nodes first..last (in this list, node_at not in the range) after the node - relinked in O(1), labeled later
+    def move_after(self, node_at, first, last):
+        if node_at.dll is not self or first.dll is not self or last.dll is not self:
+            raise ValueError("attempting to move nodes that are not part of the dllist")
+        if node_at is last or node_at.next is first:
+            return
+        self.validate_order()
+        if len(self.listeners) > 0:
+            self.notify_removed(first, last)
+        self.unlink_range(first, last)
+        self.link_range(first, last, node_at, node_at.next)
+        self.defer_order(first, last)
+        self.version += 1
+        if len(self.listeners) > 0:
+            count = 1
+            node = first
+            while node is not last:
+                node = node.next
+                count += 1
+            for listener in self.listeners:
+                listener.range_inserted(first, last, count)
+
+    # Cut the nodes first..last (inclusive) into a new list
+    # The nodes are relinked in O(1), counted and re-owned in O(k)
+    def cut(self, first, last):
+        if first.dll is not self or last.dll is not self:
+            raise ValueError("attempting to cut nodes that are not part of the dllist")
+        self.validate_order()
+        if len(self.listeners) > 0:
+            self.notify_removed(first, last)
+        self.unlink_range(first, last)
+        dllist = DLList()
+        dllist.head = first
+        dllist.tail = last
+        for node in dllist:
+            node.cell = dllist.cell
+            dllist.len += 1
+        # The nodes keep their labels (still increasing)
+        self.len -= dllist.len
+        self.version += 1
+        return dllist
+
+    # Clear - O(1) (the nodes are released with the owner cell)
     def clear(self):
-        while self.head is not None:
-            self.remove_node(self.head)    
+        if len(self.listeners) > 0:
+            while self.head is not None:
+                self.remove_node(self.head)
+            return
+        self.cell.dll = None
+        self.cell = OwnerCell(self)
+        self.head = None
+        self.tail = None
+        self.len = 0
+        self.version += 1
+        self.unordered = {}
+        self.unordered_last = {}
 
 # To test
 if __name__ == "__main__":
@@ -224,4 +592,128 @@ if __name__ == "__main__":
     print("after delete of n == 3")
     for n in dll1:
         print('n : {val}'.format(val = n.value))
-    
\ No newline at end of file
+    
+    print("- order labels (random inserts/removes against a list model)")
+    import random
+    rnd = random.Random(1)
+    dll2 = DLList()
+    model = []
+    for step in range(20000):
+        action = rnd.random()
+        if len(model) == 0 or action < 0.4:
+            # Insert next to a random node (dense inserts at one spot exhaust the gaps)
+            node = ValueNode(step)
+            if len(model) == 0:
+                dll2.append_node(node)
+                model.append(node)
+            else:
+                indx = rnd.randrange(len(model)) if rnd.random() < 0.5 else len(model) // 2
+                if rnd.random() < 0.5:
+                    model[indx].append_node(node)
+                    model.insert(indx + 1, node)
+                else:
+                    model[indx].append_node_left(node)
+                    model.insert(indx, node)
+        elif action < 0.6:
+            dll2.remove_node(model.pop(rnd.randrange(len(model))))
+        else:
+            a = rnd.randrange(len(model))
+            b = rnd.randrange(len(model))
+            c = rnd.randrange(len(model))
+            assert dll2.precedes(model[a], model[b]) == (a < b)
+            assert dll2.compare(model[a], model[b]) == (a > b) - (a < b)
+            assert dll2.in_range(model[c], model[min(a, b)], model[max(a, b)]) == (min(a, b) <= c <= max(a, b))
+    assert list(dll2) == model
+    assert all(model[i].order < model[i + 1].order for i in range(len(model) - 1))
+    print('ok : {count} nodes'.format(count = len(model)))
+
+    print("- splice/move/cut/clear (random edits against a list model)")
+    # The nodes are checked by the labels, the owner cells and the links after each edit
+    def check(dll, model):
+        dll.validate_order()
+        assert list(dll) == model
+        assert list(reversed(dll)) == model[::-1]
+        assert len(dll) == len(model)
+        assert all(node.dll is dll for node in model)
+        assert all(model[i].order < model[i + 1].order for i in range(len(model) - 1))
+
+    rnd = random.Random(2)
+    dll3 = DLList()
+    model = []
+    for step in range(5000):
+        action = rnd.random()
+        if len(model) < 2 or action < 0.3:
+            # Splice a new list (or a cut of the list) at a random gap (the middle one often)
+            donor = DLList()
+            for i in range(rnd.randint(1, 50)):
+                donor.append_node(ValueNode((step, i)))
+            nodes = list(donor)
+            gap = rnd.randint(0, len(model)) if rnd.random() < 0.5 else len(model) // 2
+            dll3.splice(donor, model[gap - 1] if gap > 0 else None, model[gap] if gap < len(model) else None)
+            model[gap:gap] = nodes
+            assert len(donor) == 0 and donor.head is None
+        elif action < 0.6:
+            # Move a range after a node out of it
+            a = rnd.randrange(len(model))
+            b = rnd.randrange(a, min(len(model), a + 20))
+            rest = model[:a] + model[b + 1:]
+            if len(rest) == 0:
+                continue
+            at = rnd.randrange(len(rest))
+            dll3.move_after(rest[at], model[a], model[b])
+            model = rest[:at + 1] + model[a:b + 1] + rest[at + 1:]
+        elif action < 0.9:
+            # Cut a range and splice it back somewhere
+            a = rnd.randrange(len(model))
+            b = rnd.randrange(a, min(len(model), a + 20))
+            cut = dll3.cut(model[a], model[b])
+            check(cut, model[a:b + 1])
+            nodes = model[a:b + 1]
+            del model[a:b + 1]
+            if len(model) > 0 and rnd.random() < 0.8:
+                gap = rnd.randint(0, len(model))
+                if gap < len(model):
+                    dll3.splice_before(model[gap], cut)
+                else:
+                    dll3.splice_after(model[-1], cut)
+                model[gap:gap] = nodes
+        elif action < 0.95:
+            dll3.clear()
+            assert all(node.dll is None for node in model)
+            model = []
+        check(dll3, model)
+    print('ok : {count} nodes'.format(count = len(model)))
+
+    print("- pending labels (splices into the spliced chains before the labels are used)")
+    rnd = random.Random(3)
+    dll4 = DLList()
+    model = []
+    for step in range(3000):
+        for i in range(rnd.randint(1, 8)):
+            donor = DLList()
+            for j in range(rnd.randint(1, 10)):
+                donor.append_node(ValueNode((step, i, j)))
+            nodes = list(donor)
+            gap = rnd.choice([0, len(model), len(model) // 2, rnd.randint(0, len(model))])
+            dll4.splice(donor, model[gap - 1] if gap > 0 else None, model[gap] if gap < len(model) else None)
+            model[gap:gap] = nodes
+        action = rnd.random()
+        if action < 0.3 and len(model) > 0:
+            a = rnd.randrange(len(model))
+            b = rnd.randrange(len(model))
+            assert dll4.precedes(model[a], model[b]) == (a < b)
+        elif action < 0.5:
+            dll4.remove_node(model.pop(rnd.randrange(len(model))))
+        elif action < 0.6:
+            node = ValueNode(step)
+            indx = rnd.randrange(len(model))
+            model[indx].append_node(node)
+            model.insert(indx + 1, node)
+        elif action < 0.62:
+            dll4.clear()
+            model = []
+            continue
+        if rnd.random() < 0.5:
+            check(dll4, model)
+    check(dll4, model)
+    print('ok : {count} nodes'.format(count = len(model)))
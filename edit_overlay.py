@@ -0,0 +1,138 @@
+import doublelinkedlist
+
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Edits of the token list made by the passes (prime tower, temp managment, PCF...)
+# - insert_before/insert_after(anchor, tokens): tokens - the token, list of tokens or DLList
+# - remove(token)
+# Same semantics as the in place edits: the later insert at the anchor ends up closer to it
+# The anchor not in the list (or None) raises ValueError - same as DLList
+
+# Edits of the pass - the edits given (EditOverlay records them), applied in place if None
+def edits_or_in_place(edits):
+    return edits if edits is not None else InPlaceEdits()
+
+# Edits applied to the token list directly
+class InPlaceEdits:
+    def check_anchor(self, anchor):
+        if anchor is None or anchor.dll is None:
+            raise ValueError("attempting to edit at node that is not part of the dllist")
+
+    def insert_before(self, anchor, tokens):
+        self.check_anchor(anchor)
+        if isinstance(tokens, doublelinkedlist.Node):
+            anchor.append_node_left(tokens)
+        else:
+            anchor.append_nodes_left(tokens)
+
+    def insert_after(self, anchor, tokens):
+        self.check_anchor(anchor)
+        if isinstance(tokens, doublelinkedlist.Node):
+            anchor.append_node(tokens)
+        else:
+            anchor.append_nodes_right(tokens)
+
+    def remove(self, token):
+        self.check_anchor(token)
+        token.dll.remove_node(token)
+
+# Edits recorded as the overlay of the token list - the list is not modified
+# - iterating the overlay gives the merged view (the list with the edits)
+# - the writer streams the merged view (write_tokens), apply() splices the edits into the list
+# The anchor can be a token of the list or a token inserted by an earlier edit
+class EditOverlay:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.edits = []         # (anchor, after, tokens) in the order recorded (tokens None - remove)
+        self.before = {}        # anchor -> inserted before (DLList, in the order recorded)
+        self.after = {}         # anchor -> inserted after
+        self.removed = set()
+        self.inserted = 0
+        self.token_lists = set()    # lists of the inserted tokens (anchors of the later edits)
+
+    # The anchor has to be in the list or inserted by an earlier edit
+    def check_anchor(self, anchor):
+        if anchor is None or (anchor.dll is not self.tokens and anchor.dll not in self.token_lists):
+            raise ValueError("attempting to edit at node that is not part of the dllist or the edits")
+
+    # Inserted tokens as the DLList
+    @staticmethod
+    def token_list(tokens):
+        if isinstance(tokens, doublelinkedlist.DLList):
+            return tokens
+        token_list = doublelinkedlist.DLList()
+        if isinstance(tokens, doublelinkedlist.Node):
+            token_list.append_node(tokens)
+        else:
+            for token in tokens:
+                token_list.append_node(token)
+        return token_list
+
+    def insert_before(self, anchor, tokens):
+        self.check_anchor(anchor)
+        token_list = EditOverlay.token_list(tokens)
+        self.token_lists.add(token_list)
+        self.edits.append((anchor, False, token_list))
+        self.before.setdefault(anchor, []).append(token_list)
+        self.inserted += len(token_list)
+
+    def insert_after(self, anchor, tokens):
+        self.check_anchor(anchor)
+        token_list = EditOverlay.token_list(tokens)
+        self.token_lists.add(token_list)
+        self.edits.append((anchor, True, token_list))
+        self.after.setdefault(anchor, []).append(token_list)
+        self.inserted += len(token_list)
+
+    def remove(self, token):
+        self.check_anchor(token)
+        self.edits.append((token, None, None))
+        self.removed.add(token)
+
+    def __len__(self):
+        return len(self.edits)
+
+    # Merged view
+    def __iter__(self):
+        before = self.before
+        after = self.after
+        removed = self.removed
+        for token in self.tokens:
+            if token in before or token in after or token in removed:
+                yield from self.expand(token)
+            else:
+                yield token
+
+    # The token with the edits at it (the inserted tokens with their edits)
+    def expand(self, token):
+        for token_list in self.before.get(token, ()):
+            for inserted in token_list:
+                yield from self.expand(inserted)
+        if token not in self.removed:
+            yield token
+        for token_list in reversed(self.after.get(token, ())):
+            for inserted in token_list:
+                yield from self.expand(inserted)
+
+    # Splice the edits into the token list (in the order recorded) and clear the overlay
+    def apply(self):
+        t_start = time.time()
+        for anchor, after, token_list in self.edits:
+            if token_list is None:
+                anchor.dll.remove_node(anchor)
+            elif after:
+                anchor.dll.splice_after(anchor, token_list)
+            else:
+                anchor.dll.splice_before(anchor, token_list)
+
+        logger.debug("Applied {edits} edits - {tokens} tokens inserted [elapsed: {elapsed:0.2f}s]".format(
+            edits = len(self.edits), tokens = self.inserted, elapsed = time.time() - t_start))
+        self.edits = []
+        self.before = {}
+        self.after = {}
+        self.removed = set()
+        self.inserted = 0
+        self.token_lists = set()
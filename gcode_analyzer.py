@@ -1,11 +1,17 @@
 
 import doublelinkedlist
 import conf
-import copy, math, time                                           # G11 unretract (Firmware)
+import token_cache
+import bgcode
+import copy, math, time, os, io, sys, mmap, gzip, bz2, lzma, collections, concurrent.futures                                           # G11 unretract (Firmware)
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Version of the parsed token format - bump when the parser output changes
+# (invalidates the token cache entries)
+PARSER_VERSION = 1
+
 # Parse exception
 class GCodeParseException(Exception):
     def __init__(self, message, line = None):
@@ -20,9 +26,34 @@ class GCodeStateException(Exception):
     def __init__(self, message):
         self.message = message
 
+# Opcode ids - assigned on first use (at parse time)
+# Opcode names:
+# - GCode      : the gcode (G1, M104...)
+# - ToolChange : T
+# - Params     : ;;LABEL
+# - Comment    : ;
+opcode_ids = {}
+opcode_names = []
+
+# Get the id of the opcode (registered on first use)
+def opcode_id(name):
+    try:
+        return opcode_ids[name]
+    except KeyError:
+        opcode_ids[name] = len(opcode_names)
+        opcode_names.append(name)
+        return opcode_ids[name]
+
+OPCODE_TOOLCHANGE = opcode_id('T')
+OPCODE_COMMENT    = opcode_id(';')
+OPCODE_LAYER_CHANGE = opcode_id(';;AFTER_LAYER_CHANGE')
+
 # Token 
 # Is a double linked list node (makes it easy to iterate
 class Token(doublelinkedlist.Node):
+    __slots__ = ('type', 'op', 'runtime_estimate', 'runtime', 'saved_state_pre', 'saved_state_post', 'checkpoint', 'analyzed',
+                 'source', 'offset', 'length', 'line', 'dirty')
+
     # Token types  
     GCODE                    = 0 # GCode token
     TOOLCHANGE               = 1 # Tool change token
@@ -33,20 +64,249 @@ class Token(doublelinkedlist.Node):
         doublelinkedlist.Node.__init__(self)
         self.type = type
         self.runtime_estimate = runtime_estimate
-        self.state_pre = None
-        self.state_post = None
-        self.seq = None
+        self.runtime = 0
+        self.saved_state_pre = None
+        self.saved_state_post = None
+        # Checkpoint the states are rebuilt from (if the analysis keeps only the checkpoints)
+        self.checkpoint = None
+        # Set when the token is counted in the totals of the analysis (see AnalysisJournal)
+        self.analyzed = False
+        # Location of the line in the mapped source (set if created from GCodeSource)
+        self.source = None
+        self.offset = None
+        self.length = None
+        # Original line (set if created by the text tokenizer)
+        self.line = None
+        # Set when the token has been modified after parsing
+        self.dirty = False
+
+    # State before/after the token
+    @property
+    def state_pre(self):
+        state = self.saved_state_pre
+        if state is None and self.checkpoint is not None:
+            state = self.checkpoint.states(self)[0]
+        return state
+
+    @state_pre.setter
+    def state_pre(self, state):
+        self.saved_state_pre = state
+
+    @property
+    def state_post(self):
+        state = self.saved_state_post
+        if state is None and self.checkpoint is not None:
+            state = self.checkpoint.states(self)[1]
+        return state
+
+    @state_post.setter
+    def state_post(self, state):
+        self.saved_state_post = state
+
+    # Position of the token in the list (order label - compares in O(1), kept valid on the edits)
+    # None if not in the list
+    @property
+    def seq(self):
+        dll = self.dll
+        if dll is None:
+            return None
+        dll.validate_order()
+        return self.order
+
+    # Source line of the token
+    @property
+    def source_line(self):
+        if self.source is None:
+            return None
+        return self.source.line(self.offset, self.length)
+
+    # Token modified after parsing
+    @property
+    def modified(self):
+        return self.dirty
+
+    # Original line of the token - None if the token is generated or modified
+    def verbatim(self):
+        if self.modified:
+            return None
+        if self.line is not None:
+            return self.line
+        return self.source_line
+
+    # Check if the field is set (without decoding it)
+    def has_field(self, name):
+        try:
+            object.__getattribute__(self, name)
+            return True
+        except AttributeError:
+            return False
     
+# GCode params
+# Keeps the raw values (used when serializing) and converts them
+# into numbers once - on first access
+class GCodeParams(dict):
+    __slots__ = ('cached_numbers', 'modified')
+
+    # Get the params converted to numbers (cached)
+    # - params that are not numbers are skipped
+    def numbers(self):
+        try:
+            return self.cached_numbers
+        except AttributeError:
+            pass
+        numbers = {}
+        for key, val in self.items():
+            try:
+                numbers[key] = float(val)
+            except ValueError:
+                pass
+        self.cached_numbers = numbers
+        return numbers
+
+    # Get a single param as number
+    def number(self, key):
+        return self.numbers()[key]
+
+    # Drop the cached numbers and mark as modified
+    def invalidate(self):
+        self.modified = True
+        try:
+            del self.cached_numbers
+        except AttributeError:
+            pass
+
+    # Unpickled with the items and the slots (filling the items would mark the params as modified)
+    def __reduce__(self):
+        state = dict([(name, getattr(self, name)) for name in GCodeParams.__slots__ if hasattr(self, name)])
+        return (GCodeParams, (list(self.items()),), (None, state))
+
+    # Any change drops the cached numbers
+    def __setitem__(self, key, val):
+        self.invalidate()
+        dict.__setitem__(self, key, val)
+
+    def __delitem__(self, key):
+        self.invalidate()
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        self.invalidate()
+        dict.update(self, *args, **kwargs)
+
+    def pop(self, *args):
+        self.invalidate()
+        return dict.pop(self, *args)
+
+# Read-only GCode params shared between the tokens (see make_params)
+# - use GCode.set_param to modify (copies the params first)
+class SharedGCodeParams(GCodeParams):
+    __slots__ = ()
+
+    def invalidate(self):
+        raise GCodeStateException("Shared GCode params are read-only, use GCode.set_param")
+
+    # Unpickled from the flyweight table of the process
+    def __reduce__(self):
+        return (make_params, (params_text(self.items()),))
+
+# Flyweight table of the parsed params - keyed by the params text of the line
+# Param sets without X/Y (G1 F1800, G1 E-0.8 F2100, G10...) repeat thousands of times
+# in the file - the tokens share one read-only instance (and its cached numbers)
+# The params with X/Y rarely repeat - not looked up (one text scan)
+shared_params_table = {}
+shared_params_max = 1 << 16
+
+# Get the params for the params text (X10.5 Y20 E0.3)
+def make_params(text):
+    if 'X' in text or 'Y' in text:
+        return GCodeParams([(p[0], p[1:]) for p in text.split()])
+    params = shared_params_table.get(text)
+    if params is not None:
+        return params
+    if len(shared_params_table) >= shared_params_max:
+        return GCodeParams([(p[0], p[1:]) for p in text.split()])
+    params = SharedGCodeParams([(p[0], p[1:]) for p in text.split()])
+    shared_params_table[text] = params
+    return params
+
+# Params text of the (key, value) pairs
+def params_text(items):
+    return ' '.join([key + str(val) for key, val in items])
+
 # GCode token
+# - when created from the mapped source the fields are decoded on first access
 class GCode(Token):
+    __slots__ = ('gcode', 'param', '_comment')
+
+    # Fields decoded lazily from the mapped source
+    lazy_fields = ('gcode', 'param', '_comment')
+
     def __init__(self, gcode, param = None, comment = ""):
         Token.__init__(self, type = Token.GCODE)
         self.gcode = gcode
+        self.op = opcode_id(gcode)
         self.param = param
         if param is None:
-            self.param = {}
-        self.comment = comment
-        self.runtime = 0
+            self.param = GCodeParams()
+        elif not isinstance(param, GCodeParams):
+            self.param = GCodeParams(param)
+        self._comment = comment
+
+    # Create the token from the line in the mapped source
+    # - gcode/param/comment are left unset until accessed
+    @classmethod
+    def from_source(cls, source, offset, length):
+        token = cls.__new__(cls)
+        Token.__init__(token, type = Token.GCODE)
+        token.source = source
+        token.offset = offset
+        token.length = length
+        return token
+
+    # Only called for the fields that are not set yet
+    def __getattr__(self, name):
+        if name == 'op':
+            self.op = opcode_id(self.gcode)
+            return self.op
+        if name not in GCode.lazy_fields or self.source is None:
+            raise AttributeError(name)
+        if name == 'gcode':
+            self.gcode = self.source.opcode(self.offset, self.length)
+        else:
+            # Decode the rest of the line - keep the fields set in the meantime
+            gcode, param, comment = parse_gcode_line(self.source_line)
+            for field, val in zip(GCode.lazy_fields, (gcode, param, comment)):
+                if not self.has_field(field):
+                    setattr(self, field, val)
+        return object.__getattribute__(self, name)
+
+    @property
+    def comment(self):
+        return self._comment
+
+    @comment.setter
+    def comment(self, val):
+        # Decode first - so the decoding doesn't override the new comment
+        if self.source is not None and not self.has_field('param'):
+            self.param
+        self._comment = val
+        self.dirty = True
+
+    # Params modified in place also make the token dirty
+    @property
+    def modified(self):
+        if self.dirty:
+            return True
+        return self.has_field('param') and getattr(self.param, 'modified', False)
+
+    # Set the param - the shared params are copied first
+    def set_param(self, key, val):
+        # Notify the list first - the analysis still sees the old params
+        if self.dll is not None:
+            self.dll.node_changed(self)
+        if isinstance(self.param, SharedGCodeParams):
+            self.param = GCodeParams(self.param)
+        self.param[key] = val
             
     # Serialize into the str
     def __str__(self):
@@ -57,8 +317,11 @@ class GCode(Token):
    
 # Tool Change token
 class ToolChange(Token):
+    __slots__ = ('prev_tool', 'next_tool')
+
     def __init__(self, prev_tool, next_tool):
         Token.__init__(self, type = Token.TOOLCHANGE)
+        self.op = OPCODE_TOOLCHANGE
         self.prev_tool = prev_tool
         self.next_tool = next_tool
 
@@ -67,10 +330,41 @@ class ToolChange(Token):
             prev_tool = self.prev_tool, next_tool = self.next_tool)
 
 # Comment - just text
+# - when created from the mapped source the text is decoded on first access
 class Comment(Token):
+    __slots__ = ('_text',)
+
     def __init__(self, text):
         Token.__init__(self, type = Token.COMMENT)
-        self.text = text
+        self.op = OPCODE_COMMENT
+        self._text = text
+
+    # Create the token from the line in the mapped source
+    @classmethod
+    def from_source(cls, source, offset, length):
+        token = cls.__new__(cls)
+        Token.__init__(token, type = Token.COMMENT)
+        token.op = OPCODE_COMMENT
+        token.source = source
+        token.offset = offset
+        token.length = length
+        return token
+
+    # Only called when the text is not set yet
+    def __getattr__(self, name):
+        if name != '_text' or self.source is None:
+            raise AttributeError(name)
+        self._text = self.source_line[1:]
+        return self._text
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, val):
+        self._text = val
+        self.dirty = True
 
     # Serialize into str
     def __str__(self):
@@ -78,8 +372,11 @@ class Comment(Token):
 
 # Comment Params
 class Params(Token):
+    __slots__ = ('label', 'param')
+
     def __init__(self, label, param = []):
         Token.__init__(self, type = Token.PARAMS)
+        self.op = opcode_id(';;' + label)
         self.label = label
         self.param = param
 
@@ -99,12 +396,615 @@ valid_params_format = {
     'TOOL_BLOCK_END'        : [int]
     }
 
+# Read the stream in fixed size chunks and yield the lines one at a time
+# - avoids keeping the whole file in memory as a list of lines
+def read_lines(gcode_in, chunk_size = None):
+    if chunk_size is None:
+        chunk_size = conf.parse_chunk_size
+
+    yield from split_lines(iter(lambda: gcode_in.read(chunk_size), ''))
+
+# Split the text chunks into lines
+def split_lines(chunks):
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        # Last line might be incomplete - carry over to the next chunk
+        pending = lines.pop()
+        yield from lines
+
+    if len(pending) > 0:
+        yield pending
+
+# Parse the params line - ;;Label:p1,p2,p3
+def parse_params_line(line):
+    contents = line[2:]
+    # Check if has extra comment - strip
+    comment_pos = contents.find(';')
+    if comment_pos != -1:
+        contents = contents[0:comment_pos].strip()
+    # Check if has params
+    label = None
+    params = []
+
+    params_sep = contents.find(':')
+    if params_sep != -1:
+        label = contents[0:params_sep].strip()
+        params = contents[params_sep+1:].split(',')
+    else:
+        label = contents.strip()
+
+    label = sys.intern(label)
+
+    # Check if the label in params
+    if label not in valid_params_format.keys():
+        raise GCodeParseException("Param {label} not valid".format(label = label), line)
+    if len(params) != len(valid_params_format[label]):
+        raise GCodeParseException("Param {label} has invalid number of arguments".format(label = label), line)
+
+    return Params(
+        label = label,
+        param = [valid_params_format[label][indx](params[indx]) for indx in range(0, len(params))])
+
+# Parse the GCode line into (gcode, params, comment)
+def parse_gcode_line(line):
+    contents = line
+    comment = ""
+    # Check if has extra comment - strip
+    comment_pos = line.find(';')
+    if comment_pos != -1:
+        contents = line[0:comment_pos].strip()
+        comment = line[comment_pos+1:].strip()
+
+    # Split into the opcode (interned) and the params text (see make_params)
+    args = contents.split(None, 1)
+    return sys.intern(args[0]), make_params(args[1] if len(args) > 1 else ''), comment
+
+# Parse the tool id from the tool change line
+def parse_tool_line(line):
+    # Check if has extra comment - strip
+    contents = line
+    comment_pos = line.find(';')
+    if comment_pos != -1:
+        contents = line[0:comment_pos].strip()
+    return int(contents[1:])
+
+# Tokenize the GCode stream
+# Generator - yields the tokens one at a time so they can be consumed lazily
+def tokenize(gcode_in, chunk_size = None, tool_head = -1):
+    yield from tokenize_lines(read_lines(gcode_in, chunk_size), tool_head)
+
+# Tokenize the lines
+def tokenize_lines(lines, tool_head = -1):
+    # Track the tool
+    current_tool_head = tool_head
+
+    for line in lines:
+        line = line.strip()
+
+        if len(line) == 0:
+            continue
+
+        # Check if comment
+        if line[0] == ';':
+            # Check if comment params - starts with ;;
+            if len(line) > 1 and line[1] == ';':
+                token = parse_params_line(line)
+                token.line = line
+                yield token
+                continue
+            # Check if normal comment - single ;
+            if len(line) > 1 and line[1] != ';':
+                token = Comment(text = line[1:])
+                token.line = line
+                yield token
+                continue
+            # Empty comment - skip
+            if len(line) == 1:
+                continue
+
+        # Check if GCODE 
+        if line[0] in ['G', 'M']:
+            gcode, param, comment = parse_gcode_line(line)
+            token = GCode(
+                gcode = gcode,
+                param = param,
+                comment = comment)
+            token.line = line
+            yield token
+            continue
+
+        # Check if Toolchange
+        if line[0] == 'T':
+            previous_tool_head = current_tool_head
+            current_tool_head = parse_tool_line(line)
+
+            token = ToolChange(
+                prev_tool = previous_tool_head,
+                next_tool = current_tool_head)
+            token.line = line
+            yield token
+            continue
+
+# Memory mapped GCode file
+# Tokens created from the source only keep the (offset, length) of their line
+# and decode the fields when they are accessed
+class GCodeSource:
+    def __init__(self, gcode_file):
+        self.file = open(gcode_file, mode='rb')
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self.map = mmap.mmap(-1, 1)
+
+    # Decode the line
+    def line(self, offset, length):
+        return self.map[offset:offset + length].decode('utf8')
+
+    # Decode just the opcode of the GCode line
+    def opcode(self, offset, length):
+        line = self.map[offset:offset + length]
+        end = len(line)
+        for sep in (b' ', b'\t', b';'):
+            pos = line.find(sep)
+            if pos != -1 and pos < end:
+                end = pos
+        return sys.intern(line[0:end].decode('utf8'))
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+# Tokenize the mapped source
+# Only the params and tool changes are decoded upfront (needed to track the tool)
+def tokenize_source(source):
+    # Track the tool
+    current_tool_head = -1
+
+    data = source.map
+    data.seek(0)
+    offset = 0
+    for raw in iter(data.readline, b''):
+        line_offset = offset
+        offset += len(raw)
+
+        line = raw.strip()
+        if len(line) == 0:
+            continue
+        line_offset += len(raw) - len(raw.lstrip())
+
+        # Check if comment
+        if line[0] == ord(';'):
+            if len(line) == 1:
+                continue
+            # Check if comment params - starts with ;;
+            if line[1] == ord(';'):
+                token = parse_params_line(line.decode('utf8'))
+                token.source = source
+                token.offset = line_offset
+                token.length = len(line)
+                yield token
+            else:
+                yield Comment.from_source(source, line_offset, len(line))
+            continue
+
+        # Check if GCODE
+        if line[0] in b'GM':
+            yield GCode.from_source(source, line_offset, len(line))
+            continue
+
+        # Check if Toolchange
+        if line[0] == ord('T'):
+            previous_tool_head = current_tool_head
+            current_tool_head = parse_tool_line(line.decode('utf8'))
+
+            token = ToolChange(
+                prev_tool = previous_tool_head,
+                next_tool = current_tool_head)
+            token.source = source
+            token.offset = line_offset
+            token.length = len(line)
+            yield token
+            continue
+
+# Convert the parsed token into the cache record (tuple of plain values)
+# - the GCode params are stored with the numbers converted already
+def token_record(token):
+    if token.type == Token.GCODE:
+        return (Token.GCODE, token.line, token.gcode, tuple(token.param.items()), token.comment, token.param.numbers())
+    if token.type == Token.TOOLCHANGE:
+        return (Token.TOOLCHANGE, token.line, token.prev_tool, token.next_tool)
+    if token.type == Token.PARAMS:
+        return (Token.PARAMS, token.line, token.label, token.param)
+    return (Token.COMMENT, token.line, token.text)
+
+# Create the token from the cache record
+def token_from_record(record):
+    type = record[0]
+    if type == Token.GCODE:
+        param = make_params(params_text(record[3]))
+        if not hasattr(param, 'cached_numbers'):
+            param.cached_numbers = record[5]
+        token = GCode(gcode = sys.intern(record[2]), param = param, comment = record[4])
+    elif type == Token.TOOLCHANGE:
+        token = ToolChange(prev_tool = record[2], next_tool = record[3])
+    elif type == Token.PARAMS:
+        token = Params(label = sys.intern(record[2]), param = record[3])
+    else:
+        token = Comment(text = record[2])
+    token.line = record[1]
+    return token
+
+# Compressed files - detected by the magic bytes when reading
+# and by the extension when writing
+compression_formats = {
+    '.gz'  : (b'\x1f\x8b', gzip),
+    '.bz2' : (b'BZh', bz2),
+    '.xz'  : (b'\xfd7zXZ\x00', lzma) }
+
+# Get the compression extension of the file (None if not compressed)
+def compression_of(gcode_file):
+    with open(gcode_file, mode='rb') as gcode_in:
+        magic = gcode_in.read(6)
+    for extension, (format_magic, module) in compression_formats.items():
+        if magic.startswith(format_magic):
+            return extension
+    return None
+
+# Open the GCode file for reading - decompressed on the fly
+def open_gcode(gcode_file):
+    extension = compression_of(gcode_file)
+    if extension is None:
+        return open(gcode_file, mode='r', encoding='utf8')
+    return compression_formats[extension][1].open(gcode_file, mode='rt', encoding='utf8')
+
+# Open the GCode file for writing - compressed if the extension is .gz/.bz2/.xz
+def open_gcode_output(gcode_file):
+    extension = os.path.splitext(gcode_file)[1]
+    if extension == '.gz':
+        return gzip.open(gcode_file, mode='wt', encoding='utf8', compresslevel = conf.output_compression_level)
+    if extension == '.bz2':
+        return bz2.open(gcode_file, mode='wt', encoding='utf8', compresslevel = max(1, conf.output_compression_level))
+    if extension == '.xz':
+        return lzma.open(gcode_file, mode='wt', encoding='utf8', preset = conf.output_compression_level)
+    return open(gcode_file, mode='w', encoding='utf8')
+
+# Open the file and tokenize it lazily
+# - compressed files are decompressed chunk by chunk as the tokens are consumed
+def iterparse(gcode_file, chunk_size = None):
+    with open_gcode(gcode_file) as gcode_in:
+        yield from tokenize(gcode_in, chunk_size)
+
+# Write the tokens into the output stream
+# - tokens not modified since parsing are written as their original line
+# - contiguous runs of those are batched into single writes
+#   (for the mapped source the run is written as one slice of the mapping)
+def write_tokens(tokens, gcode_out, batch_size = None):
+    if batch_size is None:
+        batch_size = conf.write_batch_size
+
+    pending = []        # Lines waiting to be written
+    pending_size = 0
+    span = None         # Run of lines in the mapped source [source, start, end]
+    rebuilt = 0
+
+    for token in tokens:
+        # Mapped source - extend the run if the line directly follows the previous one
+        if token.source is not None and not token.modified:
+            if span is not None and span[0] is token.source and span[2] + 1 == token.offset and span[2] - span[1] < batch_size:
+                span[2] = token.offset + token.length
+                continue
+            if span is not None:
+                pending.append(span[0].line(span[1], span[2] - span[1]))
+                pending_size += span[2] - span[1]
+            span = [token.source, token.offset, token.offset + token.length]
+        else:
+            if span is not None:
+                pending.append(span[0].line(span[1], span[2] - span[1]))
+                pending_size += span[2] - span[1]
+                span = None
+
+            if token.line is not None and not token.modified:
+                line = token.line
+            else:
+                line = str(token)
+                rebuilt += 1
+            pending.append(line)
+            pending_size += len(line) + 1
+
+        if pending_size >= batch_size:
+            gcode_out.write('\n'.join(pending) + '\n')
+            pending = []
+            pending_size = 0
+
+    if span is not None:
+        pending.append(span[0].line(span[1], span[2] - span[1]))
+    if len(pending) > 0:
+        gcode_out.write('\n'.join(pending) + '\n')
+
+    logger.debug("Written the GCode - {rebuilt} lines rebuilt".format(rebuilt = rebuilt))
+
+# Apply the configuration values and the runtime factors (opcode name -> factor) in the worker process
+# (the opcode ids are assigned per process)
+def conf_apply(values, runtime_factors):
+    for key, val in values.items():
+        setattr(conf, key, val)
+    GCodeAnalyzer.runtime_factors = dict([(opcode_id(name), factor) for name, factor in runtime_factors.items()])
+
+# Pre-scan the file for the parallel parse
+# Splits the file at ;;AFTER_LAYER_CHANGE into approximately num_chunks chunks and
+# computes the state at the start of each chunk - only the tokens that change
+# the state (tool changes, moves, retractions, layer changes) are decoded and
+# applied in place (no state copies, no runtimes)
+# Returns list of (start, end, state_stack, filament_usage, tool_head)
+def prescan_chunks(gcode_file, num_chunks):
+    chunks = []
+    with open(gcode_file, mode='rb') as gcode_in:
+        size = os.fstat(gcode_in.fileno()).st_size
+        if size == 0:
+            return chunks
+        data = mmap.mmap(gcode_in.fileno(), 0, access = mmap.ACCESS_READ)
+        chunk_size = max(1, size // max(1, num_chunks))
+
+        analyzer = GCodeAnalyzer()
+        state_stack = [GCodeAnalyzer.State()]
+        current_tool_head = -1
+
+        # Current chunk
+        chunk = (0, GCodeAnalyzer.State.copy_stack(state_stack), {}, current_tool_head)
+
+        offset = 0
+        for raw in iter(data.readline, b''):
+            line_offset = offset
+            offset += len(raw)
+
+            line = raw.strip()
+            if len(line) == 0:
+                continue
+
+            first = line[0]
+            if first == ord(';'):
+                if len(line) == 1:
+                    continue
+                if line.startswith(b';;AFTER_LAYER_CHANGE'):
+                    # Start a new chunk at the layer boundary
+                    if line_offset - chunk[0] >= chunk_size:
+                        chunks.append((chunk[0], line_offset) + chunk[1:])
+                        chunk = (line_offset, GCodeAnalyzer.State.copy_stack(state_stack), analyzer.total_filament_usage.copy(), current_tool_head)
+                    analyzer.apply_token(parse_params_line(line.decode('utf8')), state_stack)
+                continue
+
+            if first == ord('T'):
+                previous_tool_head = current_tool_head
+                current_tool_head = parse_tool_line(line.decode('utf8'))
+                analyzer.apply_token(ToolChange(prev_tool = previous_tool_head, next_tool = current_tool_head), state_stack)
+                continue
+
+            if first in b'GM':
+                # Only the codes with a handler are decoded
+                opcode = line.split(b';', 1)[0].split(None, 1)[0]
+                if opcode_id(opcode.decode('utf8')) in GCodeAnalyzer.handlers:
+                    gcode, param, comment = parse_gcode_line(line.decode('utf8'))
+                    analyzer.apply_token(GCode(gcode = gcode, param = param), state_stack)
+                continue
+
+        chunks.append((chunk[0], size) + chunk[1:])
+        data.close()
+
+    return chunks
+
+# Tokenize and analyze the chunk of the file (in the worker process)
+# Returns the tokens (not linked), the filament usage at the end of the chunk
+# and the opcode names of the worker (to map the opcode ids)
+def analyze_chunk(args):
+    gcode_file, start, end, state_stack, filament_usage, tool_head = args
+
+    with open(gcode_file, mode='rb') as gcode_in:
+        gcode_in.seek(start)
+        data = gcode_in.read(end - start)
+
+    tokens = list(tokenize(io.TextIOWrapper(io.BytesIO(data), encoding='utf8'), tool_head = tool_head))
+
+    analyzer = GCodeAnalyzer()
+    analyzer.total_filament_usage = filament_usage
+    analyzer.analyze_tokens(tokens, state_stack)
+
+    return tokens, analyzer.total_filament_usage, opcode_names
+
+# Analysis checkpoint - the state stack before the first token of the segment
+# and the tokens of the segment (in the order they were analyzed)
+class StateCheckpoint:
+    __slots__ = ('store', 'state_stack', 'tokens')
+
+    def __init__(self, store, state_stack):
+        self.store = store
+        self.state_stack = GCodeAnalyzer.State.copy_stack(state_stack)
+        self.tokens = []
+
+    # States of the token - (state_pre, state_post)
+    def states(self, token):
+        return self.store.segment_states(self)[token]
+
+# Rebuilds the states of the checkpoint segments by replaying the tokens
+# - keeps the states of the recently rebuilt segments (LRU)
+# - tokens inserted after the analysis are not replayed (same as the tokens without the states)
+class StateCheckpoints:
+    def __init__(self, cache_size = None):
+        self.cache_size = cache_size if cache_size is not None else conf.analysis_checkpoint_cache_size
+        self.cache = collections.OrderedDict()
+        # Replay analyzer - the totals are already accumulated by the analysis
+        self.analyzer = GCodeAnalyzer()
+
+    # States of the segment tokens - token -> (state_pre, state_post)
+    def segment_states(self, checkpoint):
+        states = self.cache.get(checkpoint)
+        if states is not None:
+            self.cache.move_to_end(checkpoint)
+            return states
+
+        states = {}
+        state_stack = GCodeAnalyzer.State.copy_stack(checkpoint.state_stack)
+        for token in checkpoint.tokens:
+            state_pre, state_post, runtime = self.analyzer.step_token(token, state_stack, runtime = False)
+            states[token] = (state_pre, state_post)
+
+        self.cache[checkpoint] = states
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+        return states
+
+# Journal of the token list modifications since the last analysis
+# - tokens removed or modified are taken out of the totals and marked as not analyzed
+# - pending are the tokens the next analysis has to check
+# - an inserted chain is pending by its first token (the analysis goes on through the tokens not analyzed)
+# - overflows when the modified tokens are more than conf.analysis_incremental_limit of the list
+#   (the next analysis is the full one - cheaper than checking most of the list)
+class AnalysisJournal:
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+        self.pending = set()
+        self.modified = 0
+        self.limit = int(conf.analysis_incremental_limit * len(analyzer.tokens))
+        self.overflow = False
+
+    def add_pending(self, token, count = 1):
+        self.pending.add(token)
+        self.modified += count
+        if self.modified > self.limit:
+            self.overflow = True
+            self.pending.clear()
+
+    # Analyzed the pending tokens
+    def clear(self):
+        self.pending.clear()
+        self.modified = 0
+
+    def node_inserted(self, token):
+        if not self.overflow:
+            self.add_pending(token)
+
+    def range_inserted(self, first, last, count):
+        if not self.overflow:
+            self.add_pending(first, count)
+
+    def node_removed(self, token, next_token):
+        if self.overflow:
+            return
+        self.pending.discard(token)
+        if token.analyzed:
+            self.analyzer.count_token(token, -1.0)
+            token.analyzed = False
+        if next_token is not None:
+            self.add_pending(next_token)
+
+    def node_changed(self, token):
+        if self.overflow:
+            return
+        if token.analyzed:
+            self.analyzer.count_token(token, -1.0)
+            token.analyzed = False
+        self.add_pending(token)
+
+# Arc of the G2 (clockwise) / G3 (counter-clockwise) move in the XY plane
+# - center_x/center_y, radius
+# - start_angle and sweep [rad] - the sweep is negative for the clockwise arcs
+# Same interpretation as the firmware (Marlin plan_arc):
+# - I/J: center offset from the start point
+# - R: radius (negative - the arc longer than the half circle), center solved from the end point
+# - end point at the start point - full circle
+class Arc:
+    __slots__ = ('center_x', 'center_y', 'radius', 'start_angle', 'sweep')
+
+    def __init__(self, center_x, center_y, radius, start_angle, sweep):
+        self.center_x = center_x
+        self.center_y = center_y
+        self.radius = radius
+        self.start_angle = start_angle
+        self.sweep = sweep
+
+    # Arc of the move from (x0, y0) with the move params (X/Y/I/J/R numbers)
+    # None if the arc is not defined (no I/J/R, R with the end at the start, zero radius)
+    @staticmethod
+    def from_move(x0, y0, values, clockwise):
+        x1 = values.get('X', x0)
+        y1 = values.get('Y', y0)
+
+        if 'I' in values or 'J' in values:
+            center_x = x0 + values.get('I', 0.0)
+            center_y = y0 + values.get('J', 0.0)
+        elif 'R' in values and (x1 != x0 or y1 != y0):
+            radius = values['R']
+            e = -1.0 if clockwise != (radius < 0.0) else 1.0
+            dx, dy = x1 - x0, y1 - y0
+            d = math.hypot(dx, dy)
+            h2 = (radius - 0.5 * d) * (radius + 0.5 * d)
+            h = math.sqrt(h2) if h2 >= 0.0 else 0.0
+            center_x = (x0 + x1) * 0.5 - e * h * dy / d
+            center_y = (y0 + y1) * 0.5 + e * h * dx / d
+        else:
+            return None
+
+        radius = math.hypot(x0 - center_x, y0 - center_y)
+        if radius == 0.0:
+            return None
+
+        start_angle = math.atan2(y0 - center_y, x0 - center_x)
+        sweep = math.atan2(y1 - center_y, x1 - center_x) - start_angle
+        if sweep < 0.0:
+            sweep += 2.0 * math.pi
+        if clockwise:
+            sweep -= 2.0 * math.pi
+        if sweep == 0.0 and x1 == x0 and y1 == y0:
+            sweep = 2.0 * math.pi
+        return Arc(center_x, center_y, radius, start_angle, sweep)
+
+    # Length of the arc (helix with the Z move)
+    def length(self, dz = 0.0):
+        return math.hypot(self.radius * self.sweep, dz)
+
+    # Distance travelled along the X and Y axes (the axes reverse at the quadrant points)
+    def axis_travel(self):
+        lo = min(self.start_angle, self.start_angle + self.sweep)
+        hi = max(self.start_angle, self.start_angle + self.sweep)
+        return (self.radius * Arc.variation(math.cos, lo, hi, 0.0),
+                self.radius * Arc.variation(math.sin, lo, hi, 0.5 * math.pi))
+
+    # Total variation of the function (cos/sin) over [lo, hi] - extremes at phase + k * pi
+    @staticmethod
+    def variation(function, lo, hi, phase):
+        total = 0.0
+        previous = function(lo)
+        k = math.floor((lo - phase) / math.pi) + 1
+        while phase + k * math.pi < hi:
+            value = function(phase + k * math.pi)
+            total += abs(value - previous)
+            previous = value
+            k += 1
+        return total + abs(function(hi) - previous)
+
+    # Point on the arc at the fraction of the sweep (0.0 - start, 1.0 - end)
+    def point(self, fraction):
+        angle = self.start_angle + self.sweep * fraction
+        return (self.center_x + self.radius * math.cos(angle), self.center_y + self.radius * math.sin(angle))
+
+    # Points along the arc from the start to the end (start excluded)
+    # - segments not longer than segment_length
+    def points(self, segment_length):
+        segments = max(1, int(math.ceil(abs(self.radius * self.sweep) / segment_length)))
+        return [self.point(float(indx) / segments) for indx in range(1, segments + 1)]
+
 # GCode analyzer
 # Used to iterate over the parsed token list and while collecting the state
 class GCodeAnalyzer:
 
     # GCode state
+    # States are shared between the tokens - treat the state of a token as read only
+    # - tokens that don't change the state reuse the state of the previous token
+    # - copies share the per tool maps, the map is copied on the first write (set_extrusion/set_retraction)
+    # - pushed is the state below on the M120/M121 stack (None at the bottom) - the state carries the whole stack
     class State:
+        __slots__ = ('x', 'y', 'z', 'layer_num', 'feed_rate', 'tool_selected', 'tool_extrusion', 'tool_retraction', 'e_relative',
+                     'extrusion_shared', 'retraction_shared', 'pushed')
 
         # Constructor
         def __init__(self, 
@@ -116,7 +1016,8 @@ class GCodeAnalyzer:
                      tool_selected = None, 
                      tool_extrusion = None, 
                      tool_retraction = None,
-                     e_relative = True):
+                     e_relative = True,
+                     pushed = None):
             self.x = x
             self.y = y
             self.z = z
@@ -132,8 +1033,35 @@ class GCodeAnalyzer:
             else:
                 self.tool_retraction = tool_retraction
             self.e_relative = e_relative
-
-        # Copy
+            self.extrusion_shared = False
+            self.retraction_shared = False
+            self.pushed = pushed
+
+        # Same state for the following tokens
+        # - with the relative extrusion the tracked extrusion is only a running total, only the tools are compared
+        #   (unless strict)
+        # - not retracted is the same as no retraction record
+        def same_as(self, other, strict = True):
+            if not (self.x == other.x and self.y == other.y and self.z == other.z and
+                    self.layer_num == other.layer_num and self.feed_rate == other.feed_rate and
+                    self.tool_selected == other.tool_selected and self.e_relative == other.e_relative):
+                return False
+            if self.pushed is not other.pushed:
+                if self.pushed is None or other.pushed is None or not self.pushed.same_as(other.pushed, strict):
+                    return False
+            if strict or not self.e_relative:
+                if self.tool_extrusion != other.tool_extrusion:
+                    return False
+            elif self.tool_extrusion.keys() != other.tool_extrusion.keys():
+                return False
+            if self.tool_retraction is other.tool_retraction:
+                return True
+            for tool_id in self.tool_retraction.keys() | other.tool_retraction.keys():
+                if self.tool_retraction.get(tool_id, 0.0) != other.tool_retraction.get(tool_id, 0.0):
+                    return False
+            return True
+
+        # Copy - the per tool maps are shared (copy on write) by both states
         def copy(self):
             lhs = GCodeAnalyzer.State(
                 x = self.x,
@@ -142,11 +1070,47 @@ class GCodeAnalyzer:
                 layer_num = self.layer_num,
                 feed_rate = self.feed_rate,
                 tool_selected = self.tool_selected,
-                tool_extrusion = self.tool_extrusion.copy(),
-                tool_retraction = self.tool_retraction.copy(),
-                e_relative = self.e_relative)
+                tool_extrusion = self.tool_extrusion,
+                tool_retraction = self.tool_retraction,
+                e_relative = self.e_relative,
+                pushed = self.pushed)
+            self.extrusion_shared = lhs.extrusion_shared = True
+            self.retraction_shared = lhs.retraction_shared = True
             return lhs
 
+        # State stack ending with the state (the pushed states below it)
+        def stack(self):
+            state_stack = []
+            state = self
+            while state is not None:
+                state_stack.append(state)
+                state = state.pushed
+            state_stack.reverse()
+            return state_stack
+
+        # Copy of the state stack (the copies linked to each other)
+        @staticmethod
+        def copy_stack(state_stack):
+            copies = []
+            for state in state_stack:
+                state = state.copy()
+                state.pushed = copies[-1] if len(copies) > 0 else None
+                copies.append(state)
+            return copies
+
+        # Write the per tool maps (copied first if shared)
+        def set_extrusion(self, tool_id, value):
+            if self.extrusion_shared:
+                self.tool_extrusion = self.tool_extrusion.copy()
+                self.extrusion_shared = False
+            self.tool_extrusion[tool_id] = value
+
+        def set_retraction(self, tool_id, value):
+            if self.retraction_shared:
+                self.tool_retraction = self.tool_retraction.copy()
+                self.retraction_shared = False
+            self.tool_retraction[tool_id] = value
+
         # Get the move speed
         @property
         def move_speed_x(self):
@@ -192,26 +1156,22 @@ class GCodeAnalyzer:
         def retraction(self):
             if self.tool_selected is None:
                 raise GCodeStateException("Requesting retraction state while no tool is active")
-            if self.tool_selected not in self.tool_retraction:
-                self.tool_retraction[self.tool_selected] = 0.0
-            return self.tool_retraction[self.tool_selected]
+            return self.tool_retraction.get(self.tool_selected, 0.0)
     
         # Functions to mark retraction
         # If distance is None - treat this as FW command
         def mark_retracted(self, distance = None):
             if self.tool_selected is None:
                 raise GCodeStateException("Setting retraction state while no tool is active")
-            if self.tool_selected not in self.tool_retraction:
-                self.tool_retraction[self.tool_selected] = 0.0
             if distance != None:
-                self.tool_retraction[self.tool_selected] += distance
+                self.set_retraction(self.tool_selected, self.tool_retraction.get(self.tool_selected, 0.0) + distance)
             else:
-                self.tool_retraction[self.tool_selected] = -1.0
+                self.set_retraction(self.tool_selected, -1.0)
 
         def mark_unretracted(self):
             if self.tool_selected is None:
                 raise GCodeStateException("Setting retraction state while no tool is active")
-            self.tool_retraction[self.tool_selected] = 0.0
+            self.set_retraction(self.tool_selected, 0.0)
                 
 
         # Setter/getter for e
@@ -224,144 +1184,369 @@ class GCodeAnalyzer:
 
         @e.setter
         def e(self, val):
-            self.tool_extrusion[self.tool_selected] = val
+            self.set_extrusion(self.tool_selected, val)
 
     # Initialize
     def __init__(self, gcode_file = None):
-        if gcode_file is None:
-            self.tokens = doublelinkedlist.DLList()
-        else:
-            self.parse(gcode_file)
         self.total_runtime = 0
         # total filament usage
         self.total_filament_usage = {}
 
         # cached list
         self.cached_tokens = []
+
+        # Mapped source (if parsing with conf.parse_mmap)
+        self.source = None
+        # Binary GCode file (if parsing .bgcode) - keeps the metadata blocks
+        self.bgcode = None
+        # List version the states were computed for (by the parallel parse)
+        self.analyzed_version = None
+        # Columnar model of the tokens - (list version, columns)
+        self.cached_columns = None
+        # Checkpoints of the last analysis (if conf.analysis_checkpoint_interval is set)
+        self.checkpoints = None
+        # Modifications since the last analysis (if it can be updated incrementally)
+        self.journal = None
+        self.initial_state = None
+        # Set when M82 is used - the incremental analysis has to compare the tracked extrusion too
+        self.extrusion_absolute_used = False
+
+        if gcode_file is None:
+            self.tokens = doublelinkedlist.DLList()
+        else:
+            self.parse(gcode_file)
         
     # Analyze the tokens - from beggining to end
     # State is after GCode execution
     # - also calculates the runtimes
     def analyze_state(self):
-        # State stack - to handle M120 and M121
-        # For normal operation - replace the item on on top of the queue
-        # for M120 and M121 push and pop copy of the last item onto the stack
-        state_stack = [GCodeAnalyzer.State()]
-        seq = 0
+        # Already analyzed by the parallel parse - and not modified since
+        if self.analyzed_version is not None and self.analyzed_version == self.tokens.version:
+            return self.tokens
+        self.analyzed_version = None
+
+        # Only the modified part since the last analysis
+        if self.journal is not None:
+            if not self.journal.overflow:
+                self.analyze_modified()
+                return self.tokens
+            self.tokens.listeners.remove(self.journal)
+            self.journal = None
 
         # Total runtime of GCode
         self.total_runtime = 0.0
         self.total_filament_usage = {}
+        self.extrusion_absolute_used = False
+
+        # State stack - to handle M120 and M121
+        # For normal operation - replace the item on on top of the queue
+        # for M120 and M121 push and pop copy of the last item onto the stack
+        checkpoint_interval = conf.analysis_checkpoint_interval
+        self.checkpoints = StateCheckpoints() if checkpoint_interval > 0 else None
+        self.initial_state = GCodeAnalyzer.State()
+        self.analyze_tokens(self.tokens, [self.initial_state], checkpoint_interval = checkpoint_interval)
+
+        # Track the modifications - not with the checkpoints (states are rebuilt from the tokens)
+        if checkpoint_interval == 0:
+            self.journal = AnalysisJournal(self)
+            self.tokens.listeners.append(self.journal)
+
+        return self.tokens
 
+    # Analyze the tokens modified since the last analysis
+    # Walks the list and simulates the tokens from the first modification until the state
+    # is the same as in the last analysis (then the rest of the analysis still holds)
+    # - the totals are updated by the journal (removed tokens) and here (simulated tokens)
+    # - with the relative extrusion only (no M82) the kept states have the extrusion running totals
+    #   of the last analysis (only the differences are used)
+    def analyze_modified(self):
+        pending = self.journal.pending
+        if len(pending) == 0:
+            return
+
+        t_start = time.time()
+        simulated = 0
+        state_stack = [self.initial_state]
+        converged = True
+        strict = self.extrusion_absolute_used
         for token in self.tokens:
-            token.seq = seq
-            seq += 1
-
-            # Accumulate the state - replace the top one with the copy
-            token.state_pre = state_stack[-1]
-            state_stack[-1] = state_stack[-1].copy()
-            token.state_post = state_stack[-1]
-
-            # Tool change token
-            if token.type == Token.TOOLCHANGE:
-                if token.next_tool == -1:
-                    token.state_post.tool_selected = None
-                else:
-                    token.state_post.tool_selected = token.next_tool
-                
-                    # Basically first time the tool is used
-                    if token.next_tool not in token.state_post.tool_extrusion:
-                        token.state_post.tool_extrusion[token.next_tool] = 0.0
-                token.runtime = conf.runtime_tool_change
-            # GCode 
-            elif token.type == Token.GCODE:
-                # Add retraction
-                if token.gcode == 'G10' and len(token.param) == 0: # Firmware retract
-                    if conf.retraction_firmware == False:
-                        raise GCodeStateException("Encountered G10 gcode while firmware retraction is disabled")
-                    token.state_post.mark_retracted()
-                    token.runtime = conf.runtime_g10
-                elif token.gcode == 'G11': # Firmware unretract
-                    if conf.retraction_firmware == False:
-                        raise GCodeStateException("Encountered G11 gcode while firmware retraction is disabled")
-                    token.state_post.mark_unretracted()
-                    token.runtime = conf.runtime_g11
-                elif token.gcode == 'G1': # Controlled move
-
-                    # Move times
-                    token.runtime = 0
-                    # TODO: For time being just treat X/Y/Z absolute
-                    state_pre = token.state_pre
-                    state_post = token.state_post
-
-                    if 'F' in token.param: state_post.feed_rate = float(token.param['F'])
-                    if 'X' in token.param: 
-                        state_post.x = float(token.param['X'])
-                        x0 = state_pre.x if state_pre.x != None else 0.0
-                        x_time = abs(state_post.x - x0) * 120.0 / (state_pre.move_speed_x + state_post.move_speed_x)
-                        if x_time > token.runtime: token.runtime = x_time
-                    if 'Y' in token.param: 
-                        state_post.y = float(token.param['Y'])
-                        y0 = state_pre.y if state_pre.y != None else 0.0
-                        y_time = abs(state_post.y - y0) * 120.0 / (state_pre.move_speed_y + state_post.move_speed_y)
-                        if y_time > token.runtime: token.runtime = y_time
-                    if 'Z' in token.param: 
-                        state_post.z = float(token.param['Z'])
-                        z0 = state_pre.z if state_pre.z != None else 0.0
-                        z_time = abs(state_post.z - z0) * 120.0 / (state_pre.move_speed_z + state_post.move_speed_z)
-                        if z_time > token.runtime: token.runtime = z_time
-                    if 'E' in token.param:
-                        tool_id = state_pre.tool_selected
-                        e_value = float(token.param['E'])
-
-                        if state_pre.e_relative:
-                            state_post.tool_extrusion[tool_id] += e_value
-                            if tool_id not in self.total_filament_usage:
-                                self.total_filament_usage[tool_id] = e_value
-                            else:
-                                self.total_filament_usage[tool_id] += e_value
-                        else: 
-                            state_post.tool_extrusion[tool_id] = e_value
-                            if tool_id not in self.total_filament_usage:
-                                self.total_filament_usage[tool_id] = e_value
-                            else:
-                                self.total_filament_usage[tool_id] += (e_value - state_pre.tool_extrusion[tool_id])
-                        e0 = state_pre.tool_extrusion[tool_id]
-                        e1 = state_post.tool_extrusion[tool_id]
-                        e_time = abs(e1 - e0) * 120.0 / (state_pre.extrud_speed + state_post.extrud_speed)
-                        if e_time > token.runtime: token.runtime = e_time
-
-                        # Handle the slicer based retractions
-                        if conf.retraction_firmware == False:
-                            if e_value < 0.0:
-                                state_post.mark_retracted(e_value)
-                            if e_value > 0.0 and state_pre.is_retracted:
-                                state_post.mark_unretracted()
-
-                elif token.gcode == 'M120': # Push state onto stack
-                    # Push the copy of the current state onto the stack - experimental
-                    state_stack.append(state_stack[-1].copy())
-                    token.runtime = 0.0
-                elif token.gcode == 'M121': # Pop state from the stack 
-                    # Pop the copy of the current state from the stack - experimental
-                    state_stack.pop()
-                    token.runtime = 0.0
-                else:
-                    token.runtime = 0.0
-
-            # PARAM
-            elif token.type == Token.PARAMS:
-                # Track layer changes
-                if token.label == 'AFTER_LAYER_CHANGE':
-                    token.state_post.layer_num = token.param[0]
-                token.runtime = 0
+            if converged and len(pending) == 0:
+                break
+            pending.discard(token)
+
+            state = state_stack[-1]
+            if token.analyzed:
+                # Same state as the last analysis - keep the states and the runtime
+                state_pre = token.saved_state_pre
+                if state_pre is state or state_pre.same_as(state, strict):
+                    token.saved_state_pre = state
+                    state_post = token.saved_state_post
+                    if state_post.pushed is None and len(state_stack) == 1:
+                        state_stack[-1] = state_post
+                    else:
+                        # M120/M121 - the stack of the state
+                        state_stack = state_post.stack()
+                    converged = True
+                    continue
+                self.count_token(token, -1.0)
+
+            converged = False
+            simulated += 1
+            token.analyzed = True
+            token.saved_state_pre, token.saved_state_post, token.runtime = self.step_token(token, state_stack)
+            self.total_runtime += token.runtime
+
+        self.journal.clear()
+        logger.debug("Analyzed {tokens} modified tokens [elapsed: {elapsed:0.2f}s]".format(tokens = simulated, elapsed = time.time() - t_start))
+
+    # Add (or remove with sign -1.0) the runtime and the filament usage of the analyzed token to the totals
+    def count_token(self, token, sign):
+        self.total_runtime += sign * token.runtime
+        usage = GCodeAnalyzer.filament_usage(token, token.saved_state_pre)
+        if usage is not None:
+            tool_id, length = usage
+            self.total_filament_usage[tool_id] = self.total_filament_usage.get(tool_id, 0.0) + sign * length
+
+    # Filament used by the move from the state - (tool, length) or None
+    @staticmethod
+    def filament_usage(token, state_pre):
+        if token.op not in GCodeAnalyzer.move_opcodes:
+            return None
+        values = token.param.numbers()
+        if 'E' not in values:
+            return None
+        tool_id = state_pre.tool_selected
+        if state_pre.e_relative:
+            return tool_id, values['E']
+        return tool_id, values['E'] - state_pre.tool_extrusion[tool_id]
+
+    # Analyze the sequence of tokens starting from the state stack
+    # - accumulates the runtime and filament usage into the totals
+    # - with checkpoint_interval set the tokens keep only the checkpoint their states are rebuilt from
+    #   (new checkpoint every checkpoint_interval tokens and at each layer change)
+    def analyze_tokens(self, tokens, state_stack, checkpoint_interval = 0):
+        checkpoint = None
+        for token in tokens:
+            token.analyzed = True
+
+            if checkpoint_interval > 0:
+                if checkpoint is None or len(checkpoint.tokens) >= checkpoint_interval or token.op == OPCODE_LAYER_CHANGE:
+                    checkpoint = StateCheckpoint(self.checkpoints, state_stack)
+                checkpoint.tokens.append(token)
+                token.checkpoint = checkpoint
+                token.saved_state_pre = token.saved_state_post = None
+                token.runtime = self.step_token(token, state_stack)[2]
             else:
-                token.runtime = conf.runtime_default
+                token.checkpoint = None
+                token.saved_state_pre, token.saved_state_post, token.runtime = self.step_token(token, state_stack)
 
             # Add the total runtime
             self.total_runtime += token.runtime
 
-        return self.tokens
+    # Accumulate the token into the state stack - replace the top one with the copy
+    # (tokens that don't change the state share it with the previous token)
+    # - returns (state_pre, state_post, runtime), runtime is 0.0 if not requested
+    def step_token(self, token, state_stack, runtime = True):
+        state_pre = state_stack[-1]
+        handler = GCodeAnalyzer.handlers.get(token.op)
+        if handler is None:
+            return state_pre, state_pre, 0.0
+        if token.op in GCodeAnalyzer.stateless_opcodes:
+            state_post = state_pre
+            token_runtime = handler(self, token, state_stack, state_pre) if runtime else 0.0
+        else:
+            state_stack[-1] = state_pre.copy()
+            token_runtime = handler(self, token, state_stack, state_pre if runtime else None)
+            # Top of the stack (M120/M121 push/pop)
+            state_post = state_stack[-1]
+
+        # Calibrated runtime (see calibration.CalibrationProfile)
+        factor = GCodeAnalyzer.runtime_factors.get(token.op)
+        if factor is not None:
+            token_runtime *= factor
+        return state_pre, state_post, token_runtime
+
+    # Apply the token to the state on top of the stack (in place)
+    # - state_pre is the state before the token, used to calculate the runtime
+    #   (if None - only the state is updated, used by the pre-scan)
+    # - returns the runtime estimate
+    # Dispatched on the opcode id, opcodes without a handler don't change the state
+    def apply_token(self, token, state_stack, state_pre = None):
+        handler = GCodeAnalyzer.handlers.get(token.op)
+        if handler is None:
+            return 0.0
+        return handler(self, token, state_stack, state_pre)
+
+    # Opcode handlers - opcode id -> handler(analyzer, token, state_stack, state_pre)
+    handlers = {}
+    # Opcodes whose handler doesn't change the state (only the runtime)
+    stateless_opcodes = set()
+    # Moves - the opcodes using the filament
+    move_opcodes = set()
+    # Arcs - opcode id -> clockwise
+    arc_opcodes = {}
+    # Runtime correction factors - opcode id -> factor (set by calibration.CalibrationProfile.apply)
+    runtime_factors = {}
+
+    # Register the handler for the opcode
+    @staticmethod
+    def register_handler(name, handler, stateless = False):
+        GCodeAnalyzer.handlers[opcode_id(name)] = handler
+        if stateless:
+            GCodeAnalyzer.stateless_opcodes.add(opcode_id(name))
+
+    # Comment
+    def handle_comment(self, token, state_stack, state_pre):
+        return conf.runtime_default
+
+    # Tool change token
+    def handle_tool_change(self, token, state_stack, state_pre):
+        state_post = state_stack[-1]
+        if token.next_tool == -1:
+            state_post.tool_selected = None
+        else:
+            state_post.tool_selected = token.next_tool
+        
+            # Basically first time the tool is used
+            if token.next_tool not in state_post.tool_extrusion:
+                state_post.set_extrusion(token.next_tool, 0.0)
+        return conf.runtime_tool_change
+
+    # Track layer changes
+    def handle_layer_change(self, token, state_stack, state_pre):
+        state_stack[-1].layer_num = token.param[0]
+        return 0.0
+
+    # Firmware retract (G10 with params is the temperature control)
+    def handle_g10(self, token, state_stack, state_pre):
+        if len(token.param) != 0:
+            return 0.0
+        if conf.retraction_firmware == False:
+            raise GCodeStateException("Encountered G10 gcode while firmware retraction is disabled")
+        state_stack[-1].mark_retracted()
+        return conf.runtime_g10
+
+    # Firmware unretract
+    def handle_g11(self, token, state_stack, state_pre):
+        if conf.retraction_firmware == False:
+            raise GCodeStateException("Encountered G11 gcode while firmware retraction is disabled")
+        state_stack[-1].mark_unretracted()
+        return conf.runtime_g11
+
+    # Move (G0/G1) and arc (G2/G3)
+    # - arcs end at X/Y (the start point if not set - full circle), the runtime follows the arc
+    def handle_move(self, token, state_stack, state_pre):
+        state_post = state_stack[-1]
+
+        # TODO: For time being just treat X/Y/Z absolute
+        # Params converted once and cached (next passes reuse them)
+        values = token.param.numbers()
+
+        # Arc from the position before the move
+        arc = None
+        clockwise = GCodeAnalyzer.arc_opcodes.get(token.op)
+        if clockwise is not None:
+            x0 = state_post.x if state_post.x != None else 0.0
+            y0 = state_post.y if state_post.y != None else 0.0
+            arc = Arc.from_move(x0, y0, values, clockwise)
+
+        if 'F' in values: state_post.feed_rate = values['F']
+        if 'X' in values: state_post.x = values['X']
+        if 'Y' in values: state_post.y = values['Y']
+        if 'Z' in values: state_post.z = values['Z']
+        if 'E' in values:
+            tool_id = state_post.tool_selected
+            e_value = values['E']
+
+            # Same as filament_usage (the state is not updated yet)
+            if state_post.e_relative:
+                length = e_value
+                state_post.set_extrusion(tool_id, state_post.tool_extrusion[tool_id] + e_value)
+            else:
+                length = e_value - state_post.tool_extrusion[tool_id]
+                state_post.set_extrusion(tool_id, e_value)
+            self.total_filament_usage[tool_id] = self.total_filament_usage.get(tool_id, 0.0) + length
+
+            # Handle the slicer based retractions
+            if conf.retraction_firmware == False:
+                if e_value < 0.0:
+                    state_post.mark_retracted(e_value)
+                elif e_value > 0.0 and state_post.is_retracted:
+                    state_post.mark_unretracted()
+
+        # Move times
+        if state_pre is None:
+            return 0.0
+        return GCodeAnalyzer.move_runtime(state_pre, state_post, values, arc)
+
+    # Set position - no move
+    # - with the relative extrusion the tracked E is the total extruded, G92 E doesn't reset it
+    def handle_g92(self, token, state_stack, state_pre):
+        state_post = state_stack[-1]
+        values = token.param.numbers()
+
+        if 'X' in values: state_post.x = values['X']
+        if 'Y' in values: state_post.y = values['Y']
+        if 'Z' in values: state_post.z = values['Z']
+        if 'E' in values and not state_post.e_relative and state_post.tool_selected is not None:
+            state_post.set_extrusion(state_post.tool_selected, values['E'])
+        return 0.0
+
+    # Absolute extrusion
+    def handle_m82(self, token, state_stack, state_pre):
+        self.extrusion_absolute_used = True
+        state_stack[-1].e_relative = False
+        return 0.0
+
+    # Relative extrusion
+    def handle_m83(self, token, state_stack, state_pre):
+        state_stack[-1].e_relative = True
+        return 0.0
+
+    # Push state onto stack
+    def handle_m120(self, token, state_stack, state_pre):
+        # Push the copy of the current state onto the stack - experimental
+        pushed = state_stack[-1].copy()
+        pushed.pushed = state_stack[-1]
+        state_stack.append(pushed)
+        return 0.0
+
+    # Pop state from the stack 
+    def handle_m121(self, token, state_stack, state_pre):
+        # Pop the copy of the current state from the stack - experimental
+        state_stack.pop()
+        return 0.0
+
+    # Runtime of the move between the two states
+    # - arcs: X/Y times over the distance the axes travel along the arc
+    @staticmethod
+    def move_runtime(state_pre, state_post, values, arc = None):
+        runtime = 0
+        if arc is not None:
+            x_travel, y_travel = arc.axis_travel()
+            x_time = x_travel * 120.0 / (state_pre.move_speed_x + state_post.move_speed_x)
+            y_time = y_travel * 120.0 / (state_pre.move_speed_y + state_post.move_speed_y)
+            runtime = max(x_time, y_time)
+        else:
+            if 'X' in values: 
+                x0 = state_pre.x if state_pre.x != None else 0.0
+                x_time = abs(state_post.x - x0) * 120.0 / (state_pre.move_speed_x + state_post.move_speed_x)
+                if x_time > runtime: runtime = x_time
+            if 'Y' in values: 
+                y0 = state_pre.y if state_pre.y != None else 0.0
+                y_time = abs(state_post.y - y0) * 120.0 / (state_pre.move_speed_y + state_post.move_speed_y)
+                if y_time > runtime: runtime = y_time
+        if 'Z' in values: 
+            z0 = state_pre.z if state_pre.z != None else 0.0
+            z_time = abs(state_post.z - z0) * 120.0 / (state_pre.move_speed_z + state_post.move_speed_z)
+            if z_time > runtime: runtime = z_time
+        if 'E' in values:
+            tool_id = state_pre.tool_selected
+            e0 = state_pre.tool_extrusion[tool_id]
+            e1 = state_post.tool_extrusion[tool_id]
+            e_time = abs(e1 - e0) * 120.0 / (state_pre.extrud_speed + state_post.extrud_speed)
+            if e_time > runtime: runtime = e_time
+        return runtime
 
     # Print total runtime
     @property
@@ -400,123 +1585,135 @@ class GCodeAnalyzer:
             filament_usage_cm3.append(filament_usage_mm[-1] * conf.tool_filament_diameter[k] * 0.001)
             filament_usage_g.append(filament_usage_cm3[-1] * conf.filament_density[k])
 
-        # Go over all of the tokens
-        for token in self.tokens:
-            # Setup the tool changes
-            if token.type == Token.COMMENT:
-                if "filament used [mm]" in token.text:
-                    token.text = "filament used [mm] = " + ",".join(["{length:.2f}".format(length = length) for length in filament_usage_mm])
-                    continue
-
-                if "filament used [cm3]" in token.text:
-                    token.text = "filament used [cm3] = " + ",".join(["{volume:.2f}".format(volume = volume) for volume in filament_usage_cm3])
-                    continue
-
-                if "filament used [g]" in token.text:
-                    token.text = "filament used [g] = " + ",".join(["{weight:.2f}".format(weight = weight) for weight in filament_usage_g])
-                    continue
-
-                if "estimated printing time (normal mode)" in token.text:
-                    token.text = "estimated printing time (normal mode) = {total_runtime}".format(total_runtime = self.total_runtime_str)
-                    continue
+        statistics = {
+            'filament used [mm]' : ",".join(["{length:.2f}".format(length = length) for length in filament_usage_mm]),
+            'filament used [cm3]' : ",".join(["{volume:.2f}".format(volume = volume) for volume in filament_usage_cm3]),
+            'filament used [g]' : ",".join(["{weight:.2f}".format(weight = weight) for weight in filament_usage_g]),
+            'total filament used [g]' : "{weight:.2f}".format(weight = sum(filament_usage_g)),
+            'estimated printing time (normal mode)' : self.total_runtime_str }
+
+        # PrusaSlicer writes the statistics in the trailing comment block
+        # - only walk back over it (up to the last non-comment token)
+        for token in reversed(self.tokens):
+            if token.type != Token.COMMENT:
+                break
+            key = token.text.split('=', 1)[0].strip()
+            if key in statistics:
+                token.text = "{key} = {value}".format(key = key, value = statistics[key])
+
+        # Binary GCode keeps the statistics in the print metadata block
+        if self.bgcode is not None:
+            for key, value in statistics.items():
+                if key in self.bgcode.print_metadata:
+                    self.bgcode.print_metadata[key] = value
 
 
     # Parse the file and populate the tokens
     def parse(self, gcode_file):
         self.tokens = doublelinkedlist.DLList()
 
-        # Read all the lines        
-        with open(gcode_file, mode='r', encoding='utf8') as gcode_in:
-            # Track the tool
-            current_tool_head = -1
-
-            for line in gcode_in.readlines():
-                line = line.strip()
-
-                if len(line) == 0:
-                    continue
-
-                # Check if comment
-                if line[0] == ';':
-                    # Check if comment params - starts with ;;
-                    if len(line) > 1 and line[1] == ';':
-                        contents = line[2:]
-                        # Check if has extra comment - strip
-                        comment_pos = contents.find(';')
-                        if comment_pos != -1:
-                            contents = contents[0:comment_pos].strip()
-                        # Check if has params
-                        label = None
-                        params = []
-
-                        params_sep = contents.find(':')
-                        if params_sep != -1:
-                            label = contents[0:params_sep].strip()
-                            params = contents[params_sep+1:].split(',')
-                        else:
-                            label = contents.strip()
-
-                        # Check if the label in params
-                        if label not in valid_params_format.keys():
-                            raise GCodeParseException("Param {label} not valid".format(label = label), line)
-                        if len(params) != len(valid_params_format[label]):
-                            raise GCodeParseException("Param {label} has invalid number of arguments".format(label = label), line)
-
-                        self.tokens.append_node(Params(
-                            label = label,
-                            param = [valid_params_format[label][indx](params[indx]) for indx in range(0, len(params))]))
-                        continue
-                    # Check if normal comment - single ;
-                    if len(line) > 1 and line[1] != ';':
-                        text = line[1:]
-
-                        self.tokens.append_node(Comment(text = text))
-                        continue
-                    # Empty comment - skip
-                    if len(line) == 1:
-                        continue
-
-                # Check if GCODE 
-                if line[0] in ['G', 'M']:
-                    contents = line
-                    comment = ""
-                    # Check if has extra comment - strip
-                    comment_pos = line.find(';')
-                    if comment_pos != -1:
-                        contents = line[0:comment_pos].strip()
-                        comment = line[comment_pos+1:].strip()
-
-                    # Split into params
-                    args = contents.split()
-                    gcode = args[0]
-                    # # Check if omit the code
-                    if len(args) == 1:
-                        self.tokens.append_node(GCode(
-                            gcode = gcode,
-                            comment = comment))
-                    else:
-                        self.tokens.append_node(GCode(
-                            gcode = gcode,
-                            param = dict([(p[0], p[1:]) for p in args[1:]]),
-                            comment = comment))
-                    continue
-
-                # Check if Toolchange
-                if line[0] == 'T':
-                    # Check if has extra comment - strip
-                    contents = line
-                    comment_pos = line.find(';')
-                    if comment_pos != -1:
-                        contents = line[0:comment_pos].strip()
-                    
-                    previous_tool_head = current_tool_head
-                    current_tool_head = int(contents[1:])
-
-                    self.tokens.append_node(ToolChange(
-                        prev_tool = previous_tool_head,
-                        next_tool = current_tool_head))
-                    continue
-
+        # Compressed files can only be streamed
+        compressed = compression_of(gcode_file) is not None
+
+        # Binary GCode - decode the GCode blocks straight into the tokens
+        if not compressed and bgcode.is_bgcode(gcode_file):
+            self.bgcode = bgcode.BGCodeFile(gcode_file)
+            for token in tokenize_lines(split_lines(self.bgcode.gcode_chunks())):
+                self.tokens.append_node(token)
+            return
+
+        # Map the file - tokens only keep the offsets into the mapping
+        if conf.parse_mmap and not compressed:
+            self.source = GCodeSource(gcode_file)
+            for token in tokenize_source(self.source):
+                self.tokens.append_node(token)
+            return
+
+        # Load the tokens parsed by the previous run
+        cache_key = None
+        if conf.token_cache_enabled:
+            cache = token_cache.TokenCache()
+            cache_key = cache.key(gcode_file, PARSER_VERSION)
+            records = cache.load(cache_key)
+            if records is not None:
+                logger.info("Loaded {count} tokens from the cache".format(count = len(records)))
+                for record in records:
+                    self.tokens.append_node(token_from_record(record))
+                return
+
+        # Split the file between the worker processes
+        if conf.parse_workers > 1 and not compressed:
+            self.parse_parallel(gcode_file, conf.parse_workers)
+        else:
+            # Stream the tokens straight into the list
+            for token in iterparse(gcode_file):
+                self.tokens.append_node(token)
+
+        if cache_key is not None:
+            cache.store(cache_key, [token_record(token) for token in self.tokens])
+
+    # Parse and analyze the file using multiple processes
+    # The file is split at ;;AFTER_LAYER_CHANGE boundaries, the pre-scan computes
+    # the state at each boundary so the chunks can be tokenized and analyzed
+    # independently - the result is the same as parse + analyze_state
+    def parse_parallel(self, gcode_file, workers):
+        t_start = time.time()
+
+        chunks = prescan_chunks(gcode_file, workers * conf.parse_chunks_per_worker)
+        logger.info("Parsing {chunks} chunks with {workers} workers".format(chunks = len(chunks), workers = workers))
+
+        conf_values = dict([(k, v) for k, v in vars(conf).items() if not k.startswith('_') and isinstance(v, (bool, int, float, str, list))])
+        runtime_factors = dict([(opcode_names[op], factor) for op, factor in GCodeAnalyzer.runtime_factors.items()])
+        with concurrent.futures.ProcessPoolExecutor(max_workers = workers, initializer = conf_apply, initargs = (conf_values, runtime_factors)) as executor:
+            results = executor.map(analyze_chunk, [(gcode_file,) + chunk for chunk in chunks])
+
+            # Stitch the chunks together
+            self.total_filament_usage = {}
+            for tokens, filament_usage, worker_opcode_names in results:
+                # Share the boundary state with the previous chunk
+                if len(tokens) > 0 and self.tokens.tail is not None:
+                    tokens[0].state_pre = self.tokens.tail.state_post
+                # Opcode ids are assigned per process
+                opcode_map = [opcode_id(name) for name in worker_opcode_names]
+                for token in tokens:
+                    token.op = opcode_map[token.op]
+                    self.tokens.append_node(token)
+                self.total_filament_usage = filament_usage
+
+        # Accumulate in the same order as analyze_state
+        self.total_runtime = 0.0
+        for token in self.tokens:
+            self.total_runtime += token.runtime
+        self.analyzed_version = self.tokens.version
+
+        t_end = time.time()
+        logger.info("Parallel parse done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - t_start))
+
+    # Release the mapped source
+    # - tokens that have not been decoded yet can't be used after that
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+
+# Register the opcode handlers
+GCodeAnalyzer.register_handler(';',                    GCodeAnalyzer.handle_comment, stateless = True)
+GCodeAnalyzer.register_handler('T',                    GCodeAnalyzer.handle_tool_change)
+GCodeAnalyzer.register_handler(';;AFTER_LAYER_CHANGE', GCodeAnalyzer.handle_layer_change)
+GCodeAnalyzer.register_handler('G0',                   GCodeAnalyzer.handle_move)
+GCodeAnalyzer.register_handler('G1',                   GCodeAnalyzer.handle_move)
+GCodeAnalyzer.register_handler('G2',                   GCodeAnalyzer.handle_move)
+GCodeAnalyzer.register_handler('G3',                   GCodeAnalyzer.handle_move)
+GCodeAnalyzer.move_opcodes.update([opcode_id(name) for name in ('G0', 'G1', 'G2', 'G3')])
+GCodeAnalyzer.arc_opcodes.update({ opcode_id('G2') : True, opcode_id('G3') : False })
+GCodeAnalyzer.register_handler('G10',                  GCodeAnalyzer.handle_g10)
+GCodeAnalyzer.register_handler('G11',                  GCodeAnalyzer.handle_g11)
+GCodeAnalyzer.register_handler('G92',                  GCodeAnalyzer.handle_g92)
+GCodeAnalyzer.register_handler('M82',                  GCodeAnalyzer.handle_m82)
+GCodeAnalyzer.register_handler('M83',                  GCodeAnalyzer.handle_m83)
+GCodeAnalyzer.register_handler('M120',                 GCodeAnalyzer.handle_m120)
+GCodeAnalyzer.register_handler('M121',                 GCodeAnalyzer.handle_m121)
 
 # GCode validator
 # Used to fix the GCode coming out of Prusa
@@ -524,56 +1721,67 @@ class GCodeValidator:
 
     gcodes_to_omit = ['M104', 'M109', 'M900', 'M140', 'M190']
 
+    # Visits the tokens before the state analysis (token_visitor.TokenVisitor)
+    # - the T0 injected at the end is needed by the analysis
+    analyzed = False
+
     # Init
     def __init__(self):
-        pass
+        self.found_tool = False             # found T
+        self.first_layer_header = None      # location of TC_INIT
 
     # analyze the gcode
+    # (token_visitor imports this module - imported when used)
     def analyze_and_fix(self, gcode_analyzer):
-        
-        # found T
-        found_tool = False
-
-        # location of TC_INIT
-        first_layer_header = None
-
-        # Go over each token
-        for token in gcode_analyzer.tokens:
-
-            # gcodes to omit - delete
-            if token.type == Token.GCODE and token.gcode in GCodeValidator.gcodes_to_omit:
-                logger.debug("Deleting {token}".format(token = str(token)))
-                gcode_analyzer.tokens.remove_node(token)
-                continue
-
-            # G10 temperature control to fix if no tool selected - set to T0
-            if token.type == Token.GCODE and token.gcode == 'G10' and len(token.param) == 1:
-                if ('S' in token.param or 'R' in token.param) and 'P' not in token.param:
-                    logger.warn("G10 token doesn't specify active tool, setting to T0")
-                    token.param['P'] = 0
-                continue
-
-            # Token to fix 
-            if token.type == Token.GCODE and token.gcode == 'M106':
-                logger.debug("Fixing M106 from 0..255 to 0-1.0 range")
-                token.param['S'] = float(token.param['S']) / 255.0
-                continue
-
-            # This is for case where file is using just one tool that is T0
-            # PS is assuming that default tool T0 is always enabled....
-            # 1) We need to record the location of first layer 
-            if token.type == Token.PARAMS and token.label == 'BEFORE_LAYER_CHANGE' and first_layer_header is None:
-                first_layer_header = token
-                continue
-
-            # 2) If found tool
-            if token.type == Token.TOOLCHANGE and token.next_tool != -1:
-                found_tool = True
-
-        # Inject the tool change to T0
-        if found_tool == False:
+        import token_visitor
+        token_visitor.traverse(gcode_analyzer, [self])
+
+    def handlers(self):
+        handlers = { name : self.visit_omit for name in GCodeValidator.gcodes_to_omit }
+        handlers['G10'] = self.visit_g10
+        handlers['M106'] = self.visit_m106
+        handlers[';;BEFORE_LAYER_CHANGE'] = self.visit_layer_change
+        handlers['T'] = self.visit_tool_change
+        return handlers
+
+    def begin(self, gcode_analyzer):
+        self.found_tool = False
+        self.first_layer_header = None
+
+    # gcodes to omit - delete
+    def visit_omit(self, token):
+        logger.debug("Deleting {token}".format(token = str(token)))
+        token.dll.remove_node(token)
+
+    # G10 temperature control to fix if no tool selected - set to T0
+    def visit_g10(self, token):
+        if len(token.param) == 1:
+            if ('S' in token.param or 'R' in token.param) and 'P' not in token.param:
+                logger.warn("G10 token doesn't specify active tool, setting to T0")
+                token.set_param('P', 0)
+
+    # Token to fix 
+    def visit_m106(self, token):
+        logger.debug("Fixing M106 from 0..255 to 0-1.0 range")
+        token.set_param('S', token.param.number('S') / 255.0)
+
+    # This is for case where file is using just one tool that is T0
+    # PS is assuming that default tool T0 is always enabled....
+    # 1) We need to record the location of first layer 
+    def visit_layer_change(self, token):
+        if self.first_layer_header is None:
+            self.first_layer_header = token
+
+    # 2) If found tool
+    def visit_tool_change(self, token):
+        if token.next_tool != -1:
+            self.found_tool = True
+
+    # Inject the tool change to T0
+    def end(self, gcode_analyzer):
+        if self.found_tool == False:
             logger.warn("Didn't found a tool change instruction, injecting T0 as a default tool...")
-            first_layer_header.append_node_left(ToolChange(-1, 0))
+            self.first_layer_header.append_node_left(ToolChange(-1, 0))
     
     # verify the retract sequence
     def analyze_retracts(self, gcode_analyzer):
@@ -0,0 +1,326 @@
+from gcode_analyzer import opcode_id, opcode_ids, GCodeAnalyzer
+import conf
+
+import math, time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Columns exception
+class GCodeColumnsException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+# Fill the rows not in mask with the last value in mask (initial if none before)
+# - pairs: the state stack (M120, M121) rows - the pop restores the value at the push
+def forward_fill(values, mask, initial, pairs = None):
+    if not pairs:
+        indices = numpy.where(mask, numpy.arange(len(values)), -1)
+        numpy.maximum.accumulate(indices, out = indices)
+        return numpy.where(indices >= 0, values[indices], initial)
+
+    # Last row setting the value (the value row of the pops resolved in order)
+    setters = mask.copy()
+    setters[[pop for push, pop in pairs]] = True
+    last = numpy.where(setters, numpy.arange(len(values)), -1)
+    numpy.maximum.accumulate(last, out = last)
+    source = numpy.where(mask, numpy.arange(len(values)), -1)
+    for push, pop in pairs:
+        source[pop] = source[last[push]] if last[push] >= 0 else -1
+    indices = numpy.where(last >= 0, source[last], -1)
+    return numpy.where(indices >= 0, values[indices], initial)
+
+# Matching state stack push/pop (M120/M121) rows - (push, pop) in the order of the pops
+# (unmatched pops are ignored)
+def stack_pairs(opcode):
+    push_id = opcode_id('M120')
+    pairs = []
+    pushed = []
+    for row in numpy.flatnonzero(numpy.isin(opcode, [push_id, opcode_id('M121')])).tolist():
+        if opcode[row] == push_id:
+            pushed.append(row)
+        elif len(pushed) > 0:
+            pairs.append((pushed.pop(), row))
+    return pairs
+
+# Columnar (struct of arrays) model of the token stream
+# Each token is a row in the parallel arrays:
+# - opcode   : opcode id (gcode_analyzer.opcode_id)
+# - X/Y/Z/E/F: params of the moves (G0/G1/G2/G3) and G92 (NaN if not set)
+# - I/J/R    : params of the arcs (G2/G3 - NaN if not set)
+# - tool     : tool selected after the row (-1 if none)
+# - layer    : layer number after the row (-1 before the first layer)
+# - runtime  : runtime estimate of the row
+# - offset   : offset of the line in the mapped source (-1 if not mapped)
+# The state stack (M120/M121) restores the forward filled values (tool, layer...) at the pop
+# The rows map back to the tokens so the queries can return the tokens to modify
+class GCodeColumns:
+    AXES = ('X', 'Y', 'Z', 'E', 'F')
+    ARC_PARAMS = ('I', 'J', 'R')
+    MOVES = ('G0', 'G1', 'G2', 'G3')
+
+    def __init__(self, tokens):
+        if numpy is None:
+            raise GCodeColumnsException("NumPy is required for the columnar token model")
+
+        self.rows = list(tokens)
+        count = len(self.rows)
+
+        self.opcode = numpy.fromiter((token.op for token in self.rows), dtype = numpy.int32, count = count)
+        self.runtime = numpy.fromiter((getattr(token, 'runtime', 0.0) for token in self.rows), dtype = numpy.float64, count = count)
+        self.offset = numpy.fromiter((token.offset if token.offset is not None else -1 for token in self.rows), dtype = numpy.int64, count = count)
+        self.stack_pairs = stack_pairs(self.opcode)
+
+        # Move params
+        is_move = numpy.isin(self.opcode, [opcode_id(name) for name in GCodeColumns.MOVES + ('G92',)])
+        moves = [self.rows[row].param.numbers() for row in numpy.flatnonzero(is_move)]
+        for axis in GCodeColumns.AXES:
+            column = numpy.full(count, numpy.nan)
+            column[is_move] = numpy.fromiter((numbers.get(axis, numpy.nan) for numbers in moves), dtype = numpy.float64, count = len(moves))
+            setattr(self, axis, column)
+        is_arc = numpy.isin(self.opcode, list(GCodeAnalyzer.arc_opcodes))
+        arcs = [self.rows[row].param.numbers() for row in numpy.flatnonzero(is_arc)]
+        for param in GCodeColumns.ARC_PARAMS:
+            column = numpy.full(count, numpy.nan)
+            column[is_arc] = numpy.fromiter((numbers.get(param, numpy.nan) for numbers in arcs), dtype = numpy.float64, count = len(arcs))
+            setattr(self, param, column)
+
+        # Tool - forward filled from the tool changes
+        is_tool_change = self.opcode == opcode_id('T')
+        tool = numpy.full(count, -1, dtype = numpy.int32)
+        tool[is_tool_change] = [self.rows[row].next_tool for row in numpy.flatnonzero(is_tool_change)]
+        self.tool = forward_fill(tool, is_tool_change, -1, self.stack_pairs)
+
+        # Layer - forward filled from the layer changes
+        is_layer_change = self.opcode == opcode_id(';;AFTER_LAYER_CHANGE')
+        layer = numpy.full(count, -1, dtype = numpy.int32)
+        layer[is_layer_change] = [self.rows[row].param[0] for row in numpy.flatnonzero(is_layer_change)]
+        self.layer = forward_fill(layer, is_layer_change, -1, self.stack_pairs)
+
+    # Build the columns for the tokens of the analyzer
+    # - cached on the analyzer until the token list is modified
+    # - runtimes are taken from the tokens (call analyze_state first to get them updated)
+    @staticmethod
+    def from_analyzer(gcode_analyzer):
+        tokens = gcode_analyzer.tokens
+
+        cached = gcode_analyzer.cached_columns
+        if cached is not None and cached[0] == tokens.version:
+            return cached[1]
+
+        t_start = time.time()
+        columns = GCodeColumns(tokens)
+        gcode_analyzer.cached_columns = (tokens.version, columns)
+        t_end = time.time()
+        logger.debug("Built the token columns - {rows} rows [elapsed: {elapsed:0.2f}s]".format(rows = len(columns.rows), elapsed = t_end - t_start))
+        return columns
+
+    def __len__(self):
+        return len(self.rows)
+
+    # Rows with any of the opcodes (in order)
+    def select(self, *names):
+        ids = [opcode_ids[name] for name in names if name in opcode_ids]
+        return numpy.flatnonzero(numpy.isin(self.opcode, ids))
+
+    # Tokens of the rows
+    def tokens(self, rows):
+        return [self.rows[row] for row in rows]
+
+# Runtime and filament usage estimate of the token columns
+# Same model as GCodeAnalyzer.analyze_state, computed with the array operations:
+# - runtime            : runtime of each row (same as token.runtime)
+# - cumulative_runtime : runtime up to and including the row
+# - total_runtime      : same as GCodeAnalyzer.total_runtime
+# - filament_usage     : tool -> filament used [mm] (same as GCodeAnalyzer.total_filament_usage)
+# - is_move            : rows of the moves (G0/G1/G2/G3)
+# - delta              : axis (X/Y/Z/E) -> move distance of the rows (0.0 if not moved)
+# - travel             : axis (X/Y/Z/E) -> distance the axis travels (along the arc for G2/G3)
+# - length             : XYZ path length of the rows (arc length for G2/G3)
+# - feed_rate          : feed rate after the row (NaN if not set)
+class GCodeEstimate:
+    def __init__(self, columns):
+        count = len(columns)
+        pairs = columns.stack_pairs
+        opcode = columns.opcode
+        is_move = numpy.isin(opcode, [opcode_id(name) for name in GCodeColumns.MOVES])
+        is_g92 = opcode == opcode_id('G92')
+
+        # Feed rate - set by the moves (NaN before the first one)
+        feed_post = forward_fill(columns.F, is_move & ~numpy.isnan(columns.F), numpy.nan, pairs)
+        feed_pre = shift(feed_post, numpy.nan)
+
+        # Extrusion mode - M83 is the default
+        is_mode = numpy.isin(opcode, [opcode_id('M82'), opcode_id('M83')])
+        e_relative = forward_fill(opcode == opcode_id('M83'), is_mode, True, pairs)
+        e_relative_pre = shift(e_relative, True)
+
+        # Tool (the moves don't change it, so the tool after the row is the tool of the move)
+        tool = columns.tool
+
+        self.runtime = numpy.zeros(count)
+        self.runtime[opcode == opcode_id(';')] = conf.runtime_default
+        self.runtime[opcode == opcode_id('T')] = conf.runtime_tool_change
+        g10_rows = columns.select('G10')
+        self.runtime[[row for row in g10_rows if len(columns.rows[row].param) == 0]] = conf.runtime_g10
+        self.runtime[opcode == opcode_id('G11')] = conf.runtime_g11
+
+        self.is_move = is_move
+        self.feed_rate = feed_post
+        self.delta = {}
+
+        # Positions and the distances the axes travel
+        self.travel = {}
+        moved = {}
+        position_pre = {}
+        for axis in ('X', 'Y', 'Z'):
+            values = getattr(columns, axis)
+            has_axis = (is_move | is_g92) & ~numpy.isnan(values)
+            position_post = forward_fill(values, has_axis, numpy.nan, pairs)
+            position_pre[axis] = shift(position_post, numpy.nan)
+            position_pre[axis] = numpy.where(numpy.isnan(position_pre[axis]), 0.0, position_pre[axis])
+
+            moved[axis] = is_move & has_axis
+            self.delta[axis] = numpy.where(moved[axis], position_post - position_pre[axis], 0.0)
+            self.travel[axis] = numpy.abs(self.delta[axis])
+        self.length = numpy.sqrt(self.delta['X'] ** 2 + self.delta['Y'] ** 2 + self.delta['Z'] ** 2)
+
+        # Arcs - X/Y travel along the arc (same as the analyzer up to the rounding)
+        arc_rows = numpy.flatnonzero(numpy.isin(opcode, list(GCodeAnalyzer.arc_opcodes)))
+        if len(arc_rows) > 0:
+            clockwise = opcode[arc_rows] == opcode_id('G2')
+            defined, radius, start_angle, sweep = arc_moves(position_pre['X'][arc_rows], position_pre['Y'][arc_rows],
+                columns.X[arc_rows], columns.Y[arc_rows], columns.I[arc_rows], columns.J[arc_rows], columns.R[arc_rows], clockwise)
+            arc_rows = arc_rows[defined]
+            radius, start_angle, sweep = radius[defined], start_angle[defined], sweep[defined]
+            lo = numpy.minimum(start_angle, start_angle + sweep)
+            hi = numpy.maximum(start_angle, start_angle + sweep)
+            self.travel['X'][arc_rows] = radius * variation(numpy.cos, lo, hi, 0.0)
+            self.travel['Y'][arc_rows] = radius * variation(numpy.sin, lo, hi, 0.5 * math.pi)
+            self.length[arc_rows] = numpy.hypot(radius * sweep, self.delta['Z'][arc_rows])
+            moved['X'][arc_rows] = moved['Y'][arc_rows] = True
+
+        # Move times - the longest of the axes
+        move_runtime = numpy.zeros(count)
+        for axis, limit in (('X', conf.move_speed_xy), ('Y', conf.move_speed_xy), ('Z', conf.move_speed_z)):
+            moves = moved[axis]
+            axis_time = self.travel[axis][moves] * 120.0 / (axis_speed(feed_pre[moves], limit) + axis_speed(feed_post[moves], limit))
+            move_runtime[moves] = numpy.maximum(move_runtime[moves], axis_time)
+
+        # Extrusion - tracked per tool
+        has_e = (is_move | (is_g92 & ~e_relative_pre & (tool >= 0))) & ~numpy.isnan(columns.E)
+        if numpy.any(has_e & (tool < 0)):
+            raise GCodeColumnsException("Extrusion with no tool selected")
+        if len(pairs) > 0:
+            # Extruder positions are not restored by the pops - only the relative extrusion in the pushed state
+            depth = numpy.zeros(count, dtype = numpy.int32)
+            depth[[push for push, pop in pairs]] += 1
+            depth[[pop for push, pop in pairs]] -= 1
+            if numpy.any(has_e & ~e_relative_pre & (numpy.cumsum(depth) > 0)):
+                raise GCodeColumnsException("Absolute extrusion within the state stack (M120/M121) not supported by the columnar estimate")
+        extrusion_pre = numpy.zeros(count)
+        extrusion_post = numpy.zeros(count)
+        self.filament_usage = {}
+        for tool_id in numpy.unique(tool[has_e]):
+            rows = numpy.flatnonzero(has_e & (tool == tool_id))
+            extrusion_pre[rows], extrusion_post[rows] = extrusion_positions(columns.E[rows], e_relative_pre[rows] & is_move[rows])
+
+            move_rows = rows[is_move[rows]]
+            if len(move_rows) > 0:
+                length = numpy.where(e_relative_pre[move_rows], columns.E[move_rows], columns.E[move_rows] - extrusion_pre[move_rows])
+                self.filament_usage[int(tool_id)] = float(numpy.cumsum(length)[-1])
+
+        moves = is_move & has_e
+        self.delta['E'] = numpy.where(moves, extrusion_post - extrusion_pre, 0.0)
+        self.travel['E'] = numpy.abs(self.delta['E'])
+        extruder_speed = numpy.asarray(conf.printer_extruder_speed, dtype = numpy.float64)[tool[moves]]
+        e_time = numpy.abs(extrusion_post[moves] - extrusion_pre[moves]) * 120.0 / (axis_speed(feed_pre[moves], extruder_speed) + axis_speed(feed_post[moves], extruder_speed))
+        move_runtime[moves] = numpy.maximum(move_runtime[moves], e_time)
+
+        self.runtime[is_move] = move_runtime[is_move]
+        for op, factor in GCodeAnalyzer.runtime_factors.items():
+            self.runtime[opcode == op] *= factor
+        self.cumulative_runtime = numpy.cumsum(self.runtime)
+        self.total_runtime = self.cumulative_runtime[-1] if count > 0 else 0.0
+
+    # Estimate for the tokens of the analyzer
+    @staticmethod
+    def from_analyzer(gcode_analyzer):
+        t_start = time.time()
+        estimate = GCodeEstimate(GCodeColumns.from_analyzer(gcode_analyzer))
+        t_end = time.time()
+        logger.debug("Estimated the runtime and filament usage [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - t_start))
+        return estimate
+
+# Values of the previous row (initial for the first one)
+def shift(values, initial):
+    result = numpy.empty_like(values)
+    if len(values) > 0:
+        result[0] = initial
+        result[1:] = values[:-1]
+    return result
+
+# Arcs of the moves from (x0, y0) with the move params (X/Y/I/J/R - NaN if not set)
+# Same as Arc.from_move for each row (to the last bit of NumPy arctan2/hypot): (defined, radius, start_angle, sweep)
+# - not defined: no I/J/R, R with the end at the start, zero radius
+def arc_moves(x0, y0, x, y, i, j, r, clockwise):
+    x1 = numpy.where(numpy.isnan(x), x0, x)
+    y1 = numpy.where(numpy.isnan(y), y0, y)
+
+    has_ij = ~numpy.isnan(i) | ~numpy.isnan(j)
+    has_r = ~has_ij & ~numpy.isnan(r) & ((x1 != x0) | (y1 != y0))
+    with numpy.errstate(invalid = 'ignore', divide = 'ignore'):
+        e = numpy.where(clockwise != (r < 0.0), -1.0, 1.0)
+        dx, dy = x1 - x0, y1 - y0
+        d = numpy.hypot(dx, dy)
+        h2 = (r - 0.5 * d) * (r + 0.5 * d)
+        h = numpy.where(h2 >= 0.0, numpy.sqrt(numpy.maximum(h2, 0.0)), 0.0)
+        center_x = numpy.where(has_ij, x0 + numpy.nan_to_num(i), (x0 + x1) * 0.5 - e * h * dy / d)
+        center_y = numpy.where(has_ij, y0 + numpy.nan_to_num(j), (y0 + y1) * 0.5 + e * h * dx / d)
+
+    radius = numpy.hypot(x0 - center_x, y0 - center_y)
+    defined = (has_ij | has_r) & (radius != 0.0)
+
+    start_angle = numpy.arctan2(y0 - center_y, x0 - center_x)
+    sweep = numpy.arctan2(y1 - center_y, x1 - center_x) - start_angle
+    sweep = numpy.where(sweep < 0.0, sweep + 2.0 * math.pi, sweep)
+    sweep = numpy.where(clockwise, sweep - 2.0 * math.pi, sweep)
+    sweep = numpy.where((sweep == 0.0) & (x1 == x0) & (y1 == y0), 2.0 * math.pi, sweep)
+    return defined, radius, start_angle, sweep
+
+# Total variation of the function (cos/sin) over [lo, hi] for each row - same as Arc.variation
+def variation(function, lo, hi, phase):
+    total = numpy.zeros(len(lo))
+    previous = function(lo)
+    k = numpy.floor((lo - phase) / math.pi) + 1
+    extreme = phase + k * math.pi < hi
+    while numpy.any(extreme):
+        value = numpy.where(extreme, function(phase + k * math.pi), previous)
+        total += numpy.abs(value - previous)
+        previous = value
+        k += 1
+        extreme &= phase + k * math.pi < hi
+    return total + numpy.abs(function(hi) - previous)
+
+# Move speed of the axis for the feed rate (NaN - feed rate not set)
+def axis_speed(feed_rate, limit):
+    return numpy.where(numpy.isnan(feed_rate), limit, numpy.minimum(feed_rate, limit))
+
+# Extruder positions (before, after) for the E values of one tool
+# - relative rows add to the position, the others set it
+# - summed in the same order as the analyzer (same results)
+def extrusion_positions(values, relative):
+    if numpy.all(relative):
+        post = numpy.cumsum(values)
+    else:
+        post = numpy.empty_like(values)
+        position = 0.0
+        for indx in range(len(values)):
+            position = position + values[indx] if relative[indx] else values[indx]
+            post[indx] = position
+    return shift(post, 0.0), post
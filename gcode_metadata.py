@@ -0,0 +1,107 @@
+import conf
+import gcode_analyzer
+import bgcode
+
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Metadata PrusaSlicer writes at the end of the GCode file
+# ; filament used [mm] = 1234.56,0.00        <- statistics
+# ; estimated printing time (normal mode) = 1h 2m 3s
+# ; prusaslicer_config = begin               <- config (same settings as the SLIC3R_ environment)
+# ; first_layer_temperature = 215,215
+# ; prusaslicer_config = end
+class GCodeMetadata:
+    def __init__(self, statistics = None, config = None):
+        self.statistics = statistics if statistics is not None else {}
+        self.config = config if config is not None else {}
+
+    # Parse the trailing comment lines
+    @staticmethod
+    def from_lines(lines):
+        metadata = GCodeMetadata()
+        in_config = False
+        for line in lines:
+            text = line.lstrip(';').strip()
+            if text == 'prusaslicer_config = begin':
+                in_config = True
+                continue
+            if text == 'prusaslicer_config = end':
+                in_config = False
+                continue
+
+            sep = text.find(' = ')
+            if sep == -1:
+                continue
+            if in_config:
+                metadata.config[text[0:sep]] = text[sep+3:]
+            else:
+                metadata.statistics[text[0:sep]] = text[sep+3:]
+        return metadata
+
+    # Parse the trailing comment tokens (the file has been parsed already)
+    @staticmethod
+    def from_tokens(tokens):
+        trailer = []
+        for token in reversed(tokens):
+            if token.type != gcode_analyzer.Token.COMMENT:
+                break
+            trailer.append(token.text)
+        return GCodeMetadata.from_lines(reversed(trailer))
+
+    # Binary GCode keeps the statistics and the config in the metadata blocks
+    @staticmethod
+    def from_bgcode(bgcode_file):
+        return GCodeMetadata(
+            statistics = dict(bgcode_file.print_metadata),
+            config = dict(bgcode_file.slicer_metadata))
+
+# Read the trailing comment block of the file
+# Seeks from the end of the file and reads back until the last non-comment line
+# (at most conf.metadata_tail_max_size bytes)
+def read_trailer(gcode_file, max_size = None):
+    if max_size is None:
+        max_size = conf.metadata_tail_max_size
+
+    block_size = 1 << 16
+    with open(gcode_file, mode='rb') as gcode_in:
+        end = gcode_in.seek(0, os.SEEK_END)
+        start = end
+        while True:
+            start = max(0, start - block_size)
+            gcode_in.seek(start)
+            lines = gcode_in.read(end - start).split(b'\n')
+            # First line might be incomplete (unless at the start of the file)
+            if start > 0:
+                lines = lines[1:]
+
+            # Walk back to the last GCode line
+            trailer = []
+            for line in reversed(lines):
+                line = line.strip()
+                if len(line) > 0 and not line.startswith(b';'):
+                    break
+                trailer.append(line.decode('utf8', errors = 'replace'))
+            else:
+                if start > 0 and end - start < max_size:
+                    continue
+                if start > 0:
+                    logger.warn("Trailing metadata block of {file} not found within {size} bytes".format(file = gcode_file, size = max_size))
+                    return []
+            return list(reversed(trailer))
+
+# Read the metadata of the file
+# - text GCode: the trailing comment block (tail seek, the file is not parsed)
+# - binary GCode: the metadata blocks
+# - compressed GCode: can't seek - the trailing comment tokens of the parsed file (empty if not parsed yet)
+def read_metadata(gcode_file, tokens = None):
+    if gcode_analyzer.compression_of(gcode_file) is not None:
+        if tokens is None:
+            logger.debug("Compressed GCode - the embedded slicer metadata needs the parsed tokens")
+            return GCodeMetadata()
+        return GCodeMetadata.from_tokens(tokens)
+    if bgcode.is_bgcode(gcode_file):
+        return GCodeMetadata.from_bgcode(bgcode.BGCodeFile(gcode_file))
+    return GCodeMetadata.from_lines(read_trailer(gcode_file))
@@ -0,0 +1,169 @@
+from gcode_analyzer import opcode_id, opcode_ids
+from gcode_columns import GCodeColumns, GCodeEstimate, GCodeColumnsException
+import conf
+
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Motion planner exception
+class MotionPlannerException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+# Machine limits (X/Y/Z/E) - RepRapFirmware style
+# - M201 max acceleration [mm/s^2]
+# - M203 max feed rate [mm/min]
+# - M566 max instantaneous speed change (jerk) [mm/min]
+class MotionLimits:
+    AXES = ('X', 'Y', 'Z', 'E')
+
+    def __init__(self, acceleration = None, feedrate = None, jerk = None):
+        self.acceleration = list(acceleration if acceleration is not None else conf.planner_max_acceleration)
+        self.feedrate = list(feedrate if feedrate is not None else conf.planner_max_feedrate)
+        self.jerk = list(jerk if jerk is not None else conf.planner_max_jerk)
+
+    # Update the limits from the M201/M203/M566 token
+    # - per extruder values (E1000:1000) - the first one is used
+    def configure(self, token):
+        limits = { 'M201' : self.acceleration, 'M203' : self.feedrate, 'M566' : self.jerk }[token.gcode]
+        for indx, axis in enumerate(MotionLimits.AXES):
+            if axis in token.param:
+                try:
+                    limits[indx] = float(str(token.param[axis]).split(':')[0])
+                except ValueError:
+                    logger.warn("Invalid {gcode} {axis} value: {value}".format(gcode = token.gcode, axis = axis, value = token.param[axis]))
+
+    # Limits configured by the tokens (in order)
+    @staticmethod
+    def from_tokens(tokens):
+        limits = MotionLimits()
+        for token in tokens:
+            limits.configure(token)
+        return limits
+
+# Lookahead motion planner - trapezoidal speed profiles
+# The moves are planned all at once with the array operations:
+# - speed of the move: feed rate limited by the max feed rate of each axis (scaled by the axis share)
+# - acceleration of the move: min of the axis accelerations (scaled by the axis share)
+# - junction speed: limited by the jerk of each axis (and the speeds of both moves),
+#   0 at the start/end and around the tokens that stop the motion (tool change, dwell, waits...)
+# - lookahead: the move has to be able to stop within the next planner_lookahead moves
+# - backward/forward passes (v^2 reachable with the acceleration over the move length)
+#   solved as the prefix minimums over the cumulative sums
+class MotionPlanner:
+    # Tokens that don't stop the motion (the comments don't either)
+    PASS_THROUGH = ('M104', 'M106', 'M107', 'M118', 'M140', 'M201', 'M203', 'M204', 'M220', 'M221', 'M566', 'M900')
+
+    def __init__(self, limits = None, lookahead = None):
+        if numpy is None:
+            raise MotionPlannerException("NumPy is required for the motion planner")
+        self.limits = limits if limits is not None else MotionLimits()
+        self.lookahead = lookahead if lookahead is not None else conf.planner_lookahead
+
+    # Runtimes of the rows
+    # - moves are planned, the other rows keep the estimate runtimes
+    def runtimes(self, columns, estimate):
+        runtime = estimate.runtime.copy()
+
+        # Moves that move
+        delta = numpy.stack([estimate.delta[axis] for axis in MotionLimits.AXES], axis = 1)
+        travel = numpy.stack([estimate.travel[axis] for axis in MotionLimits.AXES], axis = 1)
+        length = numpy.where(estimate.length > 0.0, estimate.length, numpy.abs(delta[:, 3]))
+        rows = numpy.flatnonzero(estimate.is_move & (length > 0.0))
+        runtime[estimate.is_move] = 0.0
+        if len(rows) == 0:
+            return runtime
+
+        # Arcs - the junctions use the chord direction, the limits the share of the axes along the arc
+        length = length[rows]
+        direction = delta[rows] / length[:, None]
+        share = travel[rows] / length[:, None]
+
+        # Max speed and acceleration of the moves [mm/s, mm/s^2]
+        with numpy.errstate(divide = 'ignore'):
+            axis_speed = numpy.min(numpy.asarray(self.limits.feedrate) / 60.0 / share, axis = 1)
+            acceleration = numpy.min(numpy.asarray(self.limits.acceleration) / share, axis = 1)
+        feed_rate = estimate.feed_rate[rows] / 60.0
+        speed = numpy.where(numpy.isnan(feed_rate), axis_speed, numpy.minimum(feed_rate, axis_speed))
+
+        # Junction speeds (squared) - entry speed of each move
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            change = numpy.abs(direction[1:] - direction[:-1])
+            junction = numpy.min(numpy.asarray(self.limits.jerk) / 60.0 / change, axis = 1)
+        junction = numpy.minimum(junction, numpy.minimum(speed[1:], speed[:-1]))
+
+        # Motion stops between the moves
+        stops = ~(estimate.is_move | self.pass_through(columns))
+        stops_count = numpy.cumsum(stops)[rows]
+        junction[stops_count[1:] != stops_count[:-1]] = 0.0
+
+        entry = numpy.zeros(len(rows) + 1)
+        entry[1:-1] = junction ** 2
+
+        # Stopping distance - v^2 = 2 * a * d
+        reach = 2.0 * acceleration * length
+        reach_sum = numpy.concatenate(([0.0], numpy.cumsum(reach)))
+
+        # Has to stop within the lookahead
+        window_end = numpy.minimum(numpy.arange(len(rows) + 1) + self.lookahead, len(rows))
+        entry = numpy.minimum(entry, reach_sum[window_end] - reach_sum)
+
+        # Backward pass - entry[i] <= entry[i+1] + reach[i]
+        suffix = reach_sum[-1] - reach_sum
+        entry = suffix + numpy.minimum.accumulate((entry - suffix)[::-1])[::-1]
+        # Forward pass - entry[i+1] <= entry[i] + reach[i]
+        entry = reach_sum + numpy.minimum.accumulate(entry - reach_sum)
+
+        # Trapezoid (or triangle if the cruise speed is not reached)
+        v0 = numpy.sqrt(numpy.maximum(entry[:-1], 0.0))
+        v1 = numpy.sqrt(numpy.maximum(entry[1:], 0.0))
+        v0 = numpy.minimum(v0, speed)
+        v1 = numpy.minimum(v1, speed)
+        accelerate = (speed ** 2 - v0 ** 2) / (2.0 * acceleration)
+        decelerate = (speed ** 2 - v1 ** 2) / (2.0 * acceleration)
+        cruise = length - accelerate - decelerate
+
+        peak = numpy.minimum(numpy.sqrt((reach + v0 ** 2 + v1 ** 2) / 2.0), speed)
+        peak = numpy.maximum(peak, numpy.maximum(v0, v1))
+        runtime[rows] = numpy.where(cruise >= 0.0,
+            (speed - v0) / acceleration + (speed - v1) / acceleration + numpy.maximum(cruise, 0.0) / speed,
+            (peak - v0) / acceleration + (peak - v1) / acceleration)
+        return runtime
+
+    # Rows that don't stop the motion
+    def pass_through(self, columns):
+        ids = [opcode_id(name) for name in MotionPlanner.PASS_THROUGH]
+        ids += [op for name, op in opcode_ids.items() if name.startswith(';')]
+        return numpy.isin(columns.opcode, ids)
+
+# Plan the runtimes of the analyzed tokens
+# - token.runtime and the total runtime of the analyzer are replaced by the planned ones
+#   (until the next analysis)
+# - keeps the analyzer runtimes (returns None) if the columnar estimate can't model the file
+def plan_runtimes(gcode_analyzer):
+    t_start = time.time()
+
+    columns = GCodeColumns.from_analyzer(gcode_analyzer)
+    try:
+        estimate = GCodeEstimate(columns)
+    except GCodeColumnsException as columns_err:
+        logger.warn("Motion planner skipped, using the analyzer runtimes - {message}".format(message = columns_err.message))
+        return None
+    limits = MotionLimits.from_tokens(columns.tokens(columns.select('M201', 'M203', 'M566')))
+    runtime = MotionPlanner(limits).runtimes(columns, estimate)
+
+    for token, token_runtime in zip(columns.rows, runtime.tolist()):
+        token.runtime = token_runtime
+    gcode_analyzer.total_runtime = float(numpy.sum(runtime))
+
+    t_end = time.time()
+    logger.info("Planned the move runtimes - estimate {simple:0.0f}s, planned {planned:0.0f}s [elapsed: {elapsed:0.2f}s]".format(
+        simple = estimate.total_runtime, planned = gcode_analyzer.total_runtime, elapsed = t_end - t_start))
+    return runtime
@@ -0,0 +1,145 @@
+import conf
+import gcode_analyzer
+import gcode_metadata
+import bgcode
+
+import os, re, mmap, time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Lines the preflight cares about - tool changes, layer changes and tool blocks
+preflight_pattern = re.compile(
+    rb'^[ \t]*(?:T(-?\d+)|;;AFTER_LAYER_CHANGE:(-?\d+),([-+.\d]+)|;;TOOL_BLOCK_(START|END):(-?\d+))',
+    re.MULTILINE)
+
+# Layer summary - same layout as tool_change_plan.LayerInfo but with plain tool ids
+class PreflightLayerInfo:
+    def __init__(self, layer_num = 0, layer_z = 0.0, layer_height = 0.0):
+        self.layer_num = layer_num
+        self.layer_z = layer_z
+        self.layer_height = layer_height
+        self.tool_change_seq = []       # Tools activated in the layer
+        self.tools_sequence = []        # Tools printing in the layer (including the one carried over)
+        self.tool_blocks = []           # Tools of the TOOL_BLOCK_START blocks
+
+    def to_dict(self):
+        return {
+            'layer' : self.layer_num,
+            'z' : self.layer_z,
+            'height' : self.layer_height,
+            'tool_changes' : self.tool_change_seq,
+            'tools' : self.tools_sequence,
+            'tool_blocks' : self.tool_blocks }
+
+# Job summary
+class PreflightReport:
+    def __init__(self, gcode_file):
+        self.gcode_file = gcode_file
+        self.tools = set()
+        self.layers = [PreflightLayerInfo()]
+        self.estimated_time = None
+        self.elapsed = 0.0
+
+    def to_dict(self):
+        return {
+            'file' : self.gcode_file,
+            'tools' : sorted(self.tools),
+            'layer_count' : len(self.layers),
+            'layers' : [layer_info.to_dict() for layer_info in self.layers],
+            'estimated_time' : self.estimated_time,
+            'elapsed' : round(self.elapsed, 4) }
+
+# Scan the chunks of the file (each chunk has to end at the line end)
+# Follows the layer/tool bookkeeping of PrimeTower.analyze_gcode
+def scan_chunks(report, chunks):
+    current_tool = None
+    layer_info = report.layers[-1]
+
+    for chunk in chunks:
+        for match in preflight_pattern.finditer(chunk):
+            tool, layer, layer_z, block, block_tool = match.groups()
+
+            if tool is not None:
+                tool_id = int(tool)
+                if tool_id != -1:
+                    current_tool = tool_id
+                    report.tools.add(tool_id)
+                    layer_info.tool_change_seq.append(tool_id)
+                    layer_info.tools_sequence.append(tool_id)
+            elif layer is not None:
+                current_layer, current_layer_z = int(layer), float(layer_z)
+                previous_layer_z = 0.0
+                # First tool is selected before the first AFTER_LAYER_CHANGE
+                if current_layer != 0:
+                    previous_layer_z = layer_info.layer_z
+                    layer_info = PreflightLayerInfo()
+                    report.layers.append(layer_info)
+
+                layer_info.layer_num = current_layer
+                layer_info.layer_z = current_layer_z
+                layer_info.layer_height = current_layer_z - previous_layer_z
+                layer_info.tools_sequence = [current_tool] if current_tool is not None else []
+            elif block == b'START' and int(block_tool) != -1:
+                layer_info.tool_blocks.append(int(block_tool))
+
+# Align the chunks (text or bytes) to the line ends
+def line_chunks(chunks):
+    pending = b''
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf8')
+        chunk = pending + chunk
+        line_end = chunk.rfind(b'\n') + 1
+        pending = chunk[line_end:]
+        yield chunk[0:line_end]
+    yield pending
+
+# Keep the trailing comment block of the chunks in the trailer (the lines after the last GCode line so far)
+# - compressed GCode can't seek to its end, the chunks are walked back only to their last GCode line
+def keep_trailer(chunks, trailer):
+    for chunk in chunks:
+        lines = []
+        found = False
+        end = len(chunk) - 1 if chunk.endswith(b'\n') else len(chunk)
+        while end >= 0:
+            start = chunk.rfind(b'\n', 0, end) + 1
+            line = chunk[start:end].strip()
+            if len(line) > 0 and not line.startswith(b';'):
+                found = True
+                break
+            lines.append(line.decode('utf8', errors = 'replace'))
+            end = start - 1
+        if found:
+            trailer.clear()
+        trailer.extend(reversed(lines))
+        yield chunk
+
+# Scan the file without parsing it (no tokens or states are built)
+# - plain text is memory mapped and scanned in one go
+# - compressed and binary GCode are scanned as they are decoded
+def preflight(gcode_file):
+    t_start = time.time()
+    report = PreflightReport(gcode_file)
+
+    metadata = None
+    if gcode_analyzer.compression_of(gcode_file) is not None:
+        trailer = []
+        with gcode_analyzer.open_gcode(gcode_file) as gcode_in:
+            scan_chunks(report, keep_trailer(line_chunks(iter(lambda: gcode_in.read(conf.parse_chunk_size), '')), trailer))
+        metadata = gcode_metadata.GCodeMetadata.from_lines(trailer)
+    elif bgcode.is_bgcode(gcode_file):
+        bgcode_file = bgcode.BGCodeFile(gcode_file)
+        scan_chunks(report, line_chunks(bgcode_file.gcode_chunks()))
+    elif os.path.getsize(gcode_file) > 0:
+        with open(gcode_file, mode='rb') as gcode_in:
+            with mmap.mmap(gcode_in.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                scan_chunks(report, [data])
+
+    if metadata is None:
+        metadata = gcode_metadata.read_metadata(gcode_file)
+    report.estimated_time = metadata.statistics.get('estimated printing time (normal mode)')
+
+    report.elapsed = time.time() - t_start
+    logger.debug("Preflight of {file} done [elapsed: {elapsed:0.3f}s]".format(file = gcode_file, elapsed = report.elapsed))
+    return report
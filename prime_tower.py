@@ -3,6 +3,8 @@ from gcode_analyzer import Token
 import tool_change_plan
 import gcode_analyzer
 import doublelinkedlist
+import edit_overlay
+import token_visitor
 import conf
 import copy, math, time, logging
 from collections import deque
@@ -111,6 +113,17 @@ class PrimeTowerLayerInfo(LayerInfo):
 
         return tokens
 
+    # Vertices of the move walking back from its end to its start point (x1, y1)
+    # - arcs (G2/G3) are split into the segments of conf.arc_segment_length
+    def wipe_vertices(self, move, x1, y1):
+        if move.type != Token.GCODE or move.op not in gcode_analyzer.GCodeAnalyzer.arc_opcodes or x1 is None or y1 is None:
+            return [(x1, y1)]
+        arc = gcode_analyzer.Arc.from_move(x1, y1, move.param.numbers(), gcode_analyzer.GCodeAnalyzer.arc_opcodes[move.op])
+        if arc is None:
+            return [(x1, y1)]
+        points = arc.points(conf.arc_segment_length)
+        return list(reversed(points[:-1])) + [(x1, y1)]
+
     # Find wipe end point
     def gcode_wipe_path(self, start_point, length, retract_length):
         path = []
@@ -126,20 +139,25 @@ class PrimeTowerLayerInfo(LayerInfo):
             if z1 != z0:
                 break
 
-            dist = math.sqrt((x1-x0)**2 + (y1-y0)**2)
+            # Arcs are followed back through the points along the arc
+            for x1, y1 in self.wipe_vertices(previous_move, x1, y1):
+                if accumulated_dist >= length:
+                    break
+
+                dist = math.sqrt((x1-x0)**2 + (y1-y0)**2)
 
-            # If end
-            if dist + accumulated_dist > length:
-                # Check cutoff
-                dist_corrected = length - accumulated_dist
-                x1 = x0 + (x1 - x0) * (dist_corrected / dist)
-                y1 = y0 + (y1 - y0) * (dist_corrected / dist)
-                dist = dist_corrected
+                # If end
+                if dist + accumulated_dist > length:
+                    # Check cutoff
+                    dist_corrected = length - accumulated_dist
+                    x1 = x0 + (x1 - x0) * (dist_corrected / dist)
+                    y1 = y0 + (y1 - y0) * (dist_corrected / dist)
+                    dist = dist_corrected
 
-            if dist != 0.0:
-                accumulated_dist += dist
-                x0, y0 = x1, y1
-                path.append((x1, y1, dist))
+                if dist != 0.0:
+                    accumulated_dist += dist
+                    x0, y0 = x1, y1
+                    path.append((x1, y1, dist))
 
             if previous_move.prev is not None:
                 previous_move = previous_move.prev
@@ -158,7 +176,7 @@ class PrimeTowerLayerInfo(LayerInfo):
             logger.info("Calculated wipe path: {length}".format(length = accumulated_dist))
         else:
             # Just add retraction
-            gcode.append_node(gcode_analyzer.GCode('G1', {'E', -retract_length}))
+            gcode.append_node(gcode_analyzer.GCode('G1', {'E' : -retract_length}))
 
         gcode.head.comment = "wipe start"
 
@@ -207,8 +225,8 @@ class PrimeTowerLayerInfo(LayerInfo):
             if inject_state.is_retracted:
                 move_z = self.layer_z + conf.retraction_zhop[inject_state.tool_selected]
                 if move_z > inject_state.z:
-                    gcode_pre.append_node(gcode_analyzer.GCode('G1', {'F', conf.prime_tower_move_speed}))
-                    gcode_pre.append_node(gcode_analyzer.GCode('G1', {'Z', move_z }))
+                    gcode_pre.append_node(gcode_analyzer.GCode('G1', {'F' : conf.prime_tower_move_speed}))
+                    gcode_pre.append_node(gcode_analyzer.GCode('G1', {'Z' : move_z }))
             else:
                 # Need to retract and Z-hop
                 move_z = max(inject_state.z, self.layer_z) + conf.retraction_zhop[inject_state.tool_selected]
@@ -222,11 +240,11 @@ class PrimeTowerLayerInfo(LayerInfo):
                 else:
                     gcode_pre.append_node(gcode_analyzer.GCode('G1', {'E' : -conf.retraction_length[inject_state.tool_selected]}))
 
-                gcode_pre.append_node(gcode_analyzer.GCode('G1', {'F', conf.prime_tower_move_speed}))
-                gcode_pre.append_node(gcode_analyzer.GCode('G1', {'Z', move_z }))
+                gcode_pre.append_node(gcode_analyzer.GCode('G1', {'F' : conf.prime_tower_move_speed}))
+                gcode_pre.append_node(gcode_analyzer.GCode('G1', {'Z' : move_z }))
 
             # Add the speed
-            gcode_pre.append_node(gcode_analyzer.GCode('G1', {'F', conf.prime_tower_move_speed}))
+            gcode_pre.append_node(gcode_analyzer.GCode('G1', {'F' : conf.prime_tower_move_speed}))
 
             gcode_post = doublelinkedlist.DLList()
             gcode_post.append_node(gcode_analyzer.GCode('G1', {'Z' : self.layer_z, 'E' : conf.retraction_length[inject_state.tool_selected]}))
@@ -301,7 +319,7 @@ class PrimeTowerLayerInfo(LayerInfo):
         return gcode
 
     # Inject prime tower layer gcode
-    def inject_gcode(self):
+    def inject_gcode(self, edits):
         
         filled_idle_gaps = False
 
@@ -357,7 +375,7 @@ class PrimeTowerLayerInfo(LayerInfo):
             # Info
             gcode.head.append_node_left(gcode_analyzer.Comment("prime-tower layer #{layer_num}".format(layer_num = self.layer_num)))
 
-            inject_point.append_nodes_right(gcode)
+            edits.insert_after(inject_point, gcode)
             logger.debug("(DEBUG) Generated prime tower band for layer #{layer} for T{tool}".format(layer = self.layer_num, tool = tool_change.tool_id))
 
             tool_indx += 1
@@ -365,7 +383,7 @@ class PrimeTowerLayerInfo(LayerInfo):
 ###########################################################################################################
 # Prime Tower 
 # Contains all the information related to prime tower generation
-class PrimeTower:
+class PrimeTower(token_visitor.TokenVisitor):
 
     def __init__(self, layers = None):
         pass
@@ -449,85 +467,96 @@ class PrimeTower:
 
     # Generate the layers for prime tower printing
     def analyze_gcode(self, gcode_analyzer):
-        self.layers = [PrimeTowerLayerInfo(prime_tower = self)]
+        token_visitor.traverse(gcode_analyzer, [self])
+        return True
 
-        t_start = time.time()
-
-        # Active tool
-        current_tool = None            # Tool Change Info
-        layer_info = self.layers[-1]   # Layer Info
-        for token in gcode_analyzer.analyze_state():
-            # Check if AFTER_LAYER_CHANGE label
-            if token.type == Token.PARAMS and token.label == 'AFTER_LAYER_CHANGE':
-                current_layer, current_layer_z = token.param[0], token.param[1]
-                previous_layer_z = 0.0
-                # This is because will put first tool before the AFTER_LAYER_CHANGE-BEFORE_LAYER_CHANGE block
-                if current_layer != 0:
-                    previous_layer_z = layer_info.layer_z
-                    layer_info = PrimeTowerLayerInfo(prime_tower = self)
-                    self.layers.append(layer_info)
-             
-                # Update the value
-                layer_info.layer_num = current_layer
-                layer_info.layer_z = current_layer_z
-                layer_info.layer_height = current_layer_z - previous_layer_z
-             
-                # Update the values
-                layer_info.layer_start = token
-
-                # If current tool is not none 
-                if current_tool is not None:
-                    self.layers[-1].tools_sequence = [current_tool]
-                else:
-                    self.layers[-1].tools_sequence = []
-
-                continue
-
-            # Check if BEFORE_LAYER_CHANGE label
-            if token.type == Token.PARAMS and token.label == 'BEFORE_LAYER_CHANGE':
-                # Mark the last layer end as the token before BEFORE_LAYER_CHANGE
-                layer_info.layer_end = token
-
-                # Validate the height
-                toolset = [tool_change_info.tool_id for tool_change_info in layer_info.tools_sequence]
-                toolset_max_layer_height = conf.max_layer_height(toolset)
-
-                # Layer height higher then max for the toolset (shouldn't happen!)
-                if round(layer_info.layer_height, 5) > toolset_max_layer_height:
-                    raise PrimeTowerException("Input layer #{layer_num} height {layer_height:0.4f} higher then max allowed for the toolset {tools}".format(
-                        layer_num = layer_info.layer_num,
-                        layer_height = layer_info.layer_height, 
-                        tools = ','.join(['T' + str(tool_id) for tool_id in toolset])))
-                continue
-
-            # Check if Tool change
-            if token.type == Token.TOOLCHANGE:
-                if token.next_tool != -1:
-                    current_tool = ToolChangeInfo(tool_change = token)
-                    logger.debug("PrimeTower - Added tool T{tool_id} to layer #{layer_num}".format(tool_id = token.next_tool, layer_num = self.layers[-1].layer_num))
-
-                    layer_info.tool_change_seq.append(current_tool)
-                    layer_info.tools_sequence.append(current_tool)
-                continue
-
-            # Beginning to Tool block
-            if token.type == Token.PARAMS and token.label == 'TOOL_BLOCK_START':
-                tool_id = token.param[0]
-                if tool_id != -1:
-                    if tool_id != current_tool.tool_id:
-                        raise ToolChangeException(message = "Tool id {tool_id} from TOOL_BLOCK_START doesn't match last active tool in layer".format(tool_id = tool_id), tool_id = tool_id)
-                    current_tool.block_start = token
-                continue
-
-            # End of Tool block
-            if token.type == Token.PARAMS and token.label == 'TOOL_BLOCK_END':
-                tool_id = token.param[0]
-                if tool_id != -1:
-                    if tool_id != current_tool.tool_id:
-                        raise ToolChangeException(message = "Tool id {tool_id} from TOOL_BLOCK_END doesn't match last active tool in layer".format(tool_id = tool_id), tool_id = tool_id)
-                    current_tool.block_end = token
-                continue
-            
+    # Visitor of the tokens (token_visitor.TokenVisitor)
+    def handlers(self):
+        return {
+            ';;AFTER_LAYER_CHANGE'  : self.visit_layer_start,
+            ';;BEFORE_LAYER_CHANGE' : self.visit_layer_end,
+            'T'                     : self.visit_tool_change,
+            ';;TOOL_BLOCK_START'    : self.visit_block_start,
+            ';;TOOL_BLOCK_END'      : self.visit_block_end }
+
+    def begin(self, gcode_analyzer):
+        self.layers = [PrimeTowerLayerInfo(prime_tower = self)]
+        self.t_start = time.time()
+
+        self.current_tool = None                # Tool Change Info
+        self.current_layer = self.layers[-1]    # Layer Info
+
+    # AFTER_LAYER_CHANGE label
+    def visit_layer_start(self, token):
+        layer_info = self.current_layer
+        current_layer, current_layer_z = token.param[0], token.param[1]
+        previous_layer_z = 0.0
+        # This is because will put first tool before the AFTER_LAYER_CHANGE-BEFORE_LAYER_CHANGE block
+        if current_layer != 0:
+            previous_layer_z = layer_info.layer_z
+            layer_info = PrimeTowerLayerInfo(prime_tower = self)
+            self.layers.append(layer_info)
+            self.current_layer = layer_info
+     
+        # Update the value
+        layer_info.layer_num = current_layer
+        layer_info.layer_z = current_layer_z
+        layer_info.layer_height = current_layer_z - previous_layer_z
+     
+        # Update the values
+        layer_info.layer_start = token
+
+        # If current tool is not none 
+        if self.current_tool is not None:
+            self.layers[-1].tools_sequence = [self.current_tool]
+        else:
+            self.layers[-1].tools_sequence = []
+
+    # BEFORE_LAYER_CHANGE label
+    def visit_layer_end(self, token):
+        layer_info = self.current_layer
+        # Mark the last layer end as the token before BEFORE_LAYER_CHANGE
+        layer_info.layer_end = token
+
+        # Validate the height
+        toolset = [tool_change_info.tool_id for tool_change_info in layer_info.tools_sequence]
+        toolset_max_layer_height = conf.max_layer_height(toolset)
+
+        # Layer height higher then max for the toolset (shouldn't happen!)
+        if round(layer_info.layer_height, 5) > toolset_max_layer_height:
+            raise PrimeTowerException("Input layer #{layer_num} height {layer_height:0.4f} higher then max allowed for the toolset {tools}".format(
+                layer_num = layer_info.layer_num,
+                layer_height = layer_info.layer_height, 
+                tools = ','.join(['T' + str(tool_id) for tool_id in toolset])))
+
+    # Tool change
+    def visit_tool_change(self, token):
+        if token.next_tool != -1:
+            self.current_tool = ToolChangeInfo(tool_change = token)
+            logger.debug("PrimeTower - Added tool T{tool_id} to layer #{layer_num}".format(tool_id = token.next_tool, layer_num = self.layers[-1].layer_num))
+
+            self.current_layer.tool_change_seq.append(self.current_tool)
+            self.current_layer.tools_sequence.append(self.current_tool)
+
+    # Beginning to Tool block
+    def visit_block_start(self, token):
+        tool_id = token.param[0]
+        if tool_id != -1:
+            if tool_id != self.current_tool.tool_id:
+                raise ToolChangeException(message = "Tool id {tool_id} from TOOL_BLOCK_START doesn't match last active tool in layer".format(tool_id = tool_id), tool_id = tool_id)
+            self.current_tool.block_start = token
+
+    # End of Tool block
+    def visit_block_end(self, token):
+        tool_id = token.param[0]
+        if tool_id != -1:
+            if tool_id != self.current_tool.tool_id:
+                raise ToolChangeException(message = "Tool id {tool_id} from TOOL_BLOCK_END doesn't match last active tool in layer".format(tool_id = tool_id), tool_id = tool_id)
+            self.current_tool.block_end = token
+
+    def end(self, gcode_analyzer):
+        self.current_tool = None
+        self.current_layer = None
 
         # Generate the active/idle/disabled list
         #-----------------------------------------------------------
@@ -537,9 +566,7 @@ class PrimeTower:
         self.generate_pillar_bands()
 
         t_end = time.time()
-        logger.info("PrimeTower: analysis done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - t_start))
-
-        return True
+        logger.info("PrimeTower: analysis done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - self.t_start))
 
     # Optimize the layers of prime tower
     # Squish the layers of prime tower following the rules:
@@ -615,10 +642,13 @@ class PrimeTower:
         return True
 
     # Inject code into the token list
-    def inject_gcode(self):
+    # - edits : where the GCode goes
+    def inject_gcode(self, edits = None):
+        edits = edit_overlay.edits_or_in_place(edits)
+
         # Inject code for all layers
         for layer in self.layers:
-            layer.inject_gcode()
+            layer.inject_gcode(edits)
 
     # Generate report on the prime tower composition
     def print_report(self):
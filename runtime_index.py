@@ -0,0 +1,181 @@
+import bisect, time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Position of the first token not before the label in the tokens (sorted by the order labels)
+def bisect_order(tokens, order):
+    lo = 0
+    hi = len(tokens)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if tokens[mid].order < order:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+# Block of the consecutive tokens
+class RuntimeIndexBlock:
+    __slots__ = ('tokens', 'runtime', 'index')
+
+    def __init__(self, tokens = None):
+        self.tokens = tokens if tokens is not None else []
+        self.runtime = sum([token.runtime for token in self.tokens])
+        self.index = None
+
+# Cumulative runtime index over the token list
+# - the tokens are kept in blocks, the blocks keep their runtime sums
+# - the prefix sums of the blocks are rebuilt on the next lookup after a block runtime changes
+#   (lookup - binary search over the blocks and a walk within one block)
+# - follows the insertions/removals of the list (listener), the inserted tokens use their runtime at insertion
+#   (the tokens and the blocks are located by the order labels of the list - binary search)
+# - the runtimes are taken when indexed - analyzing the tokens again needs a new index
+class RuntimeIndex:
+    BLOCK_SIZE = 256
+
+    def __init__(self, tokens):
+        t_start = time.time()
+
+        self.tokens = tokens
+        self.blocks = []
+        self.block_of = {}
+        self.starts = None
+
+        block = None
+        for token in tokens:
+            if block is None or len(block.tokens) >= RuntimeIndex.BLOCK_SIZE:
+                block = RuntimeIndexBlock()
+                self.blocks.append(block)
+            block.tokens.append(token)
+            block.runtime += token.runtime
+            self.block_of[token] = block
+
+        tokens.listeners.append(self)
+
+        t_end = time.time()
+        logger.debug("Runtime index - {blocks} blocks [elapsed: {elapsed:0.2f}s]".format(blocks = len(self.blocks), elapsed = t_end - t_start))
+
+    # Stop following the list
+    def close(self):
+        self.tokens.listeners.remove(self)
+
+    # Prefix sums of the blocks
+    def rebuild(self):
+        starts = []
+        total = 0.0
+        for indx, block in enumerate(self.blocks):
+            block.index = indx
+            starts.append(total)
+            total += block.runtime
+        self.starts = starts
+
+    # Runtime of the tokens before the token
+    def elapsed(self, token):
+        if self.starts is None:
+            self.rebuild()
+        block = self.block_of[token]
+        elapsed = self.starts[block.index]
+        for block_token in block.tokens:
+            if block_token is token:
+                break
+            elapsed += block_token.runtime
+        return elapsed
+
+    # Runtime of the tokens between the two tokens (both excluded)
+    def time_between(self, token_from, token_to):
+        return self.elapsed(token_to) - self.elapsed(token_from) - token_from.runtime
+
+    # Closest token before the token with at least duration of runtime from it to the token
+    # (its runtime included) - None if the list starts sooner
+    def token_before(self, token, duration):
+        target = self.elapsed(token) - duration
+        if target < 0.0:
+            return None
+
+        indx = bisect.bisect_right(self.starts, target) - 1
+        elapsed = self.starts[indx]
+        found = None
+        for block_token in self.blocks[indx].tokens:
+            if elapsed > target:
+                break
+            found = block_token
+            elapsed += block_token.runtime
+        return found
+
+    # Index of the block with the label (the last block starting at or before it, -1 if none)
+    def block_position(self, order):
+        lo = 0
+        hi = len(self.blocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.blocks[mid].tokens[0].order <= order:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1
+
+    # List listener
+    def node_inserted(self, token):
+        if token.prev is not None and token.prev in self.block_of:
+            block = self.block_of[token.prev]
+        elif token.next is not None and token.next in self.block_of:
+            block = self.block_of[token.next]
+        else:
+            block = None
+
+        if block is not None:
+            block.tokens.insert(bisect_order(block.tokens, token.order), token)
+        else:
+            block = RuntimeIndexBlock()
+            block.tokens.append(token)
+            self.blocks.insert(self.block_position(token.order) + 1, block)
+            self.starts = None
+        self.block_of[token] = block
+
+        if token.runtime != 0.0:
+            block.runtime += token.runtime
+            self.starts = None
+
+        # Split the block
+        if len(block.tokens) >= 2 * RuntimeIndex.BLOCK_SIZE:
+            split = RuntimeIndexBlock(block.tokens[RuntimeIndex.BLOCK_SIZE:])
+            del block.tokens[RuntimeIndex.BLOCK_SIZE:]
+            block.runtime -= split.runtime
+            for split_token in split.tokens:
+                self.block_of[split_token] = split
+            self.blocks.insert(self.block_position(block.tokens[0].order) + 1, split)
+            self.starts = None
+
+    # The chain is indexed token by token (the labels of the list are validated first)
+    def range_inserted(self, first, last, count):
+        self.tokens.validate_order()
+        token = first
+        while True:
+            self.node_inserted(token)
+            if token is last:
+                break
+            token = token.next
+
+    def node_removed(self, token, next_token):
+        block = self.block_of.pop(token, None)
+        if block is None:
+            return
+        if len(block.tokens) == 1:
+            del self.blocks[self.block_position(token.order)]
+            self.starts = None
+        del block.tokens[self.position(block, token)]
+        if token.runtime != 0.0:
+            block.runtime -= token.runtime
+            self.starts = None
+
+    def node_changed(self, token):
+        pass
+
+    # Position of the token in the block (by its order label)
+    @staticmethod
+    def position(block, token):
+        indx = bisect_order(block.tokens, token.order)
+        if indx < len(block.tokens) and block.tokens[indx] is token:
+            return indx
+        raise ValueError("Token not in the runtime index block")
@@ -1,7 +1,7 @@
 # PRUSA SLICER tool changer post processing script
 # Written by Marcin Kudzia 
 # https://github.com/mkudzia84
-import sys, os, time, math, traceback
+import sys, os, time, math, json, traceback
 from collections import deque 
 
 import conf
@@ -10,6 +10,12 @@ import tool_change_plan
 import prime_tower
 import thermal_control
 import pcf_control
+import bgcode
+import gcode_metadata
+import preflight
+import calibration
+import edit_overlay
+import token_visitor
 
 import logging, logging.config
 logging.config.fileConfig(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'logger.conf'))
@@ -18,21 +24,53 @@ logging.config.fileConfig(os.path.join(os.path.dirname(os.path.realpath(__file__
 def tool_filament_names(layer_info):
     return '_'.join(["T{tool_id}-{filament}".format(tool_id = tool, filament = conf.filament_type[tool]) for tool in (layer_info.tools_active | layer_info.tools_idle)])
 
+# Read the settings (before the analysis)
+def configure(metadata):
+    conf.slic3r_config_read(metadata.config)
+    conf.slic3r_config_validate(metadata.config)
+
+    # Calibrated runtime estimates
+    if conf.calibration_profile is not None:
+        calibration.CalibrationProfile.load(conf.calibration_profile).apply()
+
 def main():
-    if len(sys.argv) < 2:
+    if len(sys.argv) < 2 or (sys.argv[1] == '--preflight' and len(sys.argv) < 3) or (sys.argv[1] == '--calibrate' and len(sys.argv) < 5):
         logging.info("Usage: tcpspp.py [filename.gcode]")
+        logging.info("       tcpspp.py --preflight [filename.gcode]  - print the job summary (JSON)")
+        logging.info("       tcpspp.py --calibrate [printed.gcode] [printer.log] [profile.json]  - fit the runtime calibration profile")
+        return
+
+    # Quick scan of the job - no processing
+    # (stdout only has the JSON - the log goes to stderr)
+    if sys.argv[1] == '--preflight':
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.StreamHandler):
+                handler.setStream(sys.stderr)
+        print(json.dumps(preflight.preflight(sys.argv[2]).to_dict(), indent = 2))
+        return
+
+    # Fit the runtime correction factors to the durations logged while printing the (post-processed) file
+    if sys.argv[1] == '--calibrate':
+        profile = calibration.calibrate(sys.argv[2], sys.argv[3], printer = os.path.splitext(os.path.basename(sys.argv[4]))[0])
+        profile.save(sys.argv[4])
+        logging.info("Calibration profile written to {filename}".format(filename = sys.argv[4]))
         return
         
     t_start = time.time()
 
     filename = sys.argv[1]
 
-    conf.slic3r_config_read()
-    conf.slic3r_config_validate()
+    # Settings embedded in the file - used when not run by PrusaSlicer
+    # (compressed file can't be seeked - the settings are read from the parsed tokens)
+    compressed = gcode_analyzer.compression_of(filename) is not None
+    if not compressed:
+        configure(gcode_metadata.read_metadata(filename))
 
     logging.info("-----------------------------------------")
     logging.info(" TC-PSPP : Parsing the file              ")
     gcode = gcode_analyzer.GCodeAnalyzer(filename)
+    if compressed:
+        configure(gcode_metadata.read_metadata(filename, gcode.tokens))
 
     logging.info("Validating the GCode...")
     validator = gcode_analyzer.GCodeValidator()
@@ -50,19 +88,29 @@ def main():
     tower.print_report()
     
     logging.info(" - Injecting Prime Tower GCode")
-    tower.inject_gcode()
+    # The thermal analysis estimates the runtimes with the tower in the token list
+    tower_edits = edit_overlay.EditOverlay(gcode.tokens)
+    tower.inject_gcode(tower_edits)
+    tower_edits.apply()
 
     logging.info(" TC-PSPS : Optimizing toolhead thermals")
+    # Thermal and PCF analysis in one pass over the tokens
     temp_controller = thermal_control.TemperatureController()
-    temp_controller.analyze_gcode(gcode)
+    pcf_controller = pcf_control.PartCoolingFanController()
+    token_visitor.traverse(gcode, [temp_controller, pcf_controller])
+
+    # Passes below only record the edits - merged into the token list when writing the file
+    edits = edit_overlay.EditOverlay(gcode.tokens)
 
     logging.info(" - Injecting Thermal Mangment GCode")
-    temp_controller.inject_gcode()
+    temp_controller.inject_gcode(edits)
 
     logging.info(" - Injecting PCF control GCode")
-    pcf_controller = pcf_control.PartCoolingFanController()
-    pcf_controller.analyze_gcode(gcode)
-    pcf_controller.inject_gcode()
+    pcf_controller.inject_gcode(edits)
+
+    if conf.calibration_markers:
+        logging.info(" - Injecting the calibration timing markers")
+        calibration.inject_markers(gcode, edits)
 
     gcode.print_total_runtime()
     gcode.print_total_extrusion()
@@ -77,13 +125,25 @@ def main():
 
     logging.info("-----------------------------------------")
     logging.info(" TC-PSPP : Writing modified file...      ")
-    filename_out = filename[0:filename.rfind('.gcode')] + '_' + tool_filament_names(tower.layers[0]) + '_' + gcode.total_runtime_str + '.gcode'
+    extension = '.bgcode' if gcode.bgcode is not None else '.gcode'
+    filename_base = filename[0:filename.rfind(extension)]
+    # Compressed input - compress the output the same way
+    compression = gcode_analyzer.compression_of(filename)
+    if compression is not None:
+        extension += compression
+    filename_out = filename_base + '_' + tool_filament_names(tower.layers[0]) + '_' + gcode.total_runtime_str + extension
     logging.info(" Writing to {filename}".format(filename = filename_out))
 
-    with open(filename_out, mode='w', encoding='utf8') as gcode_out:
-        for token in gcode.tokens:
-            gcode_out.write(str(token) + '\n')
-
+    if gcode.bgcode is not None:
+        # Re-encode into the binary blocks (keeps the metadata and thumbnails)
+        with open(filename_out, mode='wb') as gcode_out:
+            writer = bgcode.BGCodeWriter(gcode_out, gcode.bgcode)
+            gcode_analyzer.write_tokens(edits, writer)
+            writer.close()
+    else:
+        with gcode_analyzer.open_gcode_output(filename_out) as gcode_out:
+            gcode_analyzer.write_tokens(edits, gcode_out)
+    gcode.close()
 
     if conf.REMOVE_GCODE:
         logging.info(" Removing old file {filename}".format(filename = filename))
@@ -107,6 +167,10 @@ if __name__ == "__main__":
         logging.error("GCode parsing error:")
         logging.error("[Error] " + gcode_err.message)
         quit()
+    except calibration.CalibrationException as calibration_err:
+        logging.error("Calibration error:")
+        logging.error("[Error] " + calibration_err.message)
+        quit()
 
 
 
@@ -2,10 +2,13 @@ import conf
 import gcode_analyzer
 import tool_change_plan
 import doublelinkedlist
+import motion_planner
+import runtime_index
+import edit_overlay
+import token_visitor
 
 import time
 
-from gcode_analyzer import Token, GCodeAnalyzer
 from tool_change_plan import ToolChangeInfo, ToolChangeException
 from conf import ConfException
 
@@ -65,89 +68,106 @@ logger = logging.getLogger(__name__)
 #      - else insert idle temp at TC_TEMP_INITALIZE
 
 # Contains information about sequence of tool changes 
-class TemperatureController:
+class TemperatureController(token_visitor.TokenVisitor):
 
     def __init__(self):
         self.tool_activation_seq = {}
         self.temp_header = None
         self.temp_footer = None
         self.temp_layer1 = None
+        # Runtime index of the analyzed tokens (while injecting)
+        self.runtime_index = None
 
     # Analyze the layer information and generate 
     # the tool change sequence (layer independant)
     def analyze_gcode(self, gcode_analyzer):
-        t_start = time.time()
+        token_visitor.traverse(gcode_analyzer, [self])
+
+    # Visitor of the tokens (token_visitor.TokenVisitor)
+    def handlers(self):
+        return {
+            ';;TC_TEMP_INITIALIZE'  : self.visit_temp_header,
+            ';;TC_TEMP_SHUTDOWN'    : self.visit_temp_footer,
+            ';;BEFORE_LAYER_CHANGE' : self.visit_layer_change,
+            'M109'                  : self.visit_m109,
+            'T'                     : self.visit_tool_change,
+            ';;TOOL_BLOCK_START'    : self.visit_block_start,
+            ';;TOOL_BLOCK_END'      : self.visit_block_end }
+
+    def begin(self, gcode_analyzer):
+        self.t_start = time.time()
 
         # Generates the list of tool_activations per tool
         logger.debug("Generating tool activation sequence per tool...")
 
         # Go over the tokens to generate the Tool Change Info 
-        # Calculate the runtimes in the process
+        # Calculate the runtimes in the process (analyzed by the traversal)
         logger.info("Estimating the gcode runtimes")
+        if conf.runtime_planner:
+            # Acceleration aware move runtimes
+            motion_planner.plan_runtimes(gcode_analyzer)
 
         # Current tool head
-        current_tool = None
-
-        # Go over all of the tokens
-        for token in gcode_analyzer.analyze_state():
-            # Find the location of ;; TC_TEMP_INITIALIZE
-            if token.type == Token.PARAMS and token.label == 'TC_TEMP_INITIALIZE':
-                self.temp_header = token
-                continue
-
-            # Find the location of ;; TC_TEMP_SHUTDOWN
-            if token.type == Token.PARAMS and token.label == 'TC_TEMP_SHUTDOWN':
-                self.temp_footer = token
-                continue
-
-            # Find the first layer start
-            if token.type == Token.PARAMS and token.label == 'BEFORE_LAYER_CHANGE' and token.param[0] == 1:
-                self.temp_layer1 = token
-                continue
-
-            # Remove the existing tokens for temp managment
-            if token.type == Token.GCODE and token.gcode == 'M109':
-                logger.info("Removed an existing M109 gcode")
-                gcode_analyzer.tokens.remove_node(token)
-                continue
-
-            # Setup the tool changes
-            if token.type == Token.TOOLCHANGE:
-                if token.state_post.tool_selected != None:
-                    current_tool = ToolChangeInfo(tool_change = token)
-                    if current_tool.tool_id not in self.tool_activation_seq:
-                        self.tool_activation_seq[current_tool.tool_id] = []
-                    self.tool_activation_seq[current_tool.tool_id].append(current_tool)
-                continue
-
-            # Beginning to Tool block
-            if token.type == Token.PARAMS and token.label == 'TOOL_BLOCK_START':
-                tool_id = token.param[0]
-                if tool_id != -1:
-                    if tool_id != current_tool.tool_id:
-                        raise ToolChangeException(message = "Tool id {tool_id} from TOOL_BLOCK_START doesn't match last active tool in layer".format(tool_id = tool_id), tool_id = tool_id)
-                    current_tool.block_start = token
-                continue
-
-            # End of Tool block
-            if token.type == Token.PARAMS and token.label == 'TOOL_BLOCK_END':
-                tool_id = token.param[0]
-                if tool_id != -1:
-                    if tool_id != current_tool.tool_id:
-                        raise ToolChangeException(message = "Tool id {tool_id} from TOOL_BLOCK_END doesn't match last active tool in layer".format(tool_id = tool_id), tool_id = tool_id)
-                    current_tool.block_end = token
-                continue
+        self.current_tool = None
+
+    # Find the location of ;; TC_TEMP_INITIALIZE
+    def visit_temp_header(self, token):
+        self.temp_header = token
+
+    # Find the location of ;; TC_TEMP_SHUTDOWN
+    def visit_temp_footer(self, token):
+        self.temp_footer = token
+
+    # Find the first layer start
+    def visit_layer_change(self, token):
+        if token.param[0] == 1:
+            self.temp_layer1 = token
+
+    # Remove the existing tokens for temp managment
+    def visit_m109(self, token):
+        logger.info("Removed an existing M109 gcode")
+        token.dll.remove_node(token)
+
+    # Setup the tool changes
+    def visit_tool_change(self, token):
+        if token.state_post.tool_selected != None:
+            self.current_tool = ToolChangeInfo(tool_change = token)
+            if self.current_tool.tool_id not in self.tool_activation_seq:
+                self.tool_activation_seq[self.current_tool.tool_id] = []
+            self.tool_activation_seq[self.current_tool.tool_id].append(self.current_tool)
+
+    # Beginning to Tool block
+    def visit_block_start(self, token):
+        tool_id = token.param[0]
+        if tool_id != -1:
+            if tool_id != self.current_tool.tool_id:
+                raise ToolChangeException(message = "Tool id {tool_id} from TOOL_BLOCK_START doesn't match last active tool in layer".format(tool_id = tool_id), tool_id = tool_id)
+            self.current_tool.block_start = token
+
+    # End of Tool block
+    def visit_block_end(self, token):
+        tool_id = token.param[0]
+        if tool_id != -1:
+            if tool_id != self.current_tool.tool_id:
+                raise ToolChangeException(message = "Tool id {tool_id} from TOOL_BLOCK_END doesn't match last active tool in layer".format(tool_id = tool_id), tool_id = tool_id)
+            self.current_tool.block_end = token
+
+    def end(self, gcode_analyzer):
+        self.current_tool = None
 
         if self.temp_header is None:
             raise ConfException("TempController: Did not found TC_TEMP_INITIALIZE parameter in the GCode, slicer has not been configured correctly...")
         if self.temp_footer is None:
             raise ConfException("TempController: Did not found TC_TEMP_SHUTDOWN parameter in the GCode, slicer has not been configured correctly...")
 
+        # Time lookups while injecting
+        self.runtime_index = runtime_index.RuntimeIndex(gcode_analyzer.tokens)
+
         t_end = time.time()
-        logger.info("Analysis done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - t_start))
+        logger.info("Analysis done [elapsed: {elapsed:0.2f}s]".format(elapsed = t_end - self.t_start))
 
     # Prep tool layer intialization
-    def gcode_prep_header(self):
+    def gcode_prep_header(self, edits):
         # Prepare gcode in the header
         gcode_init = doublelinkedlist.DLList()
         gcode_wait = doublelinkedlist.DLList()
@@ -156,11 +176,7 @@ class TemperatureController:
         for tool_id, activation_seq in self.tool_activation_seq.items():
             tool_info = activation_seq[0]
 
-            time_delta = 0.0
-            token = self.temp_header.next
-            while token != tool_info.tool_change:
-                time_delta += token.runtime
-                token = token.next
+            time_delta = self.runtime_index.time_between(self.temp_header, tool_info.tool_change)
 
             logger.debug("INIT -> T{tool} - runtime estimate: {delta:0.2f}".format(tool = tool_id, delta = time_delta))
 
@@ -171,15 +187,9 @@ class TemperatureController:
 
             if time_temp_idle2tool < time_delta:
                 # Find the inject point 
-                acc_time = 0.0
-                inject_point = tool_info.tool_change.prev
-                while inject_point is not None:
-                    acc_time += inject_point.runtime
-                    if acc_time >= time_temp_idle2tool:
-                        break
-                    inject_point = inject_point.prev
+                inject_point = self.runtime_index.token_before(tool_info.tool_change, time_temp_idle2tool)
 
-                logger.debug("Inject point for T{tool} is before \"{token}\" - time diff: {delta:0.2f}s".format(tool = tool_id, token = str(inject_point), delta = acc_time))
+                logger.debug("Inject point for T{tool} is before \"{token}\" - time diff: {delta:0.2f}s".format(tool = tool_id, token = str(inject_point), delta = time_temp_idle2tool))
 
                 # Insert idle temp in TC_INIT
                 # Insert ramp up at inject point
@@ -187,8 +197,8 @@ class TemperatureController:
                 gcode_init.append_node(gcode_analyzer.GCode('M104', {'T' : tool_id, 'S' : tool_temp - conf.temp_idle_delta}))
                 gcode_wait.append_node(gcode_analyzer.GCode('M116', {'P' : tool_id, 'S' : 5}))
 
-                inject_point.append_node(gcode_analyzer.GCode('G10', {'P' : tool_id, 'R' : tool_temp}))
-                tool_info.tool_change.append_node_left(gcode_analyzer.GCode('M116', {'P' : tool_id, 'S' : 5}))
+                edits.insert_after(inject_point, gcode_analyzer.GCode('G10', {'P' : tool_id, 'R' : tool_temp}))
+                edits.insert_before(tool_info.tool_change, gcode_analyzer.GCode('M116', {'P' : tool_id, 'S' : 5}))
             else:
                 logger.debug("Inject point for T{tool} at TC_INIT".format(tool = tool_id))
 
@@ -202,11 +212,11 @@ class TemperatureController:
         gcode_wait.append_node(gcode_analyzer.GCode('M190'))
 
         # Inject the gcode at TC_INIT
-        self.temp_header.append_nodes_right(gcode_wait)
-        self.temp_header.append_nodes_right(gcode_init)
+        edits.insert_after(self.temp_header, gcode_wait)
+        edits.insert_after(self.temp_header, gcode_init)
         
     # Prep tool activation/deactivation/idling gcode
-    def gcode_prep_toolchange(self):
+    def gcode_prep_toolchange(self, edits):
         # Check the runtime estimate between subsequent tool changes 
         for tool_id, activation_seq in self.tool_activation_seq.items():
 
@@ -216,11 +226,7 @@ class TemperatureController:
                 tool_next_info = activation_seq[activation_indx]
 
                 # Calculate the time delta between the deactivation and the activation
-                time_delta = 0.0
-                token = tool_prev_info.block_end.next
-                while token != tool_next_info.tool_change:
-                    time_delta += token.runtime
-                    token = token.next
+                time_delta = self.runtime_index.time_between(tool_prev_info.block_end, tool_next_info.tool_change)
 
                 logger.debug("T{tool} block_end -> T{tool} activation - runtime estimate: {delta:0.2f}s".format(tool = tool_id, delta = time_delta))
 
@@ -267,24 +273,18 @@ class TemperatureController:
                 # Use the new heating time
                 if time_heating > 0.0:
                     # Find the injection point for next temp
-                    acc_time = 0.0
-                    inject_point = tool_next_info.tool_change.prev
-                    while inject_point is not None:
-                        acc_time += inject_point.runtime
-                        if acc_time >= time_heating:
-                            break
-                        inject_point = inject_point.prev
+                    inject_point = self.runtime_index.token_before(tool_next_info.tool_change, time_heating)
 
                     logger.debug("Inject point for T{tool} temp ramp-up is before \"{token}\" - time diff: {delta:0.2f}s".format(
-                            tool = tool_id, token = str(inject_point), delta = acc_time))
-                    inject_point.append_node(gcode_analyzer.GCode('G10', {'R' : next_temp, 'P' : tool_id}))
+                            tool = tool_id, token = str(inject_point), delta = time_heating))
+                    edits.insert_after(inject_point, gcode_analyzer.GCode('G10', {'R' : next_temp, 'P' : tool_id}))
 
                 # Inject the idle temp
-                tool_prev_info.block_end.append_node(gcode_analyzer.GCode('G10', {'R' : idle_temp, 'P' : tool_id}))
-                tool_next_info.tool_change.append_node_left(gcode_analyzer.GCode('M116', {'P' : tool_id, 'S' : 5}))
+                edits.insert_after(tool_prev_info.block_end, gcode_analyzer.GCode('G10', {'R' : idle_temp, 'P' : tool_id}))
+                edits.insert_before(tool_next_info.tool_change, gcode_analyzer.GCode('M116', {'P' : tool_id, 'S' : 5}))
 
     # Prep tool deactivation
-    def gcode_prep_deactivation(self):
+    def gcode_prep_deactivation(self, edits):
         # For each tool add disable block
         for tool_id, activation_seq in self.tool_activation_seq.items():
             tool_info = activation_seq[-1]
@@ -293,21 +293,27 @@ class TemperatureController:
                 logger.info("Disabling T{tool} at layer {layer}".format(
                     tool = tool_id, layer = tool_info.block_end.state_post.layer_num))
 
-                tool_info.block_end.append_node(gcode_analyzer.GCode('G10', {'R' : 0, 'T' : tool_id}))
+                edits.insert_after(tool_info.block_end, gcode_analyzer.GCode('G10', {'R' : 0, 'T' : tool_id}))
 
         # Insert deactivation at the end
         for tool_id in self.tool_activation_seq.keys():
-            self.temp_footer.append_node(gcode_analyzer.GCode('G10', {'R' : 0, 'T' : tool_id}))
-        self.temp_footer.append_node(gcode_analyzer.GCode('M140', {'S' : 0}))
+            edits.insert_after(self.temp_footer, gcode_analyzer.GCode('G10', {'R' : 0, 'T' : tool_id}))
+        edits.insert_after(self.temp_footer, gcode_analyzer.GCode('M140', {'S' : 0}))
 
     # Set the bed temperatures 
-    def gcode_prep_bed_temp(self):
-        self.temp_layer1.append_node(gcode_analyzer.GCode('M140', {'S' : conf.bed_temperature(1, self.tool_activation_seq.keys())}))
-        self.temp_layer1.append_node(gcode_analyzer.GCode('M190'))
+    def gcode_prep_bed_temp(self, edits):
+        edits.insert_after(self.temp_layer1, gcode_analyzer.GCode('M140', {'S' : conf.bed_temperature(1, self.tool_activation_seq.keys())}))
+        edits.insert_after(self.temp_layer1, gcode_analyzer.GCode('M190'))
 
     # Inject the GCode
-    def inject_gcode(self):
-        self.gcode_prep_header()
-        self.gcode_prep_bed_temp()
-        self.gcode_prep_toolchange()
-        self.gcode_prep_deactivation()
+    # - edits : where the GCode goes
+    def inject_gcode(self, edits = None):
+        edits = edit_overlay.edits_or_in_place(edits)
+
+        self.gcode_prep_header(edits)
+        self.gcode_prep_bed_temp(edits)
+        self.gcode_prep_toolchange(edits)
+        self.gcode_prep_deactivation(edits)
+
+        self.runtime_index.close()
+        self.runtime_index = None
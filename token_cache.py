@@ -0,0 +1,99 @@
+import conf
+
+import os, hashlib, pickle, tempfile
+
+import logging
+logger = logging.getLogger(__name__)
+
+# On-disk cache of the parsed token streams
+# - entries are keyed by the hash of the file contents and the parser version
+# - each entry is a pickled list of token records (tuples of plain values)
+# - the directory is capped in size, least recently used entries are evicted first
+#   (loading an entry touches its mtime)
+class TokenCache:
+    def __init__(self, directory = None, max_size = None):
+        self.directory = directory if directory is not None else conf.token_cache_dir
+        self.max_size = max_size if max_size is not None else conf.token_cache_max_size
+
+    # Build the cache key for the file
+    @staticmethod
+    def key(gcode_file, version):
+        digest = hashlib.sha256()
+        with open(gcode_file, mode='rb') as gcode_in:
+            while True:
+                chunk = gcode_in.read(1 << 20)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return "{digest}-v{version}".format(digest = digest.hexdigest(), version = version)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.tokens')
+
+    # Load the records - returns None if not in the cache (or unreadable)
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with open(path, mode='rb') as cache_in:
+                records = pickle.load(cache_in)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warn("Dropping unreadable token cache entry {path}: {error}".format(path = path, error = e))
+            self.remove(path)
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return records
+
+    # Store the records - written to a temporary file first so the
+    # readers never see partial entries
+    def store(self, key, records):
+        try:
+            os.makedirs(self.directory, exist_ok = True)
+            fd, temp_path = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+            try:
+                with os.fdopen(fd, mode='wb') as cache_out:
+                    pickle.dump(records, cache_out, protocol = pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_path, self.path(key))
+            except BaseException:
+                self.remove(temp_path)
+                raise
+        except OSError as e:
+            logger.warn("Failed to store the token cache entry: {error}".format(error = e))
+            return
+        self.evict()
+
+    # Remove the least recently used entries until the directory fits the cap
+    def evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.tokens'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            logger.debug("Evicting token cache entry {path}".format(path = path))
+            self.remove(path)
+            total_size -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,61 @@
+from gcode_analyzer import opcode_id
+
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Visitor of the tokens - the analysis passes (validator, prime tower, temp managment, PCF...)
+# - handlers()              : opcode name -> handler(token) (same names as the analyzer handlers - G1, T, ;;LABEL...)
+# - begin(gcode_analyzer)   : before the first token (after the state analysis)
+# - end(gcode_analyzer)     : after the last token
+# - analyzed                : needs the analyzed states of the tokens
+# The post-processing makes three traversals - validator, prime tower, thermal + PCF:
+# - the validator fixes the tokens the state analysis reads (M106, the omitted gcodes, T0 injected at the end)
+# - the thermal analysis needs the tower injected in the list
+# GCodeAnalyzer.update_statistics is not a visitor (works on the totals of the analysis)
+class TokenVisitor:
+    analyzed = True
+
+    def handlers(self):
+        return {}
+
+    def begin(self, gcode_analyzer):
+        pass
+
+    def end(self, gcode_analyzer):
+        pass
+
+# Visit the tokens with all the visitors in one pass
+# - the state analysis (if any of the visitors needs it) is shared by the visitors
+# - the handlers of the token are called in the order of the visitors
+# - the handlers can remove the visited token
+def traverse(gcode_analyzer, visitors):
+    t_start = time.time()
+
+    analyzed = any(visitor.analyzed for visitor in visitors)
+    if analyzed:
+        gcode_analyzer.analyze_state()
+    for visitor in visitors:
+        visitor.begin(gcode_analyzer)
+
+    # Handlers by the opcode
+    dispatch = {}
+    for visitor in visitors:
+        for name, handler in visitor.handlers().items():
+            dispatch.setdefault(opcode_id(name), []).append(handler)
+
+    visited = 0
+    for token in gcode_analyzer.tokens:
+        handlers = dispatch.get(token.op)
+        if handlers is not None:
+            visited += 1
+            for handler in handlers:
+                handler(token)
+
+    for visitor in visitors:
+        visitor.end(gcode_analyzer)
+
+    t_end = time.time()
+    logger.debug("Visited {visited} tokens with {visitors} [elapsed: {elapsed:0.2f}s]".format(
+        visited = visited, visitors = ', '.join(type(visitor).__name__ for visitor in visitors), elapsed = t_end - t_start))